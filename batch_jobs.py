@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Asynchronous bulk "batch job" support for completion classification.
+Classification requests are written to a JSONL file in the provider's
+batch format; a results file (downloaded from the batch API, or any local
+file in the same format) is later ingested and applied in bulk.
+A state file next to the batch file tracks which notes are still pending.
+
+Formats:
+  openai - OpenAI Batch API (/v1/chat/completions request lines)
+  gemini - Gemini batch mode (GenerateContentRequest lines keyed by "key")
+"""
+import os
+import json
+import hashlib
+
+from completion_providers import is_reasoning_model
+
+BATCH_FORMATS = ('openai', 'gemini')
+
+def request_id(rel_path):
+    """Stable custom_id for a note path (batch ids have length limits)."""
+    return 'note-' + hashlib.sha1(rel_path.encode('utf-8')).hexdigest()[:20]
+
+def request_line(fmt, custom_id, model, system_prompt, user_prompt, schema=None):
+    """
+    Build one batch request object in the given provider format.
+    `schema` (OpenAI only) constrains the answer with strict structured output.
+    """
+    if fmt == 'openai':
+        body = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ]
+        }
+        if not is_reasoning_model(model):
+            body["temperature"] = 0
+        if schema:
+            body["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "classification", "strict": True, "schema": schema}
+            }
+        return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+    if fmt == 'gemini':
+        return {
+            "key": custom_id,
+            "request": {
+                "system_instruction": {"parts": [{"text": system_prompt}]},
+                "contents": [{"role": "user", "parts": [{"text": user_prompt}]}],
+                "generation_config": {"temperature": 0},
+            },
+        }
+    raise ValueError(f"Unsupported batch format: {fmt}")
+
+def parse_result_line(fmt, obj):
+    """
+    Extract (custom_id, content, error) from one results-file object.
+    `content` is the model's text output, or None when the request failed.
+    """
+    if fmt == 'openai':
+        custom_id = obj.get('custom_id')
+        response = obj.get('response') or {}
+        if obj.get('error') or response.get('status_code', 200) != 200:
+            return custom_id, None, obj.get('error') or response.get('body')
+        try:
+            return custom_id, response['body']['choices'][0]['message']['content'], None
+        except (KeyError, IndexError, TypeError) as e:
+            return custom_id, None, f"malformed response: {e}"
+    if fmt == 'gemini':
+        custom_id = obj.get('key')
+        if obj.get('error'):
+            return custom_id, None, obj['error']
+        try:
+            parts = obj['response']['candidates'][0]['content']['parts']
+            return custom_id, ''.join(p.get('text', '') for p in parts), None
+        except (KeyError, IndexError, TypeError) as e:
+            return custom_id, None, f"malformed response: {e}"
+    raise ValueError(f"Unsupported batch format: {fmt}")
+
+def read_results(path, fmt):
+    """Yield (custom_id, content, error) for every line of a results JSONL file."""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield parse_result_line(fmt, json.loads(line))
+
+class BatchState:
+    """
+    Pending-request tracking for a batch file, stored as <batch_file>.state.json:
+      {"format": ..., "model": ..., "batch_ids": [...],
+       "requests": {custom_id: {path, hash, status, batch}}}
+    Status is one of: pending, applied, failed, changed (the note was edited
+    after its request was written). `batch` is the id of the submitted job
+    carrying the request, or None while it is only written to the batch file;
+    `batch_ids` lists the submitted jobs whose results are not ingested yet.
+    """
+    def __init__(self, batch_file):
+        self.path = f"{batch_file}.state.json"
+        self.data = {"format": None, "model": None, "batch_ids": [], "requests": {}}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.data.update(json.load(f))
+        # State files written before several jobs could be outstanding
+        old_id = self.data.pop('batch_id', None)
+        if old_id and old_id not in self.data['batch_ids']:
+            self.data['batch_ids'].append(old_id)
+        for r in self.requests.values():
+            r.setdefault('batch', old_id)
+
+    @property
+    def requests(self):
+        return self.data['requests']
+
+    def pending(self):
+        return {cid: r for cid, r in self.requests.items() if r['status'] == 'pending'}
+
+    def in_batch(self, batch_id):
+        """Pending requests carried by job `batch_id` (None: written but not submitted)."""
+        return {cid: r for cid, r in self.pending().items() if r['batch'] == batch_id}
+
+    def counts(self):
+        counts = {}
+        for r in self.requests.values():
+            counts[r['status']] = counts.get(r['status'], 0) + 1
+        return counts
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+
+def write_batch_file(path, lines, append=False):
+    with open(path, 'a' if append else 'w', encoding='utf-8') as f:
+        for obj in lines:
+            f.write(json.dumps(obj, ensure_ascii=False) + '\n')
+
+def submit_openai_batch(openai, batch_file):
+    """Upload a batch file and start an OpenAI batch job. Returns the batch id."""
+    with open(batch_file, 'rb') as f:
+        uploaded = openai.files.create(file=f, purpose='batch')
+    batch = openai.batches.create(
+        input_file_id=uploaded.id,
+        endpoint='/v1/chat/completions',
+        completion_window='24h',
+    )
+    return batch.id
+
+def poll_openai_batch(openai, batch_id, results_path):
+    """
+    Check an OpenAI batch job; when it has completed, download its output
+    to results_path. Returns the job status string.
+    """
+    batch = openai.batches.retrieve(batch_id)
+    if batch.status == 'completed' and batch.output_file_id:
+        content = openai.files.content(batch.output_file_id)
+        with open(results_path, 'wb') as f:
+            f.write(content.read())
+    return batch.status
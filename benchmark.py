@@ -0,0 +1,709 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for tag_refiner.py, generate_index.py and generate_taxonomy.py.
+Generates a synthetic vault (size, note-length distribution and share of
+Japanese text are configurable) and runs the real pipelines against
+simulated completion and embedding providers with configurable latency,
+error rate and server-side rate limits. No API is called. Reports
+throughput and p50/p95/p99 timings per stage (discovery, frontmatter
+parsing, classification, similarity scoring, writes, ...) so performance
+changes can be compared before they are rolled out. The startup suite
+checks each script's cold import time (`python -X importtime`) and
+`--help` time against a budget; the lexical suite checks the local
+classifier's accuracy on a toy set whose notes name their tag.
+"""
+import os
+import re
+import sys
+import json
+import time
+import math
+import random
+import shutil
+import zlib
+import argparse
+import tempfile
+import threading
+import subprocess
+import contextlib
+from argparse import Namespace
+from collections import defaultdict
+from datetime import date, timedelta
+
+import numpy as np
+
+import tag_refiner
+import instrumentation
+import tag_index
+import generate_index
+import generate_taxonomy
+from tag_refiner import (VaultScan, load_tags_file, run_notes, batched,
+                         process_file, process_batch, process_packed)
+from completion_providers import BaseProvider
+from embedding_classifier import BaseEmbeddingProvider
+from vault_manifest import VaultManifest, taxonomy_hash
+from rate_limit import RateLimiter, RateLimitedProvider, call_with_retry, estimate_tokens
+from taxonomy_merge import split_by_tokens
+from preprocess import count_tokens
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Cumulative cold import time budgets (ms) of the scripts: provider SDKs,
+# numpy and scikit-learn are only imported once a run needs them
+IMPORT_BUDGETS_MS = {
+    'tag_refiner': 150,
+    'generate_taxonomy': 120,
+    'generate_index': 60,
+}
+HELP_BUDGET_SECONDS = 0.5
+# Held-out micro F1 the lexical classifier must reach on the separable toy set
+LEXICAL_MIN_F1 = 0.9
+IMPORTTIME_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| (.*)$')
+
+JA_WORDS = ('機械学習', 'モデル', '論文', '実験', '評価', 'データ', '開発', 'ツール', '設定', '手順',
+            '結果', '比較', '性能', '改善', '記事', '要約', '技術', '発表', '公開', '農業')
+JA_PARTICLES = ('の', 'を', 'に', 'は', 'で', 'と', 'が')
+EN_WORDS = ('model', 'training', 'dataset', 'benchmark', 'release', 'agent', 'prompt', 'latency',
+            'throughput', 'embedding', 'vector', 'index', 'server', 'client', 'update', 'paper')
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark tag_refiner / generate_index / generate_taxonomy offline "
+                    "on a synthetic vault with simulated providers."
+    )
+    parser.add_argument(
+        "--suite",
+        action="append",
+        choices=["refiner", "index", "taxonomy", "startup", "lexical"],
+        help="Benchmark to run (repeatable; default: all)."
+    )
+    parser.add_argument(
+        "--vault",
+        help="Directory for the synthetic vault (default: a temporary directory, removed afterwards)."
+    )
+    parser.add_argument(
+        "--tags-file",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tags.yml'),
+        help="Taxonomy used for classification and index pages (default: tags.yml next to this script)."
+    )
+    parser.add_argument("--notes", type=int, default=1000, help="Number of notes (default: 1000).")
+    parser.add_argument("--dirs", type=int, default=20, help="Number of folders notes are spread over (default: 20).")
+    parser.add_argument(
+        "--length-median",
+        type=int,
+        default=2000,
+        help="Median note body length in characters; lengths are log-normal (default: 2000)."
+    )
+    parser.add_argument(
+        "--length-sigma",
+        type=float,
+        default=1.0,
+        help="Log-normal sigma of note lengths (default: 1.0)."
+    )
+    parser.add_argument(
+        "--japanese",
+        type=float,
+        default=0.7,
+        help="Share of Japanese text in note bodies, 0-1 (default: 0.7)."
+    )
+    parser.add_argument(
+        "--tagged",
+        type=float,
+        default=0.2,
+        help="Share of notes already tagged (with the tag revision checkbox) (default: 0.2)."
+    )
+    parser.add_argument(
+        "--provider",
+        choices=["completion", "embedding"],
+        default="completion",
+        help="Simulated provider type used by the refiner benchmark (default: completion)."
+    )
+    parser.add_argument("--concurrency", type=int, default=8, help="tag_refiner --concurrency (default: 8).")
+    parser.add_argument("--pack-size", type=int, default=1, help="tag_refiner --pack-size (default: 1).")
+    parser.add_argument("--embed-batch-size", type=int, default=64,
+                        help="tag_refiner --embed-batch-size (default: 64).")
+    parser.add_argument("--latency-ms", type=float, default=200.0,
+                        help="Median simulated completion latency (default: 200).")
+    parser.add_argument("--embed-latency-ms", type=float, default=50.0,
+                        help="Median simulated embedding request latency (default: 50).")
+    parser.add_argument("--latency-sigma", type=float, default=0.5,
+                        help="Log-normal sigma of simulated latencies (default: 0.5).")
+    parser.add_argument("--error-rate", type=float, default=0.02,
+                        help="Share of simulated requests failing with a retryable 503 (default: 0.02).")
+    parser.add_argument("--rpm", type=int, default=0,
+                        help="Simulated server requests-per-minute limit, answered with 429 (default: 0 = none).")
+    parser.add_argument("--tpm", type=int, default=0,
+                        help="Simulated server tokens-per-minute limit (default: 0 = none).")
+    parser.add_argument("--client-rpm", type=int,
+                        help="Client-side RateLimiter rpm as tag_refiner --rpm (default: same as --rpm).")
+    parser.add_argument("--client-tpm", type=int,
+                        help="Client-side RateLimiter tpm as tag_refiner --tpm (default: same as --tpm).")
+    parser.add_argument("--max-retries", type=int, default=5, help="Retries per request (default: 5).")
+    parser.add_argument("--embed-dim", type=int, default=256, help="Simulated embedding dimension (default: 256).")
+    parser.add_argument("--shard-tokens", type=int, default=3000,
+                        help="generate_taxonomy --shard-tokens for the taxonomy benchmark (default: 3000).")
+    parser.add_argument("--startup-runs", type=int, default=3,
+                        help="Cold starts measured per script in the startup benchmark (default: 3).")
+    parser.add_argument("--import-top", type=int, default=10,
+                        help="Slowest imports listed per script in the startup benchmark (default: 10).")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0).")
+    parser.add_argument("--report", help="Write the results as JSON to this file.")
+    return parser.parse_args()
+
+class StageTimer:
+    """Thread-safe per-stage duration samples."""
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def wrap(self, stage, fn):
+        """fn with every call timed under `stage`."""
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+    def wrap_iter(self, stage, fn):
+        """Generator function fn with the time to produce each item timed under `stage`."""
+        def timed(*args, **kwargs):
+            it = fn(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+                self.add(stage, time.perf_counter() - start)
+                yield item
+        return timed
+
+    def summary(self):
+        rows = {}
+        for stage, samples in self.samples.items():
+            ms = np.asarray(samples) * 1000.0
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            rows[stage] = {
+                'count': len(samples),
+                'total_s': round(float(ms.sum()) / 1000.0, 4),
+                'p50_ms': round(float(p50), 3),
+                'p95_ms': round(float(p95), 3),
+                'p99_ms': round(float(p99), 3),
+            }
+        return rows
+
+@contextlib.contextmanager
+def patched(module, name, value):
+    """Temporarily replace a module attribute (used to time library calls in place)."""
+    original = getattr(module, name)
+    setattr(module, name, value)
+    try:
+        yield
+    finally:
+        setattr(module, name, original)
+
+class SimulatedError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+class SimulatedService:
+    """
+    Stand-in for a remote API: log-normal latency, random retryable
+    failures (503) and server-side rpm/tpm limits answered with 429.
+    """
+    def __init__(self, latency_ms, sigma=0.5, error_rate=0.0, rpm=0, tpm=0, seed=0, timer=None, stage='api'):
+        self.latency = latency_ms / 1000.0
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.rpm = rpm
+        self.tpm = tpm
+        self.timer = timer
+        self.stage = stage
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._last = time.monotonic()
+
+    def _admit(self, tokens):
+        now = time.monotonic()
+        elapsed, self._last = now - self._last, now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60.0)
+            if self._requests < 1:
+                return False
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+            if self._tokens < min(tokens, self.tpm):
+                return False
+        if self.rpm:
+            self._requests -= 1
+        if self.tpm:
+            self._tokens -= min(tokens, self.tpm)
+        return True
+
+    def call(self, tokens=0):
+        with self._lock:
+            self.calls += 1
+            admitted = self._admit(tokens)
+            delay = self._rng.lognormvariate(math.log(self.latency), self.sigma) if self.latency > 0 else 0.0
+            failed = self._rng.random() < self.error_rate
+            if not admitted:
+                self.throttled += 1
+            elif failed:
+                self.errors += 1
+        if not admitted:
+            raise SimulatedError(429, "simulated rate limit")
+        start = time.perf_counter()
+        time.sleep(delay)
+        if self.timer is not None:
+            self.timer.add(self.stage, time.perf_counter() - start)
+        if failed:
+            raise SimulatedError(503, "simulated server error")
+
+    def stats(self):
+        return {'calls': self.calls, 'errors': self.errors, 'throttled': self.throttled}
+
+def _pick_tags(text, tags_list):
+    """Deterministic 1-3 tags for a text."""
+    h = zlib.crc32(text.encode('utf-8'))
+    return [tags_list[(h >> (8 * i)) % len(tags_list)] for i in range(1 + h % 3)]
+
+class SimulatedCompletionProvider(BaseProvider):
+    """Completion provider answering classification prompts from a SimulatedService."""
+    def __init__(self, service, tags_list, model='simulated'):
+        self.service = service
+        self.tags_list = tags_list
+        self.model = model
+
+    def complete(self, system_prompt, user_prompt):
+        self.service.call(estimate_tokens(system_prompt) + estimate_tokens(user_prompt))
+        if '### ID: ' in user_prompt:
+            blocks = user_prompt.split('### ID: ')[1:]
+            return json.dumps({b.split('\n', 1)[0].strip(): _pick_tags(b, self.tags_list) for b in blocks})
+        return json.dumps(_pick_tags(user_prompt, self.tags_list), ensure_ascii=False)
+
+class SimulatedEmbeddingProvider(BaseEmbeddingProvider):
+    """Embedding provider returning deterministic pseudo-random vectors from a SimulatedService."""
+    name = 'simulated'
+    max_batch_inputs = 64
+    max_input_chars = 8000
+
+    def __init__(self, service, dim=256, model='simulated-embedding', top_k=3):
+        super().__init__(model, top_k)
+        self.service = service
+        self.dim = dim
+
+    def embed_texts(self, texts):
+        if not texts:
+            return []
+        self.service.call(sum(estimate_tokens(t) for t in texts))
+        return [np.random.default_rng(zlib.crc32(t.encode('utf-8'))).standard_normal(self.dim).astype(np.float32)
+                for t in texts]
+
+def _sentence(rng, japanese):
+    if rng.random() < japanese:
+        words = [rng.choice(JA_WORDS) + rng.choice(JA_PARTICLES) for _ in range(rng.randint(3, 8))]
+        return ''.join(words) + '。'
+    words = [rng.choice(EN_WORDS) for _ in range(rng.randint(5, 14))]
+    return ' '.join(words).capitalize() + '.'
+
+def synthetic_note(rng, i, tags_list, length, japanese, tagged):
+    """Markdown text of one synthetic note with about `length` body characters."""
+    topic = rng.choice(tags_list)
+    title = f"{topic.split('/')[-1]} {rng.choice(EN_WORDS)} {i}"
+    created = date(2023, 1, 1) + timedelta(days=rng.randrange(1000))
+    fm = [
+        '---',
+        f'title: "{title}"',
+        f'source: "https://example.com/{i}"',
+        f'created: {created.isoformat()}',
+        f'description: "{_sentence(rng, japanese)}"',
+    ]
+    if tagged:
+        fm.append('tags:')
+        fm.extend(f'  - "{t}"' for t in _pick_tags(title, tags_list))
+        fm.append('tag_revision_needed: false')
+    fm.append('---')
+    paragraphs, size = [], 0
+    while size < length:
+        paragraph = ''.join(_sentence(rng, japanese) for _ in range(rng.randint(2, 6)))
+        paragraphs.append(paragraph)
+        size += len(paragraph)
+    return '\n'.join(fm) + f"\n# {title}\n\n" + '\n\n'.join(paragraphs) + '\n'
+
+def generate_vault(root, args, tags_list):
+    """Write the synthetic vault; returns the total size in bytes."""
+    rng = random.Random(args.seed)
+    total = 0
+    for i in range(args.notes):
+        folder = os.path.join(root, f"folder{i % max(1, args.dirs):03d}")
+        os.makedirs(folder, exist_ok=True)
+        length = int(rng.lognormvariate(math.log(max(1, args.length_median)), args.length_sigma))
+        text = synthetic_note(rng, i, tags_list, length, args.japanese, rng.random() < args.tagged)
+        data = text.encode('utf-8')
+        with open(os.path.join(folder, f"note{i:06d}.md"), 'wb') as f:
+            f.write(data)
+        total += len(data)
+    return total
+
+def bench_refiner(vault, work, args, tags_list, timer):
+    """Tag the vault with tag_refiner's pipeline, then re-run it on the unchanged vault."""
+    tax_hash = taxonomy_hash(tags_list)
+    manifest = VaultManifest(os.path.join(work, 'manifest.json'), vault)
+    if args.provider == 'embedding':
+        service = SimulatedService(args.embed_latency_ms, args.latency_sigma, args.error_rate,
+                                   args.rpm, args.tpm, args.seed, timer, 'api.embedding')
+        fake = SimulatedEmbeddingProvider(service, args.embed_dim)
+    else:
+        service = SimulatedService(args.latency_ms, args.latency_sigma, args.error_rate,
+                                   args.rpm, args.tpm, args.seed, timer, 'api.completion')
+        fake = SimulatedCompletionProvider(service, tags_list)
+    client_rpm = args.rpm if args.client_rpm is None else args.client_rpm
+    client_tpm = args.tpm if args.client_tpm is None else args.client_tpm
+    provider = RateLimitedProvider(fake, RateLimiter(client_rpm or None, client_tpm or None),
+                                   max_retries=args.max_retries)
+    if args.provider == 'embedding':
+        provider.load_tags(tags_list)
+        index = fake.index
+        index.classify = timer.wrap('similarity', index.classify)
+        index.classify_batch = timer.wrap('similarity', index.classify_batch)
+        classify = timer.wrap('classify', provider.classify_batch)
+        group = max(1, args.embed_batch_size)
+
+        def handle(paths):
+            with timer.measure('note_group'):
+                process_batch(paths, Namespace(classify_batch=classify), tags_list,
+                              manifest=manifest, tax_hash=tax_hash)
+    elif args.pack_size > 1:
+        classify_packed = timer.wrap('classify.packed', provider.classify_packed)
+        classify_single = timer.wrap('classify', provider.classify)
+        group = args.pack_size
+
+        def handle(paths):
+            with timer.measure('note_group'):
+                process_packed(paths, Namespace(classify_packed=classify_packed, classify=classify_single),
+                               tags_list, manifest=manifest, tax_hash=tax_hash)
+    else:
+        classify = timer.wrap('classify', provider.classify)
+        group = None
+
+        def handle(note):
+            with timer.measure('note'):
+                process_file(note.path, Namespace(classify=classify), tags_list, manifest=manifest,
+                             tax_hash=tax_hash, header=note.header)
+
+    def run():
+        scan = VaultScan(vault, manifest, tax_hash, manifest, workers=8)
+        notes = iter(scan)
+        run_notes(notes if group is None else batched(notes, group), handle, concurrency=args.concurrency)
+        manifest.save()
+        return scan
+
+    with patched(tag_refiner, 'iter_notes', timer.wrap_iter('discovery', tag_refiner.iter_notes)), \
+            patched(tag_refiner, 'read_header', timer.wrap('frontmatter', tag_refiner.read_header)), \
+            patched(tag_refiner, 'read_head_tail', timer.wrap('read', tag_refiner.read_head_tail)), \
+            patched(tag_refiner, 'replace_header', timer.wrap('write', tag_refiner.replace_header)):
+        counters = instrumentation.METRICS.counters
+        before = counters['notes_tagged'], counters['notes_failed']
+        start = time.perf_counter()
+        scan = run()
+        elapsed = time.perf_counter() - start
+        handled = counters['notes_tagged'] - before[0], counters['notes_failed'] - before[1]
+        start = time.perf_counter()
+        rerun = run()
+        rerun_elapsed = time.perf_counter() - start
+    tagged = sum(1 for e in manifest.entries.values() if e.get('status') == 'tagged')
+    return {
+        'notes': len(scan.seen),
+        'tagged': tagged,
+        'skipped': scan.skipped,
+        'failed': handled[1],
+        # Notes neither tagged nor reported as failed, e.g. a failing note that aborted its worker
+        'lost': len(scan.seen) - scan.skipped - scan.unchanged - sum(handled),
+        'seconds': round(elapsed, 3),
+        'notes_per_second': round(len(scan.seen) / elapsed, 2) if elapsed else None,
+        'rerun_seconds': round(rerun_elapsed, 3),
+        'rerun_unchanged': rerun.unchanged,
+        'service': service.stats(),
+    }
+
+def bench_index(vault, work, args, timer):
+    """Build the tag index and static index pages, then refresh both on the unchanged vault."""
+    tax = generate_index.load_taxonomy(args.tags_file)
+    output_dir = os.path.join(work, 'index')
+    folder = os.path.basename(os.path.normpath(vault))
+    results = {}
+    with patched(tag_index, 'iter_notes', timer.wrap_iter('index.discovery', tag_index.iter_notes)), \
+            patched(tag_index, 'note_entry', timer.wrap('index.frontmatter', tag_index.note_entry)), \
+            patched(generate_index, 'write_if_changed', timer.wrap('index.write', generate_index.write_if_changed)):
+        for run in ('build', 'refresh'):
+            start = time.perf_counter()
+            index = tag_index.TagIndex(os.path.join(work, 'tagindex.json'), vault)
+            with timer.measure(f'index.scan.{run}'):
+                read = index.refresh()
+            index.save()
+            with timer.measure('index.invert'):
+                by_tag = index.notes_by_tag()
+            with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                with timer.measure('index.render'):
+                    written = generate_index.write_index(tax, output_dir, folder, by_tag)
+            elapsed = time.perf_counter() - start
+            results[run] = {
+                'notes': len(index.entries),
+                'read': read,
+                'pages_written': written,
+                'seconds': round(elapsed, 3),
+                'notes_per_second': round(len(index.entries) / elapsed, 2) if elapsed else None,
+            }
+    return results
+
+def simulated_taxonomy_reply(prompt):
+    """YAML a taxonomy model might return: categories from title words, or the merged input echoed."""
+    if prompt.startswith('ノートタイトル一覧'):
+        categories = defaultdict(set)
+        for line in prompt.split('\n'):
+            if line.startswith('- '):
+                words = [w for w in (re.sub(r'\W', '', w) for w in line[2:].split()) if w and w != 'title']
+                if len(words) >= 2:
+                    categories[words[0]].add(words[1])
+        return '```yaml\n' + ''.join(
+            f"{c}:\n" + ''.join(f"  - {s}\n" for s in sorted(subs)) for c, subs in categories.items()
+        ) + '```\n'
+    return prompt.split(':\n', 1)[-1].split('同じ意味')[0]
+
+def bench_taxonomy(vault, args, timer):
+    """Collect titles, cluster their simulated embeddings and run map-reduce generation."""
+    results = {}
+    with patched(generate_taxonomy, 'read_title', timer.wrap('taxonomy.title', generate_taxonomy.read_title)):
+        start = time.perf_counter()
+        titles = generate_taxonomy.collect_titles(vault)
+        results['collect_seconds'] = round(time.perf_counter() - start, 3)
+    results['titles'] = len(titles)
+    service = SimulatedService(args.embed_latency_ms, args.latency_sigma, args.error_rate,
+                               args.rpm, args.tpm, args.seed, timer, 'api.embedding')
+    embedder = SimulatedEmbeddingProvider(service, args.embed_dim)
+    embedder.max_retries = args.max_retries
+    from clustering import StreamingClusterer
+    clusterer = StreamingClusterer(min(10, len(titles)), batch_size=2048)
+    start = time.perf_counter()
+    for batch in batched(titles, 2048):
+        with timer.measure('taxonomy.embed'):
+            embs = embedder.embed_many(batch)
+        with timer.measure('taxonomy.cluster'):
+            clusterer.partial_fit(embs)
+    with timer.measure('taxonomy.cluster'):
+        clusterer.finish()
+    if not clusterer.sampled_all:
+        for batch in batched(titles, 2048):
+            with timer.measure('taxonomy.embed'):
+                embs = embedder.embed_many(batch)
+            with timer.measure('taxonomy.cluster'):
+                clusterer.assign(embs)
+    with timer.measure('taxonomy.cluster'):
+        clusterer.representatives(10)
+    results['cluster_seconds'] = round(time.perf_counter() - start, 3)
+
+    llm = SimulatedService(args.latency_ms, args.latency_sigma, args.error_rate,
+                           args.rpm, args.tpm, args.seed, timer, 'api.completion')
+
+    def request(system_prompt, user_prompt):
+        llm.call(estimate_tokens(system_prompt) + estimate_tokens(user_prompt))
+        return simulated_taxonomy_reply(user_prompt)
+
+    limiter = RateLimiter((args.rpm if args.client_rpm is None else args.client_rpm) or None,
+                          (args.tpm if args.client_tpm is None else args.client_tpm) or None)
+
+    def complete(system_prompt, user_prompt):
+        limiter.acquire(estimate_tokens(system_prompt) + estimate_tokens(user_prompt))
+        return call_with_retry(request, system_prompt, user_prompt, max_retries=args.max_retries)
+
+    options = Namespace(depth=3, shard_tokens=args.shard_tokens, concurrency=args.concurrency, model=None)
+    shards = split_by_tokens(titles, args.shard_tokens, lambda t: count_tokens(f"- {t}\n"))
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        tree = generate_taxonomy.generate_map_reduce(shards, timer.wrap('taxonomy.llm', complete), options)
+    results['map_reduce_seconds'] = round(time.perf_counter() - start, 3)
+    results['shards'] = len(shards)
+    results['categories'] = len(tree)
+    results['service'] = llm.stats()
+    return results
+
+def bench_lexical(args, tags_list, timer):
+    """
+    Train the lexical classifier on a separable toy set (filler text plus
+    the note's tag path, mentioned three times) and score held-out notes.
+    """
+    from lexical_classifier import LexicalModel
+    rng = random.Random(args.seed)
+    train, test = [], []
+    for i in range(args.notes):
+        tag = rng.choice(tags_list)
+        parts = [_sentence(rng, args.japanese) for _ in range(rng.randint(5, 20))]
+        for _ in range(3):
+            parts.insert(rng.randint(0, len(parts)), ' '.join(tag.split('/')) + '。')
+        (test if i % 5 == 0 else train).append((f"note{i:06d}.md", '1', ''.join(parts), [tag]))
+    model = LexicalModel(seed=args.seed)
+    with timer.measure('lexical.train'):
+        model.update(train)
+    with timer.measure('lexical.predict'):
+        predicted = model.predict([text for _, _, text, _ in test], tags_list)
+    hits = sum(len(set(p or ()) & set(tags)) for p, (_, _, _, tags) in zip(predicted, test))
+    emitted = sum(len(p or ()) for p in predicted)
+    precision = hits / emitted if emitted else 0.0
+    recall = hits / len(test) if test else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if hits else 0.0
+    return {
+        'train_notes': len(train),
+        'test_notes': len(test),
+        'untagged': sum(1 for p in predicted if p is None),
+        'precision': round(precision, 3),
+        'recall': round(recall, 3),
+        'f1': round(f1, 3),
+        'min_f1': LEXICAL_MIN_F1,
+        'train_notes_per_second': round(len(train) / timer.samples['lexical.train'][-1], 1),
+    }
+
+def import_times(module):
+    """
+    (self us, cumulative us, indented name) rows of `python -X importtime -c
+    'import module'`, limited to the module and the imports below it.
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                          cwd=SCRIPT_DIR, capture_output=True, text=True)
+    if proc.returncode:
+        raise RuntimeError(f"importing {module} failed: {proc.stderr.strip().splitlines()[-1:]}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        m = IMPORTTIME_RE.match(line)
+        if m:
+            rows.append((int(m.group(1)), int(m.group(2)), m.group(3)))
+    # Rows are printed when an import finishes: the module's subtree follows
+    # the previous top-level row (interpreter startup, e.g. site)
+    end = max(i for i, row in enumerate(rows) if row[2] == module)
+    start = max((i + 1 for i, row in enumerate(rows[:end]) if not row[2].startswith(' ')), default=0)
+    return rows[start:end + 1]
+
+def bench_startup(args, timer):
+    """Cold import and --help times of each script in fresh interpreters, against their budgets."""
+    results = {}
+    for module, budget in IMPORT_BUDGETS_MS.items():
+        imports = []
+        for _ in range(max(1, args.startup_runs)):
+            rows = import_times(module)
+            total = rows[-1][1]
+            timer.add(f"startup.{module}.import", total / 1e6)
+            imports.append((total, rows))
+            with timer.measure(f"startup.{module}.help"):
+                subprocess.run([sys.executable, f"{module}.py", '--help'], cwd=SCRIPT_DIR,
+                               capture_output=True, check=True)
+        # The median run is compared against the budget; its slowest imports are listed
+        imports.sort(key=lambda run: run[0])
+        total, rows = imports[len(imports) // 2]
+        help_s = sorted(timer.samples[f"startup.{module}.help"])[len(imports) // 2]
+        heaviest = sorted(rows[:-1], key=lambda row: -row[1])
+        results[module] = {
+            'import_ms': round(total / 1000.0, 1),
+            'import_budget_ms': budget,
+            'help_s': round(help_s, 3),
+            'help_budget_s': HELP_BUDGET_SECONDS,
+            'over_budget': total / 1000.0 > budget or help_s > HELP_BUDGET_SECONDS,
+            'modules': len(rows),
+            'heaviest': heaviest[:args.import_top],
+        }
+    return results
+
+def print_startup(startup):
+    for module, row in startup.items():
+        flag = '  OVER BUDGET' if row['over_budget'] else ''
+        print(f"\n{module}: import {row['import_ms']:.1f} ms (budget {row['import_budget_ms']} ms), "
+              f"--help {row['help_s']:.3f} s (budget {row['help_budget_s']} s), "
+              f"{row['modules']} modules{flag}")
+        print("import time: self [us] | cumulative | imported package")
+        for self_us, cum_us, name in row['heaviest']:
+            print(f"import time: {self_us:>9} | {cum_us:>10} | {name}")
+
+def print_report(report):
+    print(f"\n{'stage':<24}{'count':>8}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, row in sorted(report['stages'].items()):
+        print(f"{stage:<24}{row['count']:>8}{row['total_s']:>10.3f}{row['p50_ms']:>10.2f}"
+              f"{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}")
+    for suite in ('refiner', 'index', 'taxonomy', 'lexical'):
+        if suite in report:
+            print(f"\n{suite}: {json.dumps(report[suite], ensure_ascii=False)}")
+    if 'startup' in report:
+        print_startup(report['startup'])
+
+def main():
+    args = parse_args()
+    suites = args.suite or ['refiner', 'index', 'taxonomy', 'startup', 'lexical']
+    tags_list = load_tags_file(args.tags_file)
+    work = tempfile.mkdtemp(prefix='tag_refiner_bench_')
+    vault = args.vault or os.path.join(work, 'vault')
+    try:
+        if os.path.isdir(vault) and os.listdir(vault):
+            sys.exit(f"Error: vault directory {vault} is not empty.")
+        start = time.perf_counter()
+        size = generate_vault(vault, args, tags_list)
+        print(f"Synthetic vault: {vault} ({args.notes} notes, {size / 1e6:.1f} MB, "
+              f"generated in {time.perf_counter() - start:.1f}s)")
+        report = {'config': vars(args)}
+        for suite in suites:
+            timer = StageTimer()
+            print(f"Running {suite} benchmark...")
+            # The pipelines report every note; keep the benchmark output readable
+            with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                if suite == 'refiner':
+                    result = bench_refiner(vault, work, args, tags_list, timer)
+                elif suite == 'index':
+                    result = bench_index(vault, work, args, timer)
+                elif suite == 'startup':
+                    result = bench_startup(args, timer)
+                elif suite == 'lexical':
+                    result = bench_lexical(args, tags_list, timer)
+                else:
+                    result = bench_taxonomy(vault, args, timer)
+            report[suite] = result
+            report.setdefault('stages', {}).update(
+                {(stage if stage.startswith(f"{suite}.") else f"{suite}.{stage}"): row
+                 for stage, row in timer.summary().items()}
+            )
+        print_report(report)
+        if args.report:
+            with open(args.report, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"\nReport written to {args.report}")
+        if report.get('refiner', {}).get('lost'):
+            print(f"Error: {report['refiner']['lost']} notes were neither tagged nor reported as failed",
+                  file=sys.stderr)
+            sys.exit(1)
+        if report.get('lexical', {}).get('f1', LEXICAL_MIN_F1) < LEXICAL_MIN_F1:
+            print(f"Error: lexical classifier F1 {report['lexical']['f1']} is below {LEXICAL_MIN_F1}",
+                  file=sys.stderr)
+            sys.exit(1)
+        over = [module for module, row in report.get('startup', {}).items() if row['over_budget']]
+        if over:
+            print(f"Error: startup over budget: {', '.join(over)}", file=sys.stderr)
+            sys.exit(1)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Confidence-gated classification cascade.
+A cheap local stage answers the notes it is confident about and escalates
+the rest to the next provider (ultimately a completion model). Each stage
+counts how many notes it resolved so runs can report the split.
+"""
+import sys
+import threading
+
+from similarity import as_matrix
+
+class GatedProvider:
+    """
+    Base for a first-stage classifier wrapped around a fallback provider.
+    Subclasses implement predict_many(texts, tags_list), returning tags for
+    confident notes and None for notes to escalate. `stats` counts notes
+    resolved here (under `stage`) and notes escalated to the fallback.
+    Other attributes (model, load_tags, ...) are passed through to the fallback.
+    """
+    stage = 'fast'
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self.stats = {self.stage: 0, 'escalated': 0}
+        self._stats_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.fallback, name)
+
+    def predict_many(self, texts, tags_list):
+        raise NotImplementedError
+
+    def _resolve(self, texts, tags_list):
+        """First-stage results and the indices left for the fallback."""
+        results = self.predict_many(texts, tags_list)
+        unresolved = [i for i, tags in enumerate(results) if tags is None]
+        with self._stats_lock:
+            self.stats[self.stage] += len(texts) - len(unresolved)
+            self.stats['escalated'] += len(unresolved)
+        return results, unresolved
+
+    def classify(self, text, tags_list):
+        results, unresolved = self._resolve([text], tags_list)
+        if unresolved:
+            return self.fallback.classify(text, tags_list)
+        return results[0]
+
+    def classify_batch(self, texts, tags_list):
+        results, unresolved = self._resolve(texts, tags_list)
+        if unresolved:
+            if hasattr(self.fallback, 'classify_batch'):
+                fallback = self.fallback.classify_batch([texts[i] for i in unresolved], tags_list)
+            else:
+                fallback = [self.fallback.classify(texts[i], tags_list) for i in unresolved]
+            for i, tags in zip(unresolved, fallback):
+                results[i] = tags
+        return results
+
+    def classify_packed(self, notes, tags_list):
+        """Packed-mode counterpart: only escalated notes are packed into the fallback request."""
+        results, unresolved = self._resolve([text for _, text in notes], tags_list)
+        out = {nid: tags for (nid, _), tags in zip(notes, results) if tags is not None}
+        if len(unresolved) > 1:
+            try:
+                out.update(self.fallback.classify_packed([notes[i] for i in unresolved], tags_list))
+            except Exception as e:
+                print(f"Warning: packed request failed, falling back to single notes: {e}", file=sys.stderr)
+        # Escalated notes missing from the packed answer go to the fallback one by one
+        for i in unresolved:
+            nid, text = notes[i]
+            if nid not in out:
+                out[nid] = self.fallback.classify(text, tags_list)
+        return out
+
+class CascadeProvider(GatedProvider):
+    """
+    Embedding-similarity first stage. A note is resolved locally when the
+    cosine similarity of its best tag beats the runner-up by at least
+    `margin`; otherwise it is escalated to the completion provider.
+    """
+    stage = 'embedding'
+
+    def __init__(self, embedder, fallback, margin=0.02):
+        super().__init__(fallback)
+        self.embedder = embedder
+        self.margin = margin
+
+    def predict_many(self, texts, tags_list):
+        self.embedder.load_tags(tags_list)
+        if not texts:
+            return []
+        index = self.embedder.index
+        top_k = self.embedder.top_k
+        embs = as_matrix(self.embedder.embed_many(texts), dim=index.dim)
+        results = []
+        for row, ranked in zip(embs, index.top_k_batch(embs, max(top_k, 2))):
+            if not row.any():
+                results.append(None)
+            elif len(ranked) < 2 or ranked[0][1] - ranked[1][1] >= self.margin:
+                results.append([tag for tag, _ in ranked[:top_k]])
+            else:
+                results.append(None)
+        return results
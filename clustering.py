@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Streaming title clustering for taxonomy generation.
+Title embeddings arrive in batches and are fed to MiniBatchKMeans.partial_fit,
+optionally after a random projection to fewer dimensions. Memory stays
+bounded by the vault size: only a fixed-size reservoir sample of the
+vectors is kept for the refinement epochs, and representative titles (the
+ones closest to their cluster centre, several per cluster in proportion to
+the cluster's size) are picked from fixed-size per-cluster candidate lists
+filled by a second pass over the embeddings. When the sample holds every
+title the second pass is skipped.
+"""
+import numpy as np
+
+from similarity import as_matrix, normalize_rows
+
+def random_projection(dim, out_dim, seed=0):
+    """Gaussian random projection matrix (dim x out_dim); preserves cosine similarity approximately."""
+    rng = np.random.default_rng(seed)
+    return (rng.standard_normal((dim, out_dim)) / np.sqrt(out_dim)).astype(np.float32)
+
+def representative_counts(sizes, total):
+    """
+    Split `total` representatives over clusters in proportion to their sizes,
+    giving every non-empty cluster at least one and no cluster more than its size.
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    filled = sizes > 0
+    total = max(int(total), int(filled.sum()))
+    counts = np.minimum(sizes, np.maximum(filled, np.floor(total * sizes / max(sizes.sum(), 1)))).astype(np.int64)
+    # Hand out the remainder to the clusters with the most titles per representative
+    for _ in range(int(min(total, sizes.sum()) - counts.sum())):
+        room = np.where(counts < sizes, sizes / np.maximum(counts, 1), -1)
+        counts[int(np.argmax(room))] += 1
+    return counts
+
+def select_representatives(similarity, labels, counts):
+    """
+    Indices of the counts[c] rows of each cluster c with the highest
+    similarity to their centre, ordered by cluster and then by closeness.
+    """
+    order = np.lexsort((-similarity, labels))
+    sorted_labels = labels[order]
+    starts = np.searchsorted(sorted_labels, np.arange(len(counts)))
+    rank = np.arange(len(order)) - starts[sorted_labels]
+    return order[rank < counts[sorted_labels]]
+
+class StreamingClusterer:
+    """
+    Cluster embedding batches with MiniBatchKMeans.partial_fit.
+    Rows are L2-normalized (and projected to reduce_dim dimensions when
+    reduce_dim > 0); batches smaller than n_clusters are buffered until
+    partial_fit can take them. Up to `sample_size` rows are kept as a
+    reservoir sample for finish(); assign() then takes the rows again, in
+    the same order, and keeps the `candidates` rows closest to each centre.
+    Empty embeddings (failed requests) are skipped but keep their row
+    numbers, so representatives index the caller's titles.
+    """
+    def __init__(self, n_clusters, reduce_dim=0, batch_size=2048, sample_size=8192, candidates=64, seed=0):
+        self.n_clusters = n_clusters
+        self.reduce_dim = reduce_dim
+        # scikit-learn takes about a second to import; only pay it when clustering
+        from sklearn.cluster import MiniBatchKMeans
+        self.kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size,
+                                      random_state=seed, n_init=3)
+        self.projection = None
+        self.seed = seed
+        self.sample_size = sample_size
+        self.candidates = candidates
+        self.sample = None
+        self.sample_rows = np.zeros(0, dtype=np.int64)
+        self.rows = 0
+        self.kept = 0
+        self.dim = None
+        self._rng = np.random.default_rng(seed)
+        self._pending = []
+        self._fitted = False
+        self._reset_assignment()
+
+    def _reset_assignment(self):
+        self.assigned = 0
+        self.sizes = np.zeros(self.n_clusters, dtype=np.int64)
+        self._cand_rows = np.zeros(0, dtype=np.int64)
+        self._cand_labels = np.zeros(0, dtype=np.int64)
+        self._cand_sims = np.zeros(0, dtype=np.float32)
+
+    def _transform(self, embeddings, start):
+        """(row numbers, vectors) of the non-empty embeddings of a batch whose first row is `start`."""
+        embeddings = list(embeddings)
+        keep = [i for i, e in enumerate(embeddings) if e is not None and len(e)]
+        if self.dim is None and keep:
+            self.dim = len(embeddings[keep[0]])
+        vectors = normalize_rows(as_matrix([embeddings[i] for i in keep], dim=self.dim or 0))
+        if self.reduce_dim and self.reduce_dim < vectors.shape[1]:
+            if self.projection is None:
+                self.projection = random_projection(vectors.shape[1], self.reduce_dim, self.seed)
+            vectors = normalize_rows(vectors @ self.projection)
+        return start + np.asarray(keep, dtype=np.int64), vectors
+
+    def _keep_sample(self, rows, vectors):
+        """Reservoir sampling (algorithm R) of the rows seen so far."""
+        seen = np.arange(self.kept, self.kept + len(vectors))
+        self.kept += len(vectors)
+        room = max(0, self.sample_size - len(self.sample_rows))
+        if room:
+            head = vectors[:room]
+            self.sample = head.copy() if self.sample is None else np.concatenate([self.sample, head])
+            self.sample_rows = np.concatenate([self.sample_rows, rows[:room]])
+        # The t-th kept row replaces a random slot with probability sample_size / (t + 1)
+        slots = self._rng.integers(0, seen[room:] + 1) if len(seen) > room else np.zeros(0, dtype=np.int64)
+        for i, slot in zip(np.flatnonzero(slots < self.sample_size) + room, slots[slots < self.sample_size]):
+            self.sample[slot] = vectors[i]
+            self.sample_rows[slot] = rows[i]
+
+    @property
+    def sampled_all(self):
+        """True if the sample holds every row, so assign() needs no second pass."""
+        return len(self.sample_rows) == self.kept
+
+    def partial_fit(self, embeddings):
+        rows, vectors = self._transform(embeddings, self.rows)
+        self.rows += len(embeddings)
+        if not len(vectors):
+            return
+        self._keep_sample(rows, vectors)
+        self._pending.append(vectors)
+        if sum(len(v) for v in self._pending) >= self.n_clusters:
+            self.kmeans.partial_fit(np.concatenate(self._pending))
+            self._pending = []
+            self._fitted = True
+
+    def finish(self, epochs=2):
+        """
+        Fit any buffered rows and run a few more passes over the sample. If
+        the sample holds every row they are assigned right away.
+        """
+        if self._pending and not self._fitted:
+            # Fewer rows than clusters overall
+            self.kmeans.set_params(n_clusters=self.kept)
+            self.n_clusters = self.kept
+        if self._pending:
+            self.kmeans.partial_fit(np.concatenate(self._pending))
+            self._pending = []
+        step = self.kmeans.batch_size
+        for _ in range(epochs):
+            perm = self._rng.permutation(len(self.sample_rows))
+            for start in range(0, len(perm), step):
+                batch = self.sample[perm[start:start + step]]
+                if len(batch) >= self.n_clusters:
+                    self.kmeans.partial_fit(batch)
+        self._reset_assignment()
+        if self.sampled_all and self.kept:
+            order = np.argsort(self.sample_rows)
+            self._assign(self.sample_rows[order], self.sample[order])
+            self.sample = None
+
+    def _assign(self, rows, vectors):
+        centers = normalize_rows(self.kmeans.cluster_centers_.astype(np.float32))
+        sims = vectors @ centers.T
+        labels = np.argmax(sims, axis=1)
+        similarity = sims[np.arange(len(sims)), labels]
+        # Titles whose embedding failed carry no information
+        valid = vectors.any(axis=1)
+        self.sizes += np.bincount(labels[valid], minlength=self.n_clusters)
+        rows = np.concatenate([self._cand_rows, rows[valid]])
+        labels = np.concatenate([self._cand_labels, labels[valid]])
+        similarity = np.concatenate([self._cand_sims, similarity[valid]])
+        keep = select_representatives(similarity, labels, np.full(self.n_clusters, self.candidates))
+        self._cand_rows, self._cand_labels, self._cand_sims = rows[keep], labels[keep], similarity[keep]
+
+    def assign(self, embeddings):
+        """Second pass: assign the next batch of rows (in partial_fit order) to the final centres."""
+        rows, vectors = self._transform(embeddings, self.assigned)
+        self.assigned += len(embeddings)
+        if len(vectors) and self.kept:
+            self._assign(rows, vectors)
+
+    def representatives(self, total):
+        """
+        Row indices of about `total` representatives (at least one per
+        non-empty cluster, at most `candidates` per cluster).
+        """
+        counts = np.minimum(representative_counts(self.sizes, total), self.candidates)
+        return self._cand_rows[select_representatives(self._cand_sims, self._cand_labels, counts)]
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Completion providers used to classify notes (and by generate_taxonomy.py
+to generate taxonomies): the classification prompts and answer parsers,
+and the OpenAI, Gemini and Ollama backends. SDKs are imported on the first
+request, so constructing a provider (or printing --help) stays cheap.
+"""
+import sys
+
+from taxonomy import as_taxonomy, extract_json, answer_tags
+from rate_limit import estimate_tokens
+from ollama_client import OllamaClient, DEFAULT_KEEP_ALIVE
+from instrumentation import stage, api_call, record_usage, record_openai_usage, record_gemini_usage
+
+def build_classification_prompts(text, tags_list):
+    """
+    Build system and user prompts for Obsidian note classification.
+    Returns (system_prompt, user_prompt) for LLM calls.
+    """
+    system_prompt = (
+        "You are a helpful assistant that classifies Obsidian notes into the given tags. "
+        "Only output a JSON array of valid tags."
+    )
+    tag_lines = as_taxonomy(tags_list).tag_lines
+    user_prompt = (
+        f"""以下は Obsidian ノートの本文です。
+タグ一覧:
+{tag_lines}
+
+出力は JSON 配列のみで、例: [\"dev/agents\",\"dev/tools\"]。
+ノート本文:
+{text}
+"""
+    )
+    return system_prompt, user_prompt
+
+def build_packed_classification_prompts(notes, tags_list):
+    """
+    Build prompts classifying several notes at once.
+    `notes` is a list of (note_id, text); the taxonomy is sent only once and
+    the model answers with a JSON object mapping note ID to a tag array.
+    """
+    system_prompt = (
+        "You are a helpful assistant that classifies Obsidian notes into the given tags. "
+        "Only output a JSON object mapping each note ID to a JSON array of valid tags."
+    )
+    tag_lines = as_taxonomy(tags_list).tag_lines
+    note_blocks = '\n\n'.join(f"### ID: {nid}\n{text}" for nid, text in notes)
+    user_prompt = (
+        f"""以下は複数の Obsidian ノートの本文です。各ノートを分類してください。
+タグ一覧:
+{tag_lines}
+
+出力は JSON オブジェクトのみで、キーはノート ID、値はタグの配列です。例: {{\"n1\": [\"dev/agents\"], \"n2\": [\"dev/tools\"]}}。
+ノート:
+{note_blocks}
+"""
+    )
+    return system_prompt, user_prompt
+
+def parse_packed_response(content, note_ids, tags_list):
+    """
+    Parse a packed response into {note_id: tags}. Entries that are missing,
+    not arrays or contain no valid tag are left out so they can be retried
+    individually. Returns None if the response is not a JSON object.
+    """
+    try:
+        data = extract_json(content)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    taxonomy = as_taxonomy(tags_list)
+    results = {}
+    for nid in note_ids:
+        tags = data.get(nid)
+        if isinstance(tags, list):
+            tags = taxonomy.validate(tags)
+            if tags:
+                results[nid] = tags
+    return results
+
+def parse_tags_response(content, tags_list):
+    """
+    Parse a model response that should be a JSON array of tags (or a
+    {"tags": [...]} object from a schema-constrained request). Surrounding
+    prose and code fences are ignored and near-miss tags are repaired.
+    Returns the valid tags, or None if the response is not parseable.
+    """
+    try:
+        tags = answer_tags(extract_json(content))
+    except ValueError:
+        return None
+    return None if tags is None else as_taxonomy(tags_list).validate(tags)
+
+class BaseProvider:
+    """
+    Completion provider. Subclasses implement `complete`, which sends one
+    system/user prompt pair and returns the raw model text (optionally
+    capped at `max_tokens` generated tokens).
+    Providers whose `complete` accepts output constraints set
+    `structured_output`: True to pass a JSON schema of the answer (`schema`),
+    False to only pass a stop sequence ending a single-note answer (`stop`).
+    """
+    structured_output = None
+    # Schemas may forbid extra keys (OpenAI strict mode); Gemini rejects the keyword
+    strict_schema = True
+
+    def complete(self, system_prompt, user_prompt):
+        raise NotImplementedError
+
+    def output_options(self, tags_list, ids=None):
+        """Keyword arguments for `complete` constraining the answer to the taxonomy."""
+        if self.structured_output is None:
+            return {}
+        if self.structured_output:
+            return {'schema': as_taxonomy(tags_list).schema(ids, strict=self.strict_schema)}
+        # The closing bracket ends a tag array; packed answers contain several
+        return {'stop': [']']} if ids is None else {}
+
+    def classify(self, text, tags_list):
+        system_prompt, user_prompt = build_classification_prompts(text, tags_list)
+        content = self.complete(system_prompt, user_prompt, **self.output_options(tags_list)).strip()
+        tags = parse_tags_response(content, tags_list)
+        if tags is None:
+            print(f"Warning: failed to parse JSON response: {content}", file=sys.stderr)
+            return []
+        return tags
+
+    def classify_packed(self, notes, tags_list):
+        """
+        Classify several (note_id, text) pairs in one request.
+        Returns {note_id: tags} for the entries that validated; callers fall
+        back to `classify` for the rest.
+        """
+        system_prompt, user_prompt = build_packed_classification_prompts(notes, tags_list)
+        ids = [nid for nid, _ in notes]
+        content = self.complete(system_prompt, user_prompt, **self.output_options(tags_list, ids)).strip()
+        results = parse_packed_response(content, ids, tags_list)
+        if results is None:
+            print(f"Warning: failed to parse packed JSON response: {content}", file=sys.stderr)
+            return {}
+        return results
+
+# OpenAI reasoning models reject temperature and stop sequences
+REASONING_MODEL_PREFIXES = ('o1', 'o3', 'o4', 'gpt-5')
+
+def is_reasoning_model(model):
+    """True for OpenAI reasoning models (o1, o3, o4-mini, the gpt-5 family and their dated snapshots)."""
+    return model.startswith(REASONING_MODEL_PREFIXES)
+
+class OpenAIProvider(BaseProvider):
+    # Use o4-mini as default model for cost-effective tagging
+    default_model = "o4-mini"
+
+    def __init__(self, api_key, model=None, structured_output=True):
+        self.api_key = api_key
+        self._openai = None
+        self.model = model or self.default_model
+        self.structured_output = structured_output
+
+    @property
+    def openai(self):
+        """The openai module, imported and configured on first use."""
+        if self._openai is None:
+            with stage('import'):
+                import openai
+            openai.api_key = self.api_key
+            self._openai = openai
+        return self._openai
+
+    def complete(self, system_prompt, user_prompt, schema=None, stop=None, max_tokens=None):
+        # Use new OpenAI chat completion API
+        params = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ]
+        }
+        if not is_reasoning_model(self.model):
+            params["temperature"] = 0
+        if schema:
+            params["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "classification", "strict": True, "schema": schema}
+            }
+        if stop and not is_reasoning_model(self.model):
+            params["stop"] = stop
+        if max_tokens:
+            params["max_completion_tokens"] = max_tokens
+
+        with api_call('openai', self.model):
+            resp = self.openai.chat.completions.create(**params)
+        record_openai_usage('openai', self.model, resp)
+        return resp.choices[0].message.content
+
+class GeminiProvider(BaseProvider):
+    # Default to latest Gemini 2.5 Flash preview
+    default_model = "gemini-2.5-flash-preview-05-20"
+
+    strict_schema = False
+
+    def __init__(self, api_key, model=None, structured_output=True):
+        self.api_key = api_key
+        self._genai = None
+        self.model = model or self.default_model
+        self.structured_output = structured_output
+
+    @property
+    def genai(self):
+        """The google.generativeai module, imported and configured on first use."""
+        if self._genai is None:
+            with stage('import'):
+                import google.generativeai as genai
+            genai.configure(api_key=self.api_key)
+            self._genai = genai
+        return self._genai
+
+    def complete(self, system_prompt, user_prompt, schema=None, stop=None, max_tokens=None):
+        config = {"temperature": 0}
+        if max_tokens:
+            config["max_output_tokens"] = max_tokens
+        if schema:
+            config.update(response_mime_type="application/json", response_schema=schema)
+        if stop:
+            config["stop_sequences"] = stop
+        with api_call('gemini', self.model):
+            response = self.genai.GenerativeModel(self.model, system_instruction=system_prompt).generate_content(
+                user_prompt, generation_config=config
+            )
+        content = response.text
+        if not record_gemini_usage('gemini', self.model, response):
+            record_usage('gemini', self.model, prompt=estimate_tokens(system_prompt) + estimate_tokens(user_prompt),
+                         completion=estimate_tokens(content), estimated=True)
+        return content
+
+class OllamaProvider(BaseProvider):
+    def __init__(self, model=None, host=None, keep_alive=DEFAULT_KEEP_ALIVE, pool_size=8, structured_output=True):
+        # Default to latest Llama 4 model
+        self.model = model or "llama4"
+        # Persistent HTTP connections to the local Ollama server
+        self.client = OllamaClient(host, keep_alive=keep_alive, pool_size=pool_size)
+        self.structured_output = structured_output
+
+    def complete(self, system_prompt, user_prompt, schema=None, stop=None, max_tokens=None):
+        options = {"temperature": 0}
+        if stop:
+            options["stop"] = stop
+        if max_tokens:
+            options["num_predict"] = max_tokens
+        # Connection and server errors propagate so the note is retried
+        return self.client.chat(
+            self.model,
+            [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            options=options,
+            format=schema
+        )
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Batching layer for embedding requests.
+Splits long notes into chunks, packs chunks from many notes into requests
+sized to the provider's input-count and token limits, sends the requests
+in parallel and maps the results back to per-note embeddings (chunk
+embeddings are averaged, as before).
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limit import estimate_tokens, call_with_retry
+from similarity import mean_embedding
+
+def split_chunks(text, max_chars=None):
+    """Split text into consecutive chunks of at most max_chars characters."""
+    if not max_chars or len(text) <= max_chars:
+        return [text]
+    return [text[i:i + max_chars] for i in range(0, len(text), max_chars)]
+
+def pack_batches(token_counts, max_inputs, max_tokens=None):
+    """
+    Greedily pack items (given by their token counts) into consecutive
+    batches holding at most max_inputs items and max_tokens tokens.
+    Returns a list of index lists.
+    """
+    batches, current, current_tokens = [], [], 0
+    for i, tokens in enumerate(token_counts):
+        full = len(current) >= max_inputs or (
+            max_tokens and current and current_tokens + tokens > max_tokens
+        )
+        if full:
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+class EmbeddingBatcher:
+    """
+    Embed many texts with as few requests as the provider limits allow.
+    `embed_fn(list_of_texts)` must return one vector per input (an empty
+    list for failures) using a single API request.
+    """
+    def __init__(self, embed_fn, max_inputs, max_tokens=None, max_chars=None,
+                 workers=4, limiter=None, max_retries=5):
+        self.embed_fn = embed_fn
+        self.max_inputs = max_inputs
+        self.max_tokens = max_tokens
+        self.max_chars = max_chars
+        self.workers = workers
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    def _send(self, texts, tokens):
+        def attempt():
+            if self.limiter is not None:
+                self.limiter.acquire(tokens)
+            return self.embed_fn(texts)
+        return call_with_retry(attempt, max_retries=self.max_retries)
+
+    def embed(self, texts):
+        """Return one embedding per text (chunks averaged; [] for failures)."""
+        owners, chunks = [], []
+        for i, text in enumerate(texts):
+            for chunk in split_chunks(text, self.max_chars):
+                owners.append(i)
+                chunks.append(chunk)
+        if not chunks:
+            return []
+        token_counts = [estimate_tokens(c) for c in chunks]
+        batches = pack_batches(token_counts, self.max_inputs, self.max_tokens)
+        jobs = [([chunks[i] for i in b], sum(token_counts[i] for i in b)) for b in batches]
+        if len(jobs) == 1 or self.workers <= 1:
+            results = [self._send(t, n) for t, n in jobs]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(jobs))) as ex:
+                results = list(ex.map(lambda job: self._send(*job), jobs))
+        # Map chunk vectors back to their notes
+        per_text = [[] for _ in texts]
+        for batch, vectors in zip(batches, results):
+            for i, vec in zip(batch, vectors):
+                if vec is not None and len(vec):
+                    per_text[owners[i]].append(vec)
+        out = []
+        for vecs in per_text:
+            if not vecs:
+                out.append([])
+            elif len(vecs) == 1:
+                out.append(vecs[0])
+            else:
+                # average embeddings across chunks
+                out.append(mean_embedding(vecs))
+        return out
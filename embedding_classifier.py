@@ -3,144 +3,192 @@
 Embedding-based classifier: uses OpenAI Embedding API to classify
 Obsidian notes by similarity to tag embeddings.
 """
-import math
-import subprocess
-import json
-import sys
-import openai
+import threading
+from similarity import TagSimilarityIndex, as_matrix
+from embedding_store import EmbeddingStore
+from embedding_batcher import EmbeddingBatcher
+from ollama_client import OllamaClient, DEFAULT_KEEP_ALIVE
+from rate_limit import estimate_tokens
+from instrumentation import api_call, stage, record_usage, record_openai_usage
 
-class OpenAIEmbeddingProvider:
+class BaseEmbeddingProvider:
     """
-    Embedding-based classifier using OpenAI Embedding API.
-    Computes cosine similarity between text embedding and tag embeddings.
+    Shared scoring logic for embedding providers.
+    Subclasses implement `embed_texts`, which embeds a list of inputs in a
+    single API request; the EmbeddingBatcher packs notes, chunks and tags
+    into such requests within the provider limits below. Similarity scoring
+    is done by a vectorized TagSimilarityIndex.
     """
-    def __init__(self, api_key, model=None, top_k=3):
-        openai.api_key = api_key
-        self.openai = openai
-        # Default to next-gen small embedding model for cost efficiency
-        self.model = model or "text-embedding-3-small"
+    # Provider key used by the on-disk embedding store
+    name = None
+    # Per-request limits used to pack embedding batches
+    max_batch_inputs = 1
+    max_batch_tokens = None
+    # Longer inputs are split into chunks whose embeddings are averaged
+    max_input_chars = None
+
+    def __init__(self, model, top_k=3, batch_workers=4):
+        self.model = model
         self.top_k = top_k
+        self.batch_workers = batch_workers
         self.tags_list = None
         self.tag_embeddings = None
+        self.index = None
+        self.store = None
+        # Shared RateLimiter, set when running under --concurrency/--rpm/--tpm
+        self.limiter = None
+        self.max_retries = 5
+        self._tags_lock = threading.Lock()
 
-    def load_tags(self, tags_list):
-        if self.tag_embeddings is not None:
-            return
-        self.tags_list = tags_list
-        # Use new OpenAI embeddings API: embeddings.create
-        resp = self.openai.embeddings.create(
-            model=self.model,
-            input=tags_list
+    def enable_store(self, root, dtype='float16'):
+        """Serve embeddings from (and save them to) an on-disk EmbeddingStore."""
+        self.store = EmbeddingStore(root, self.name, self.model, dtype=dtype)
+        return self.store
+
+    def embed_texts(self, texts):
+        """Embed a list of inputs in one request; [] marks a failed input."""
+        raise NotImplementedError
+
+    def batcher(self):
+        return EmbeddingBatcher(
+            self.embed_texts, self.max_batch_inputs, self.max_batch_tokens,
+            self.max_input_chars, workers=self.batch_workers,
+            limiter=self.limiter, max_retries=self.max_retries,
         )
-        # resp.data is a list of objects with .embedding attribute
-        self.tag_embeddings = [d.embedding for d in resp.data]
+
+    def embed_many(self, texts):
+        """
+        Embed texts in as few batched requests as possible, reading from the
+        embedding store first when one is enabled.
+        """
+        texts = list(texts)
+        embed_fn = self.batcher().embed
+        if self.store is None:
+            return embed_fn(texts)
+        return self.store.lookup(texts, embed_fn)
+
+    def embed_text(self, text):
+        """Return the embedding of one text ([] on failure)."""
+        return self.embed_many([text])[0]
+
+    def load_tags(self, tags_list):
+        # Concurrent classify() calls must embed the taxonomy only once
+        with self._tags_lock:
+            if self.tag_embeddings is not None:
+                return
+            tag_embeddings = self.embed_many(tags_list)
+            self.index = TagSimilarityIndex(tags_list, tag_embeddings)
+            self.tags_list = tags_list
+            self.tag_embeddings = tag_embeddings
 
     def classify(self, text, tags_list):
         self.load_tags(tags_list)
-        # Compute embedding for the note text, chunk if too long
-        def get_emb(chunk_text):
-            resp = self.openai.embeddings.create(model=self.model, input=chunk_text)
-            return resp.data[0].embedding
-        # Approximate char limit to avoid token overflow (<~8192 tokens)
-        # Reduce to 8000 chars to account for Japanese characters (~1 char per token)
-        MAX_CHARS = 8000
-        if len(text) > MAX_CHARS:
-            chunks = [text[i:i+MAX_CHARS] for i in range(0, len(text), MAX_CHARS)]
-            embs = [get_emb(chunk) for chunk in chunks]
-            # average embeddings across chunks
-            dim = len(embs[0])
-            text_emb = [sum(e[i] for e in embs) / len(embs) for i in range(dim)]
-        else:
-            text_emb = get_emb(text)
-        sims = []
-        for tag, tag_emb in zip(self.tags_list, self.tag_embeddings):
-            dot = sum(te * qe for te, qe in zip(text_emb, tag_emb))
-            norm_t = math.sqrt(sum(te * te for te in text_emb))
-            norm_q = math.sqrt(sum(qe * qe for qe in tag_emb))
-            sim = dot / (norm_t * norm_q) if norm_t and norm_q else 0.0
-            sims.append((tag, sim))
-        sims.sort(key=lambda x: x[1], reverse=True)
-        return [tag for tag, _ in sims[:self.top_k]]
-
-class GeminiEmbeddingProvider:
+        text_emb = self.embed_text(text)
+        if text_emb is None or not len(text_emb):
+            return []
+        with stage('similarity'):
+            return self.index.classify(text_emb, self.top_k)
+
+    def classify_batch(self, texts, tags_list):
+        """Classify several notes with batched embedding requests and one matrix product."""
+        self.load_tags(tags_list)
+        if not texts:
+            return []
+        embs = as_matrix(self.embed_many(texts), dim=self.index.dim)
+        with stage('similarity'):
+            results = self.index.classify_batch(embs, self.top_k)
+        # Notes whose embedding failed get no tags, as in classify()
+        return [tags if row.any() else [] for tags, row in zip(results, embs)]
+
+class OpenAIEmbeddingProvider(BaseEmbeddingProvider):
+    """
+    Embedding-based classifier using OpenAI Embedding API.
+    Computes cosine similarity between text embedding and tag embeddings.
+    """
+    name = "openai"
+    # embeddings.create accepts up to 2048 inputs / 300k tokens per request
+    max_batch_inputs = 2048
+    max_batch_tokens = 300000
+    # Approximate char limit to avoid token overflow (<~8192 tokens)
+    # Reduce to 8000 chars to account for Japanese characters (~1 char per token)
+    max_input_chars = 8000
+
+    def __init__(self, api_key, model=None, top_k=3):
+        self.api_key = api_key
+        self._openai = None
+        # Default to next-gen small embedding model for cost efficiency
+        super().__init__(model or "text-embedding-3-small", top_k)
+
+    @property
+    def openai(self):
+        """The openai module, imported and configured on first use."""
+        if self._openai is None:
+            with stage('import'):
+                import openai
+            openai.api_key = self.api_key
+            self._openai = openai
+        return self._openai
+
+    def embed_texts(self, texts):
+        # Use new OpenAI embeddings API: embeddings.create
+        if not texts:
+            return []
+        with api_call(self.name, self.model):
+            resp = self.openai.embeddings.create(model=self.model, input=list(texts))
+        if not record_openai_usage(self.name, self.model, resp, embedding=True):
+            record_usage(self.name, self.model, embedding=sum(estimate_tokens(t) for t in texts), estimated=True)
+        # resp.data is a list of objects with .embedding attribute
+        return [d.embedding for d in resp.data]
+
+class GeminiEmbeddingProvider(BaseEmbeddingProvider):
     """
     Embedding-based classifier using Google Gemini Embedding API.
     """
+    name = "gemini"
+    # batchEmbedContents accepts up to 100 inputs per request
+    max_batch_inputs = 100
+    max_input_chars = 8000
+
     def __init__(self, api_key, model=None, top_k=3):
-        import google.generativeai as genai
-        genai.configure(api_key=api_key)
-        self.genai = genai
+        self.api_key = api_key
+        self._genai = None
         # Default to experimental high-performance embedding
-        self.model = model or "gemini-embedding-exp-03-07"
-        self.top_k = top_k
-        self.tags_list = None
-        self.tag_embeddings = None
+        super().__init__(model or "gemini-embedding-exp-03-07", top_k)
 
-    def load_tags(self, tags_list):
-        if self.tag_embeddings is not None:
-            return
-        self.tags_list = tags_list
-        resp = self.genai.embed_content(self.model, tags_list)
-        self.tag_embeddings = resp['embedding']
+    @property
+    def genai(self):
+        """The google.generativeai module, imported and configured on first use."""
+        if self._genai is None:
+            with stage('import'):
+                import google.generativeai as genai
+            genai.configure(api_key=self.api_key)
+            self._genai = genai
+        return self._genai
 
-    def classify(self, text, tags_list):
-        self.load_tags(tags_list)
-        resp = self.genai.embed_content(self.model, text)
-        text_emb = resp['embedding']
-        sims = []
-        for tag, tag_emb in zip(self.tags_list, self.tag_embeddings):
-            dot = sum(te * qe for te, qe in zip(text_emb, tag_emb))
-            norm_t = math.sqrt(sum(te * te for te in text_emb))
-            norm_q = math.sqrt(sum(qe * qe for qe in tag_emb))
-            sim = dot / (norm_t * norm_q) if norm_t and norm_q else 0.0
-            sims.append((tag, sim))
-        sims.sort(key=lambda x: x[1], reverse=True)
-        return [tag for tag, _ in sims[:self.top_k]]
-
-class OllamaEmbeddingProvider:
+    def embed_texts(self, texts):
+        if not texts:
+            return []
+        with api_call(self.name, self.model):
+            resp = self.genai.embed_content(self.model, list(texts))
+        # embed_content reports no token usage
+        record_usage(self.name, self.model, embedding=sum(estimate_tokens(t) for t in texts), estimated=True)
+        return resp['embedding']
+
+class OllamaEmbeddingProvider(BaseEmbeddingProvider):
     """
     Embedding-based classifier using an Ollama-hosted embedding model.
-    Expects the model to output JSON-formatted embeddings for input content.
+    Talks to the Ollama HTTP API (/api/embed) over persistent connections.
     """
-    def __init__(self, model=None, top_k=3):
-        # Default to high-performance local embedding model
-        self.model = model or "mxbai-embed-large"
-        self.top_k = top_k
-        self.tags_list = None
-        self.tag_embeddings = None
+    name = "ollama"
+    # /api/embed accepts a list of inputs; inputs beyond the model context are truncated
+    max_batch_inputs = 32
 
-    def load_tags(self, tags_list):
-        if self.tag_embeddings is not None:
-            return
-        self.tags_list = tags_list
-        try:
-            result = subprocess.run([
-                "ollama", "run", self.model, "--json"
-            ], input=json.dumps(tags_list), capture_output=True, text=True, check=True)
-            self.tag_embeddings = json.loads(result.stdout)
-        except Exception as e:
-            print(f"Error embedding tags via Ollama: {e}", file=sys.stderr)
-            self.tag_embeddings = [[ ] for _ in tags_list]
+    def __init__(self, model=None, top_k=3, host=None, keep_alive=DEFAULT_KEEP_ALIVE, pool_size=8):
+        # Default to high-performance local embedding model
+        super().__init__(model or "mxbai-embed-large", top_k)
+        self.client = OllamaClient(host, keep_alive=keep_alive, pool_size=pool_size)
 
-    def classify(self, text, tags_list):
-        self.load_tags(tags_list)
-        try:
-            result = subprocess.run([
-                "ollama", "run", self.model, "--json"
-            ], input=json.dumps(text), capture_output=True, text=True, check=True)
-            text_emb = json.loads(result.stdout)
-        except Exception as e:
-            print(f"Error embedding text via Ollama: {e}", file=sys.stderr)
+    def embed_texts(self, texts):
+        if not texts:
             return []
-        sims = []
-        for tag, tag_emb in zip(self.tags_list, self.tag_embeddings):
-            if not tag_emb or not text_emb:
-                sim = 0.0
-            else:
-                dot = sum(te * qe for te, qe in zip(text_emb, tag_emb))
-                norm_t = math.sqrt(sum(te * te for te in text_emb))
-                norm_q = math.sqrt(sum(qe * qe for qe in tag_emb))
-                sim = dot / (norm_t * norm_q) if norm_t and norm_q else 0.0
-            sims.append((tag, sim))
-        sims.sort(key=lambda x: x[1], reverse=True)
-        return [tag for tag, _ in sims[:self.top_k]]
\ No newline at end of file
+        return self.client.embed(self.model, texts)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Persistent on-disk embedding store.
+Embeddings are keyed by (provider, model, content hash) so unchanged tags,
+note bodies and titles are never sent to the embedding API twice.
+
+Layout of one store directory (<root>/<provider>/<model>/):
+  meta.json    - {"dim": ..., "dtype": "float16" | "float32"}
+  vectors.bin  - row-major matrix, memory-mapped for reads, append-only
+  keys.txt     - one content hash per line; line i is row i of vectors.bin
+Both data files are append-only, so an interrupted run can at worst leave
+a partial last row, which is ignored on the next load.
+"""
+import os
+import re
+import json
+import hashlib
+import threading
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'embeddings')
+
+def content_hash(text):
+    """Stable hash of a text used as the store key."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def _safe_name(name):
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', str(name))
+
+class EmbeddingStore:
+    """
+    Memory-mapped embedding cache for a single (provider, model) pair.
+    """
+    def __init__(self, root, provider, model, dtype='float16'):
+        self.path = os.path.join(root, _safe_name(provider), _safe_name(model))
+        os.makedirs(self.path, exist_ok=True)
+        self.meta_path = os.path.join(self.path, 'meta.json')
+        self.vectors_path = os.path.join(self.path, 'vectors.bin')
+        self.keys_path = os.path.join(self.path, 'keys.txt')
+        self.dim = None
+        self.dtype = np.dtype(dtype)
+        self.rows = {}
+        self._count = 0
+        self._mm = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.meta_path):
+            return
+        with open(self.meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.dim = int(meta['dim'])
+        self.dtype = np.dtype(meta['dtype'])
+        keys = []
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, 'r', encoding='utf-8') as f:
+                keys = [line.strip() for line in f]
+        row_bytes = self.dim * self.dtype.itemsize
+        n_vectors = os.path.getsize(self.vectors_path) // row_bytes if os.path.exists(self.vectors_path) else 0
+        # Ignore trailing rows that were only half written by a killed run
+        n = min(len(keys), n_vectors)
+        if len(keys) != n_vectors:
+            self._truncate(n, row_bytes, keys[:n])
+        self.rows = {k: i for i, k in enumerate(keys[:n]) if k}
+        self._count = n
+
+    def _truncate(self, n, row_bytes, keys):
+        with open(self.vectors_path, 'ab') as f:
+            f.truncate(n * row_bytes)
+        with open(self.keys_path, 'w', encoding='utf-8') as f:
+            f.writelines(k + '\n' for k in keys)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, text):
+        return content_hash(text) in self.rows
+
+    def _matrix(self):
+        if self._mm is None and self._count:
+            self._mm = np.memmap(self.vectors_path, dtype=self.dtype, mode='r',
+                                 shape=(self._count, self.dim))
+        return self._mm
+
+    def get_many(self, texts):
+        """Return a list with the cached float32 vector for each text, or None."""
+        with self._lock:
+            mm = self._matrix()
+            out = []
+            for text in texts:
+                row = self.rows.get(content_hash(text))
+                out.append(None if row is None else np.asarray(mm[row], dtype=np.float32))
+            return out
+
+    def put_many(self, texts, vectors):
+        """Append embeddings for texts not already present. Empty vectors are skipped."""
+        with self._lock:
+            new_keys, new_rows = [], []
+            seen = set()
+            for text, vec in zip(texts, vectors):
+                if vec is None or not len(vec):
+                    continue
+                key = content_hash(text)
+                if key in self.rows or key in seen:
+                    continue
+                if self.dim is None:
+                    self.dim = len(vec)
+                    with open(self.meta_path, 'w', encoding='utf-8') as f:
+                        json.dump({'dim': self.dim, 'dtype': self.dtype.name}, f)
+                if len(vec) != self.dim:
+                    continue
+                seen.add(key)
+                new_keys.append(key)
+                new_rows.append(np.asarray(vec, dtype=self.dtype))
+            if not new_keys:
+                return
+            # Vectors first, keys second: a key is only visible once its row exists
+            with open(self.vectors_path, 'ab') as f:
+                f.write(np.stack(new_rows).tobytes())
+            with open(self.keys_path, 'a', encoding='utf-8') as f:
+                f.writelines(k + '\n' for k in new_keys)
+            for key in new_keys:
+                self.rows[key] = self._count
+                self._count += 1
+            self._mm = None
+
+    def lookup(self, texts, embed_fn):
+        """
+        Return embeddings for all texts, calling `embed_fn(missing_texts)` only
+        for texts that are not cached yet and storing its results.
+        """
+        cached = self.get_many(texts)
+        missing = [i for i, vec in enumerate(cached) if vec is None]
+        if missing:
+            # Embed each distinct text once
+            unique = list(dict.fromkeys(texts[i] for i in missing))
+            fresh = dict(zip(unique, embed_fn(unique)))
+            self.put_many(unique, [fresh[t] for t in unique])
+            for i in missing:
+                cached[i] = fresh[texts[i]]
+        return cached
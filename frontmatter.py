@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Frontmatter I/O for Obsidian notes.
+The header is delimited by whole '---' lines, so '---' inside a value does
+not end it. Skip decisions read only the header bytes; YAML is parsed and
+emitted with the libyaml C loader/dumper when PyYAML was built with it.
+Updates patch only the changed keys and keep the rest of the header as
+written, and notes are replaced atomically (temporary file + rename).
+"""
+import os
+import re
+import sys
+import hashlib
+import tempfile
+import yaml
+
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# Bytes read per step while looking for the end of the header
+HEADER_CHUNK_BYTES = 8192
+
+def load_yaml(text):
+    return yaml.load(text, Loader=SafeLoader)
+
+def dump_yaml(data):
+    return yaml.dump(data, Dumper=SafeDumper, allow_unicode=True, sort_keys=False)
+
+class Header:
+    """
+    Frontmatter of a note.
+      text        - YAML between the delimiter lines ('\\n' line endings), or None
+      fm_dict     - parsed frontmatter ({} when missing or unparsable)
+      body_offset - byte offset where the body starts
+      newline     - line ending used by the note
+    """
+    def __init__(self, text, fm_dict, body_offset, newline='\n'):
+        self.text = text
+        self.fm_dict = fm_dict
+        self.body_offset = body_offset
+        self.newline = newline
+
+def _is_delimiter(line, closing=False):
+    line = line.rstrip()
+    return line == b'---' or (closing and line == b'...')
+
+def find_header(data, at_eof=True, resume=0):
+    """
+    Locate the frontmatter in the leading bytes of a note.
+    Returns (text, body_offset, newline), or None when `data` ends before
+    the closing delimiter and more bytes are needed (at_eof=False). A first
+    line of '---' that is never closed is a horizontal rule, not a header.
+    Lines starting before `resume` are known not to close the header and
+    are not scanned again.
+    """
+    end = data.find(b'\n')
+    if end < 0:
+        if not at_eof:
+            return None
+        return None, 0, '\n'
+    newline = '\r\n' if data[:end].endswith(b'\r') else '\n'
+    if not _is_delimiter(data[:end]):
+        return None, 0, newline
+    start = end + 1
+    pos = max(start, resume)
+    while True:
+        end = data.find(b'\n', pos)
+        if end < 0:
+            if not at_eof:
+                return None
+            if not _is_delimiter(data[pos:], closing=True):
+                return None, 0, newline
+            # Closing delimiter on the last line, without a line break
+            return data[start:pos].decode('utf-8').replace('\r\n', '\n'), len(data), newline
+        if _is_delimiter(data[pos:end], closing=True):
+            text = data[start:pos].decode('utf-8').replace('\r\n', '\n')
+            return text, end + 1, newline
+        pos = end + 1
+
+def parse_header(text, path=''):
+    """Parse frontmatter YAML into a dict, warning (and returning {}) on failure."""
+    if not text or not text.strip():
+        return {}
+    try:
+        fm_dict = load_yaml(text)
+    except Exception as e:
+        print(f"Warning: failed to parse YAML in {path}: {e}", file=sys.stderr)
+        return {}
+    if not isinstance(fm_dict, dict):
+        print(f"Warning: frontmatter of {path} is not a mapping", file=sys.stderr)
+        return {}
+    return fm_dict
+
+def read_header(path, data=None):
+    """
+    Read and parse only the frontmatter of a note (or of `data`, its leading bytes).
+    Returns a Header.
+    """
+    if data is None:
+        data = bytearray()
+        resume = 0
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(HEADER_CHUNK_BYTES)
+                data += chunk
+                # Only a completed line can end the header
+                if chunk and b'\n' not in chunk:
+                    continue
+                found = find_header(data, at_eof=not chunk, resume=resume)
+                if found is not None:
+                    break
+                # Resume at the line still being read
+                resume = data.rfind(b'\n') + 1
+    else:
+        found = find_header(data)
+    text, body_offset, newline = found
+    return Header(text, parse_header(text, path), body_offset, newline)
+
+def _key_pattern(key):
+    return re.compile(r'''^(['"]?)%s\1[ \t]*:(?:[ \t]|$)''' % re.escape(key))
+
+def _block_end(lines, i):
+    """Index after the value block of the top-level key on line i."""
+    j = i + 1
+    while j < len(lines):
+        line = lines[j]
+        if line and line[0] not in ' \t' and not (line.startswith('-') and not line.startswith('---')):
+            break
+        j += 1
+    # Leave trailing blank lines in place
+    while j > i + 1 and not lines[j - 1].strip():
+        j -= 1
+    return j
+
+def patch_header(text, fm_dict, updates):
+    """
+    Return header YAML with `updates` applied. Only the lines of the updated
+    top-level keys are replaced (new keys are appended); if the result would
+    not parse back to the expected mapping, the whole header is re-emitted.
+    """
+    expected = dict(fm_dict)
+    expected.update(updates)
+    lines = (text or '').split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+    for key, value in updates.items():
+        block = dump_yaml({key: value}).rstrip('\n').split('\n')
+        pattern = _key_pattern(key)
+        for i, line in enumerate(lines):
+            if pattern.match(line):
+                lines[i:_block_end(lines, i)] = block
+                break
+        else:
+            lines.extend(block)
+    patched = '\n'.join(lines) + '\n'
+    try:
+        ok = load_yaml(patched) == expected
+    except Exception:
+        ok = False
+    return patched if ok else dump_yaml(expected)
+
+def build_header(header, updates):
+    """Encoded frontmatter block (with delimiters) for a Header with `updates` applied."""
+    patched = patch_header(header.text, header.fm_dict, updates)
+    block = f"---\n{patched}---\n"
+    return block.replace('\n', header.newline).encode('utf-8')
+
+def replace_header(path, header_bytes, body_offset, data=None, chunk_size=1024 * 1024):
+    """
+    Atomically replace everything before body_offset with header_bytes.
+    The body is taken from `data` (the full file contents) when given,
+    otherwise streamed from the file. Returns the SHA-256 of the new contents.
+    """
+    digest = hashlib.sha256(header_bytes)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            dst.write(header_bytes)
+            if data is not None:
+                body = memoryview(data)[body_offset:]
+                digest.update(body)
+                dst.write(body)
+            else:
+                with open(path, 'rb') as src:
+                    src.seek(body_offset)
+                    while True:
+                        chunk = src.read(chunk_size)
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+                        dst.write(chunk)
+        os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return digest.hexdigest()
@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 """
 Generate an Obsidian note with Dataview index for notes by taxonomy categories.
+With --static, each section is a pre-sorted table rendered from a persistent
+tag -> notes index instead of a Dataview query, so pages open without
+querying the vault. Only index files whose content changed are rewritten.
 """
 import os
 import sys
 import argparse
 import yaml
 
+from tag_index import TagIndex, default_tag_index_path
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Generate an index note with Dataview blocks for each taxonomy category."
@@ -25,6 +30,22 @@ def parse_args():
         "--output",
         help="Output directory for index files (default: <input-dir>/00_index)."
     )
+    parser.add_argument(
+        "--static",
+        action="store_true",
+        help="Write static tables (sorted by created, newest first) instead of Dataview queries."
+    )
+    parser.add_argument(
+        "--tag-index",
+        help="Tag index state used by --static to re-read only changed notes "
+             "(default: .cache/tagindex_<hash of input dir>.json next to this script)."
+    )
+    parser.add_argument(
+        "--scan-workers",
+        type=int,
+        default=8,
+        help="Threads reading note frontmatter for --static (default: 8)."
+    )
     return parser.parse_args()
 
 def load_taxonomy(path):
@@ -47,56 +68,71 @@ def generate_toc(node, level=0):
                 lines.append(f"{indent}- [[#{item}]]")
     return lines
 
-def render_taxonomy(node, prefix='', level=2, input_folder=None):
+def _cell(text):
+    return text.replace('|', '\\|')
+
+def render_table(notes, input_folder):
+    """Static markdown table of (path, entry) index rows."""
+    if not notes:
+        return ['*No notes*', '']
+    lines = ['| File | Date | Description | Tags |', '| --- | --- | --- | --- |']
+    for path, entry in notes:
+        target = f"{input_folder}/{path[:-3] if path.lower().endswith('.md') else path}"
+        name = os.path.splitext(os.path.basename(path))[0]
+        lines.append(f"| [[{_cell(target)}\\|{_cell(name)}]] | {_cell(entry['created'])} "
+                     f"| {_cell(entry['description'])} | {_cell(', '.join(entry['tags']))} |")
+    lines.append('')
+    return lines
+
+def render_section(name, tag_path, level, input_folder, by_tag=None):
+    lines = [f"{'#' * level} {name}", "[[#Index|↑ Index]]", ""]
+    if by_tag is not None:
+        lines.extend(render_table(by_tag.get(tag_path, []), input_folder))
+        return lines
+    lines.append('```dataview')
+    lines.append('TABLE created as "Date", description as "Description", tags as "Tags"')
+    lines.append(f'FROM "{input_folder}"')
+    lines.append(f'WHERE contains(tags, "{tag_path}")')
+    lines.append('SORT created DESC')
+    lines.append('```\n')
+    return lines
+
+def render_taxonomy(node, prefix='', level=2, input_folder=None, by_tag=None):
     lines = []
     
     if isinstance(node, dict):
         for key, value in node.items():
-            lines.append(f"{'#' * level} {key}")
-            lines.append("[[#Index|↑ Index]]")
-            lines.append("")
             tag_path = f"{prefix}/{key}".lstrip('/')
-            
-            lines.append('```dataview')
-            lines.append('TABLE created as "Date", description as "Description", tags as "Tags"')
-            lines.append(f'FROM "{input_folder}"')
-            lines.append(f'WHERE contains(tags, "{tag_path}")')
-            lines.append('SORT created DESC')
-            lines.append('```\n')
+            lines.extend(render_section(key, tag_path, level, input_folder, by_tag))
 
             if isinstance(value, (dict, list)):
-                lines.extend(render_taxonomy(value, tag_path, level + 1, input_folder))
+                lines.extend(render_taxonomy(value, tag_path, level + 1, input_folder, by_tag))
 
     elif isinstance(node, list):
         for item in node:
             if isinstance(item, dict):
-                 lines.extend(render_taxonomy(item, prefix, level, input_folder))
+                 lines.extend(render_taxonomy(item, prefix, level, input_folder, by_tag))
             else:
-                lines.append(f"{'#' * level} {item}")
-                lines.append("[[#Index|↑ Index]]")
-                lines.append("")
                 tag_path = f"{prefix}/{item}".lstrip('/')
-
-                lines.append('```dataview')
-                lines.append('TABLE created as "Date", description as "Description", tags as "Tags"')
-                lines.append(f'FROM "{input_folder}"')
-                lines.append(f'WHERE contains(tags, "{tag_path}")')
-                lines.append('SORT created DESC')
-                lines.append('```\n')
+                lines.extend(render_section(item, tag_path, level, input_folder, by_tag))
     return lines
 
-def main():
-    args = parse_args()
-    tax = load_taxonomy(args.tags_file)
-    if not tax:
-        sys.exit(f"Empty or invalid taxonomy file: {args.tags_file}")
+def write_if_changed(path, content):
+    """Write content unless the file already holds exactly it. Returns True if written."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            if f.read() == content:
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    return True
 
-    output_dir = args.output or os.path.join(args.input_dir, '00_index')
+def write_index(tax, output_dir, input_folder_name, by_tag=None):
+    """Render one index file per top-level category; returns the number of files rewritten."""
     os.makedirs(output_dir, exist_ok=True)
-    print(f"Index directory set to: {output_dir}")
-
-    input_folder_name = os.path.basename(os.path.normpath(args.input_dir))
-
+    written = 0
     for category, sub_node in tax.items():
         output_path = os.path.join(output_dir, f"{category}.md")
         
@@ -104,13 +140,37 @@ def main():
         toc_header = ["## Index", ""]
         toc_body = generate_toc(sub_node)
         
-        body = render_taxonomy(sub_node, category, 2, input_folder_name)
+        body = render_taxonomy(sub_node, category, 2, input_folder_name, by_tag)
         
         content = '\n'.join(header + toc_header + toc_body + [""] + body)
         
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(content)
-        print(f"Generated index for '{category}' at {output_path}")
+        if write_if_changed(output_path, content):
+            written += 1
+            print(f"Generated index for '{category}' at {output_path}")
+    return written
+
+def main():
+    args = parse_args()
+    tax = load_taxonomy(args.tags_file)
+    if not tax:
+        sys.exit(f"Empty or invalid taxonomy file: {args.tags_file}")
+
+    output_dir = args.output or os.path.join(args.input_dir, '00_index')
+    print(f"Index directory set to: {output_dir}")
+
+    input_folder_name = os.path.basename(os.path.normpath(args.input_dir))
+
+    by_tag = None
+    if args.static:
+        index_path = args.tag_index or default_tag_index_path(args.input_dir)
+        tag_index = TagIndex(index_path, args.input_dir)
+        read = tag_index.refresh(workers=args.scan_workers)
+        tag_index.save()
+        print(f"Tag index: {index_path} ({len(tag_index.entries)} notes, {read} read)")
+        by_tag = tag_index.notes_by_tag()
+
+    written = write_index(tax, output_dir, input_folder_name, by_tag)
+    print(f"{written} of {len(tax)} index files changed")
 
 if __name__ == '__main__':
     main()
@@ -7,11 +7,21 @@ import os
 import sys
 from datetime import date
 import argparse
-import subprocess
-import yaml
-import numpy as np
-from sklearn.cluster import KMeans
-from embedding_classifier import OpenAIEmbeddingProvider, GeminiEmbeddingProvider, OllamaEmbeddingProvider
+from concurrent.futures import ThreadPoolExecutor
+from providers import COMPLETION, EMBEDDING, provider_names, build_completion_provider, build_embedding_provider
+from preprocess import count_tokens
+from rate_limit import DEFAULT_RATE_LIMITS, RateLimiter, call_with_retry, estimate_tokens
+from taxonomy_merge import split_by_tokens, parse_taxonomy, merge_taxonomies, dump_taxonomy, leaf_paths
+from vault_scanner import iter_notes, prefetch
+import instrumentation
+from instrumentation import stage
+
+# Title tokens per taxonomy prompt; larger title lists are generated map-reduce style
+DEFAULT_SHARD_TOKENS = {
+    'openai': 20000,
+    'gemini': 50000,
+    'ollama': 3000,
+}
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -19,7 +29,7 @@ def parse_args():
     )
     parser.add_argument(
         "--provider",
-        choices=["openai", "gemini", "ollama"],
+        choices=provider_names(COMPLETION),
         default="openai",
         help="LLM provider to use for taxonomy generation."
     )
@@ -31,6 +41,10 @@ def parse_args():
         "--api-key",
         help="API key for OpenAI or Google Gemini."
     )
+    parser.add_argument(
+        "--ollama-host",
+        help="Ollama server URL (default: $OLLAMA_HOST or http://localhost:11434)."
+    )
     parser.add_argument(
         "--input-dir",
         required=True,
@@ -59,7 +73,7 @@ def parse_args():
     )
     parser.add_argument(
         "--embed-provider",
-        choices=["openai", "gemini", "ollama"],
+        choices=provider_names(EMBEDDING),
         default="openai",
         help="Embedding provider for summarization (default: openai)."
     )
@@ -67,41 +81,107 @@ def parse_args():
         "--embed-model",
         help="Embedding model identifier for summarization (overrides default)."
     )
+    parser.add_argument(
+        "--embedding-cache",
+        help="Directory of the on-disk embedding store reused across runs "
+             "(default: .cache/embeddings next to this script)."
+    )
+    parser.add_argument(
+        "--no-embedding-cache",
+        action="store_true",
+        help="Always call the embedding API instead of reading cached title embeddings."
+    )
     parser.add_argument(
         "--clusters",
         type=int,
         default=10,
         help="Number of clusters to form for title summarization (default: 10)."
     )
+    parser.add_argument(
+        "--representatives",
+        type=int,
+        help="Total representative titles sent to the LLM, split over clusters by size "
+             "(default: one per cluster)."
+    )
+    parser.add_argument(
+        "--reduce-dim",
+        type=int,
+        default=0,
+        help="Randomly project title embeddings to this many dimensions before clustering "
+             "to bound memory on large vaults (default: 0 = keep full dimensions)."
+    )
+    parser.add_argument(
+        "--cluster-batch-size",
+        type=int,
+        default=2048,
+        help="Titles embedded and clustered per streamed batch (default: 2048)."
+    )
+    parser.add_argument(
+        "--cluster-sample-size",
+        type=int,
+        default=8192,
+        help="Title embeddings kept in memory for refining the clusters; larger vaults are embedded "
+             "(or read from the embedding cache) a second time to pick representatives (default: 8192)."
+    )
+    parser.add_argument(
+        "--shard-tokens",
+        type=int,
+        help="Maximum title tokens per prompt; longer title lists are split into shards whose "
+             "partial taxonomies are merged (default depends on provider)."
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Number of shard requests sent in parallel (default: 4)."
+    )
+    parser.add_argument(
+        "--max-output-tokens",
+        type=int,
+        default=2048,
+        help="Maximum tokens generated per request (default: 2048)."
+    )
+    parser.add_argument(
+        "--report",
+        help="Write a JSON run report (stage timings, provider latency, tokens, estimated cost) to this file."
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        help="Write run metrics in Prometheus text format to this file."
+    )
+    parser.add_argument(
+        "--profile",
+        help="Profile the main thread with cProfile and write the stats to this file."
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Trace memory allocations (tracemalloc) and add peak usage to the report."
+    )
     return parser.parse_args()
 
-def collect_titles(input_dir):
-    """Collect first-line titles (or filenames) from markdown files."""
-    titles = []
-    for root, _, files in os.walk(input_dir):
-        for fn in files:
-            # Skip hidden files and dotfiles
-            if fn.startswith('.'):
-                continue
-            if fn.lower().endswith('.md'):
-                path = os.path.join(root, fn)
-                # Extract first meaningful line (skip YAML frontmatter '---')
-                title = ''
-                try:
-                    with open(path, 'r', encoding='utf-8') as f:
-                        for line in f:
-                            text = line.strip()
-                            if not text or text.startswith('---'):
-                                continue
-                            title = text.lstrip('# ').strip()
-                            break
-                except Exception:
-                    title = ''
-                # Fallback to filename without extension
-                if not title:
-                    title = os.path.splitext(fn)[0]
-                titles.append(title)
-    return titles
+def read_title(path):
+    """First meaningful line of a note (skipping YAML frontmatter '---'), or its filename."""
+    title = ''
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                text = line.strip()
+                if not text or text.startswith('---'):
+                    continue
+                title = text.lstrip('# ').strip()
+                break
+    except Exception:
+        title = ''
+    # Fallback to filename without extension
+    if not title:
+        title = os.path.splitext(os.path.basename(path))[0]
+    return title
+
+def collect_titles(input_dir, workers=8):
+    """Collect first-line titles (or filenames) from markdown files, reading them in parallel."""
+    paths = (path for path, _ in iter_notes(input_dir))
+    return [title for _, title in prefetch(paths, read_title, workers)]
 
 def build_prompt(titles_list, depth):
     """Build system and user prompts for taxonomy generation with max depth."""
@@ -119,102 +199,169 @@ def build_prompt(titles_list, depth):
     )
     return system_prompt, user_prompt
 
+def build_reduce_prompt(taxonomy_yaml, depth):
+    """Build prompts asking the model to consolidate merged partial taxonomies."""
+    system_prompt = (
+        f"あなたは優れたAIタクソノミー設計者です。ノートの一部ずつから作成した部分タクソノミーを"
+        f"統合したYAMLを、最大{depth}階層の日本語カテゴリ/サブカテゴリ階層に整理してください。"
+        "不要な説明やタイトルは含めず、YAMLマッピングのみを返してください。"
+    )
+    user_prompt = (
+        f"統合前のタクソノミー:\n{taxonomy_yaml}\n"
+        "同じ意味・重複するカテゴリは1つにまとめ、適切な親カテゴリの下へ移動してください。"
+        "既存のカテゴリが表す分野は削除しないでください。"
+        "出力はYAMLマッピングのみで、カテゴリごとにサブカテゴリのリストを示してください。"
+    )
+    return system_prompt, user_prompt
+
+def build_completion(args):
+    """
+    Return complete(system_prompt, user_prompt) for the selected provider.
+    Calls share one rate limiter and retry transient errors, so they can
+    be issued from several threads.
+    """
+    max_tokens = args.max_output_tokens
+    provider = build_completion_provider(args.provider, args.model, args.api_key, ollama_host=args.ollama_host,
+                                         pool_size=max(8, args.concurrency))
+
+    def request(system_prompt, user_prompt):
+        return provider.complete(system_prompt, user_prompt, max_tokens=max_tokens)
+
+    limits = DEFAULT_RATE_LIMITS.get(args.provider, {})
+    limiter = RateLimiter(limits.get('rpm'), limits.get('tpm'))
+
+    def complete(system_prompt, user_prompt):
+        limiter.acquire(estimate_tokens(system_prompt) + estimate_tokens(user_prompt) + max_tokens)
+        return call_with_retry(request, system_prompt, user_prompt)
+    return complete
+
+def map_parallel(fn, items, concurrency):
+    """[fn(item)] computed on a thread pool; a call that raises yields the exception."""
+    def safe(item):
+        try:
+            return fn(item)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        return list(executor.map(safe, items))
+
+def reduce_taxonomy(tree, complete, depth):
+    """Consolidate a merged tree with one model call, keeping the local merge if the reply is unusable."""
+    system_prompt, user_prompt = build_reduce_prompt(dump_taxonomy(tree), depth)
+    try:
+        with stage('reduce'):
+            reply = complete(system_prompt, user_prompt)
+        return merge_taxonomies([parse_taxonomy(reply, depth)], depth)
+    except Exception as e:
+        print(f"Warning: reduction failed ({e}); keeping the locally merged taxonomy", file=sys.stderr)
+        return tree
+
+def generate_map_reduce(shards, complete, args):
+    """
+    Generate one partial taxonomy per shard in parallel, then merge them:
+    locally (duplicate categories unified) and with reduction calls, in
+    rounds of token-bounded groups until one group fits a single prompt.
+    """
+    def generate(shard):
+        with stage('map'):
+            return parse_taxonomy(complete(*build_prompt(shard, args.depth)), args.depth)
+
+    trees = []
+    for i, result in enumerate(map_parallel(generate, shards, args.concurrency), 1):
+        if isinstance(result, Exception):
+            print(f"Warning: shard {i}/{len(shards)} failed: {result}", file=sys.stderr)
+        else:
+            trees.append(result)
+    if not trees:
+        sys.exit('Error: no shard produced a valid taxonomy.')
+    print(f"Generated {len(trees)} partial taxonomies; merging.")
+
+    def size(tree):
+        return count_tokens(dump_taxonomy(tree), args.model)
+
+    def reduce_group(group):
+        return reduce_taxonomy(merge_taxonomies(group, args.depth), complete, args.depth)
+
+    groups = split_by_tokens(trees, args.shard_tokens, size)
+    while 1 < len(groups) < len(trees):
+        trees = map_parallel(reduce_group, groups, args.concurrency)
+        groups = split_by_tokens(trees, args.shard_tokens, size)
+    return reduce_group(trees)
+
 def main():
     args = parse_args()
-    titles = collect_titles(args.input_dir)
+    instrumentation.configure('generate_taxonomy', report=args.report, textfile=args.metrics_textfile,
+                              profile=args.profile, trace_memory=args.trace_memory)
+    with stage('collect_titles'):
+        titles = collect_titles(args.input_dir)
     if not titles:
         sys.exit("No markdown files found in input directory.")
     # Optionally summarize titles via embedding clustering
     if args.use_embedding:
-        # Initialize embedding provider
-        if args.embed_provider == 'openai':
-            emb = OpenAIEmbeddingProvider(args.api_key or os.getenv('OPENAI_API_KEY'), args.embed_model)
-        elif args.embed_provider == 'gemini':
-            emb = GeminiEmbeddingProvider(args.api_key or os.getenv('GOOGLE_API_KEY'), args.embed_model)
-        else:
-            emb = OllamaEmbeddingProvider(args.embed_model)
-        # Embed titles
-        emb.load_tags(titles)
-        embs = np.array(emb.tag_embeddings)
-        # Cluster embeddings
+        from clustering import StreamingClusterer
+        emb = build_embedding_provider(args.embed_provider, args.embed_model, args.api_key,
+                                       ollama_host=args.ollama_host, cache=not args.no_embedding_cache,
+                                       cache_dir=args.embedding_cache)
+        # Embed titles batch by batch (cached titles are read from the embedding store)
+        # and cluster them incrementally
         n_clusters = min(args.clusters, len(titles))
+        total = args.representatives or n_clusters
+        clusterer = StreamingClusterer(n_clusters, reduce_dim=args.reduce_dim, batch_size=args.cluster_batch_size,
+                                       sample_size=args.cluster_sample_size, candidates=total)
+        step = max(1, args.cluster_batch_size)
         try:
-            kmeans = KMeans(n_clusters=n_clusters, random_state=0)
-            labels = kmeans.fit_predict(embs)
+            for start in range(0, len(titles), step):
+                with stage('embed'):
+                    embs = emb.embed_many(titles[start:start + step])
+                with stage('cluster'):
+                    clusterer.partial_fit(embs)
+            with stage('cluster'):
+                clusterer.finish()
+            # Titles beyond the in-memory sample are assigned to the final clusters in a second pass
+            if not clusterer.sampled_all:
+                for start in range(0, len(titles), step):
+                    with stage('embed'):
+                        embs = emb.embed_many(titles[start:start + step])
+                    with stage('cluster'):
+                        clusterer.assign(embs)
+            # Representative titles closest to each centroid, more for larger clusters
+            rep_idx = clusterer.representatives(total)
         except Exception as e:
             sys.exit(f"Error during clustering: {e}")
-        # Select representative title per cluster (closest to centroid)
-        rep_titles = []
-        for ci in range(n_clusters):
-            idxs = [i for i, lbl in enumerate(labels) if lbl == ci]
-            if not idxs:
-                continue
-            centroid = kmeans.cluster_centers_[ci]
-            # find index with minimal distance to centroid
-            dists = [np.linalg.norm(embs[i] - centroid) for i in idxs]
-            rep_idx = idxs[int(np.argmin(dists))]
-            rep_titles.append(titles[rep_idx])
+        rep_titles = [titles[i] for i in rep_idx]
         print(f"Summarized {len(titles)} titles into {len(rep_titles)} representatives.")
         titles = rep_titles
-    # Build prompts for taxonomy generation
-    system_prompt, user_prompt = build_prompt(titles, args.depth)
-
-    taxonomy = None
-    if args.provider == 'openai':
-        try:
-            import openai
-        except ImportError:
-            sys.exit("Error: openai package required for provider=openai.")
-        openai.api_key = args.api_key or os.getenv('OPENAI_API_KEY')
-        if not openai.api_key:
-            sys.exit('Error: OPENAI_API_KEY is not set.')
-        # Default to cost-effective o4-mini model
-        model = args.model or 'o4-mini'
-        # Use new OpenAI chat completion API
-        resp = openai.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0,
-            max_tokens=2048
-        )
-        taxonomy = resp.choices[0].message.content
-    elif args.provider == 'gemini':
-        try:
-            import google.generativeai as genai
-        except ImportError:
-            sys.exit("Error: google-generativeai package required for provider=gemini.")
-        key = args.api_key or os.getenv('GOOGLE_API_KEY')
-        if not key:
-            sys.exit('Error: GOOGLE_API_KEY is not set.')
-        genai.configure(api_key=key)
-        model = args.model or 'gemini-2.5-flash-preview-05-20'
-        resp = genai.chat.completions.create(
-            model=model,
-            messages=[
-                {"author": "system", "content": system_prompt},
-                {"author": "user", "content": user_prompt}
-            ],
-            temperature=0,
-            max_output_tokens=2048
-        )
-        taxonomy = resp.choices[0].message.content
+    if args.shard_tokens is None:
+        args.shard_tokens = DEFAULT_SHARD_TOKENS[args.provider]
+    complete = build_completion(args)
+    shards = split_by_tokens(titles, args.shard_tokens, lambda t: count_tokens(f"- {t}\n", args.model))
+    if len(shards) > 1:
+        print(f"Splitting {len(titles)} titles into {len(shards)} shards of up to {args.shard_tokens} tokens.")
+        tree = generate_map_reduce(shards, complete, args)
     else:
-        model = args.model or 'llama4'
-        full_prompt = system_prompt + "\n" + user_prompt
+        # Build prompts for taxonomy generation
+        system_prompt, user_prompt = build_prompt(titles, args.depth)
+        try:
+            with stage('generate'):
+                reply = complete(system_prompt, user_prompt)
+        except Exception as e:
+            sys.exit(f"Error generating taxonomy: {e}")
+        if not reply:
+            sys.exit('Error: received empty taxonomy from LLM.')
         try:
-            result = subprocess.run(
-                ["ollama", "run", model, "--prompt", full_prompt],
-                capture_output=True, check=True, text=True
-            )
-            taxonomy = result.stdout
-        except subprocess.CalledProcessError as e:
-            sys.exit(f"Error running ollama: {e}")
+            tree = merge_taxonomies([parse_taxonomy(reply, args.depth)], args.depth)
+        except ValueError as e:
+            sys.exit(f"Error: LLM output is not a usable taxonomy ({e}):\n{reply}")
 
-    if not taxonomy:
-        sys.exit('Error: received empty taxonomy from LLM.')
+    taxonomy = dump_taxonomy(tree)
+    # Validate what will be written: it must parse back to the same tags
+    try:
+        valid = leaf_paths(parse_taxonomy(taxonomy, args.depth)) == leaf_paths(tree)
+    except ValueError:
+        valid = False
+    if not valid:
+        sys.exit(f"Error: generated taxonomy failed validation:\n{taxonomy}")
 
     if args.dry_run:
         print(taxonomy)
@@ -227,7 +374,7 @@ def main():
         # Write taxonomy to file
         with open(output_path, 'w', encoding='utf-8') as f:
             f.write(taxonomy)
-        print(f"Generated taxonomy saved to {output_path}")
+        print(f"Generated taxonomy ({len(leaf_paths(tree))} tags) saved to {output_path}")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Hierarchical two-stage (or deeper) classification over the tag tree.
+Instead of presenting every leaf tag at once, the classifier first picks
+top-level categories, then only looks at the children of the chosen
+branches, keeping at most `beam_width` branches per level.
+"""
+import threading
+import yaml
+import numpy as np
+
+from similarity import TagSimilarityIndex, normalize_rows, top_k_indices
+
+class TagTree:
+    """
+    Tag taxonomy as a tree of '/'-joined paths.
+    `children[path]` lists the child paths of a node ('' is the root);
+    leaves are the flattened tags produced by load_tags_file.
+    """
+    def __init__(self):
+        self.children = {'': []}
+        self.leaves = []
+
+    def _add(self, parent, path, leaf):
+        if path not in self.children and path not in self.leaves:
+            self.children[parent].append(path)
+        if leaf:
+            if path not in self.leaves:
+                self.leaves.append(path)
+        else:
+            self.children.setdefault(path, [])
+
+    @classmethod
+    def from_data(cls, data):
+        """Build the tree from parsed tags.yml data (same layouts as load_tags_file)."""
+        tree = cls()
+        def recurse(node, prefix=""):
+            if isinstance(node, dict):
+                for key, value in node.items():
+                    path = f"{prefix}/{key}" if prefix else str(key)
+                    tree._add(prefix, path, leaf=False)
+                    recurse(value, path)
+            elif isinstance(node, list):
+                for item in node:
+                    recurse(item, prefix)
+            elif isinstance(node, str):
+                tree._add(prefix, f"{prefix}/{node}" if prefix else node, leaf=True)
+        recurse(data)
+        # Categories without any tag below them are not selectable
+        empty = [p for p, kids in tree.children.items() if p and not kids]
+        while empty:
+            path = empty.pop()
+            del tree.children[path]
+            parent = path.rsplit('/', 1)[0] if '/' in path else ''
+            tree.children[parent].remove(path)
+            if parent and not tree.children[parent]:
+                empty.append(parent)
+        return tree
+
+    def is_leaf(self, path):
+        return path not in self.children
+
+    def nodes(self):
+        """All node paths except the root, parents before children."""
+        out = []
+        stack = list(reversed(self.children['']))
+        while stack:
+            path = stack.pop()
+            out.append(path)
+            stack.extend(reversed(self.children.get(path, [])))
+        return out
+
+    def depth(self):
+        return max((p.count('/') + 1 for p in self.leaves), default=0)
+
+def load_tags_tree(path):
+    """Load tags.yml keeping its tree structure."""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = yaml.safe_load(f)
+    tree = TagTree.from_data(data)
+    if not tree.leaves:
+        raise ValueError(f"Invalid tags file format: {path}")
+    return tree
+
+class HierarchicalClassifier:
+    """
+    Wrap a completion or embedding provider to walk the tag tree level by level.
+    Completion providers are prompted only with the children of the chosen
+    branches; embedding providers score only those children.
+    Other attributes (model, store, ...) are passed through.
+    """
+    def __init__(self, provider, tree, beam_width=2, top_k=3):
+        self.provider = provider
+        self.tree = tree
+        self.beam_width = beam_width
+        self.top_k = getattr(provider, 'top_k', top_k)
+        self.is_embedding = hasattr(provider, 'embed_many')
+        self.node_index = None
+        self.node_rows = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
+
+    # Completion providers
+
+    def _classify_completion(self, text):
+        frontier = self.tree.children['']
+        chosen_leaves = []
+        while frontier:
+            picked = self.provider.classify(text, frontier)
+            branches = []
+            for path in picked:
+                if self.tree.is_leaf(path):
+                    if path not in chosen_leaves:
+                        chosen_leaves.append(path)
+                elif len(branches) < self.beam_width:
+                    branches.append(path)
+            frontier = [c for b in branches for c in self.tree.children[b]]
+        return chosen_leaves
+
+    # Embedding providers
+
+    def load_tags(self, tags_list=None):
+        """Embed every node path once (leaf embeddings are shared with flat mode)."""
+        with self._lock:
+            if self.node_index is not None:
+                return
+            nodes = self.tree.nodes()
+            self.node_index = TagSimilarityIndex(nodes, self.provider.embed_many(nodes))
+            self.node_rows = {path: i for i, path in enumerate(nodes)}
+
+    def _walk(self, qvec):
+        """Beam search over the tree for one normalized query vector."""
+        frontier = self.tree.children['']
+        candidates = {}
+        while frontier:
+            rows = [self.node_rows[p] for p in frontier]
+            scores = self.node_index.matrix[rows] @ qvec
+            branches = []
+            for j in top_k_indices(scores, len(frontier)):
+                path = frontier[j]
+                if self.tree.is_leaf(path):
+                    candidates[path] = float(scores[j])
+                elif len(branches) < self.beam_width:
+                    branches.append(path)
+            frontier = [c for b in branches for c in self.tree.children[b]]
+        ranked = sorted(candidates.items(), key=lambda x: x[1], reverse=True)
+        return [tag for tag, _ in ranked[:self.top_k]]
+
+    def _classify_vectors(self, vectors):
+        results = []
+        for vec in vectors:
+            if vec is None or not len(vec) or len(vec) != self.node_index.dim:
+                results.append([])
+                continue
+            qvec = normalize_rows(np.asarray(vec, dtype=np.float32))[0]
+            results.append(self._walk(qvec) if qvec.any() else [])
+        return results
+
+    def classify(self, text, tags_list):
+        if not self.is_embedding:
+            return self._classify_completion(text)
+        self.load_tags()
+        return self._classify_vectors(self.provider.embed_many([text]))[0]
+
+    def classify_batch(self, texts, tags_list):
+        if not self.is_embedding:
+            return [self._classify_completion(t) for t in texts]
+        self.load_tags()
+        return self._classify_vectors(self.provider.embed_many(texts))
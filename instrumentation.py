@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+Run instrumentation shared by tag_refiner.py, generate_taxonomy.py and the
+provider modules. Records per-stage timers and event counters, per-provider
+request latency histograms and errors, and token usage (taken from the API
+usage fields, or estimated where a provider reports none) with an estimated
+cost. configure() optionally enables cProfile / tracemalloc and writes a
+JSON run report and a Prometheus textfile (node_exporter textfile collector)
+when the run ends. Recording is cheap and always on; nothing is written
+unless an output is configured.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import contextlib
+from bisect import bisect_left
+from collections import defaultdict
+
+# Histogram bucket upper bounds in seconds (Prometheus `le` labels)
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Estimated USD per 1M tokens: (input, output). Local models cost nothing;
+# models missing here are reported as unpriced.
+PRICES = {
+    'o4-mini': (1.10, 4.40),
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4.1': (2.00, 8.00),
+    'gpt-4.1-mini': (0.40, 1.60),
+    'text-embedding-3-small': (0.02, 0.0),
+    'text-embedding-3-large': (0.13, 0.0),
+    'gemini-2.5-flash-preview-05-20': (0.15, 0.60),
+    'gemini-1.5-pro': (1.25, 5.00),
+}
+FREE_PROVIDERS = ('ollama',)
+
+class Histogram:
+    """Cumulative-bucket latency histogram with sum, count and max."""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Quantile estimated by linear interpolation inside its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                low = BUCKETS[i - 1] if i else 0.0
+                high = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(low + (high - low) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_s': round(self.sum, 6),
+            'mean_ms': round(1000 * self.sum / self.count, 3) if self.count else None,
+            'max_ms': round(1000 * self.max, 3),
+            'p50_ms': _ms(self.quantile(0.5)),
+            'p95_ms': _ms(self.quantile(0.95)),
+            'p99_ms': _ms(self.quantile(0.99)),
+        }
+
+def _ms(seconds):
+    return None if seconds is None else round(1000 * seconds, 3)
+
+class Metrics:
+    """Thread-safe store of everything recorded during one run."""
+    def __init__(self, script=None):
+        self.script = script or os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+        self.started = time.time()
+        self.stages = defaultdict(Histogram)
+        self.counters = defaultdict(int)
+        self.requests = defaultdict(Histogram)
+        self.errors = defaultdict(int)
+        # (provider, model, kind, source) -> tokens; kind is prompt/completion/embedding
+        self.tokens = defaultdict(int)
+        self.memory = None
+        self.profile = None
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self.stages[stage].observe(seconds)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed_iter(self, name, iterable):
+        """Yield from iterable, timing the production of each item under `name`."""
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.observe(name, time.perf_counter() - start)
+            yield item
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def set_count(self, name, value):
+        with self._lock:
+            self.counters[name] = value
+
+    @contextlib.contextmanager
+    def api_call(self, provider, model):
+        """Time one provider request; failed requests are counted as errors."""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            with self._lock:
+                self.errors[(provider, model)] += 1
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.requests[(provider, model)].observe(seconds)
+
+    def record_usage(self, provider, model, prompt=0, completion=0, embedding=0, estimated=False):
+        source = 'estimate' if estimated else 'usage'
+        with self._lock:
+            for kind, n in (('prompt', prompt), ('completion', completion), ('embedding', embedding)):
+                if n:
+                    self.tokens[(provider, model, kind, source)] += int(n)
+
+    def costs(self):
+        """({(provider, model): usd}, [unpriced (provider, model)]) from recorded tokens."""
+        totals = defaultdict(lambda: {'input': 0, 'output': 0})
+        for (provider, model, kind, _), n in list(self.tokens.items()):
+            totals[(provider, model)]['output' if kind == 'completion' else 'input'] += n
+        costs, unpriced = {}, []
+        for (provider, model), t in totals.items():
+            if provider in FREE_PROVIDERS:
+                costs[(provider, model)] = 0.0
+            elif model in PRICES:
+                price_in, price_out = PRICES[model]
+                costs[(provider, model)] = (t['input'] * price_in + t['output'] * price_out) / 1e6
+            else:
+                unpriced.append((provider, model))
+        return costs, unpriced
+
+    def report(self):
+        """JSON-serializable run report."""
+        costs, unpriced = self.costs()
+        providers = {}
+        for (provider, model), hist in list(self.requests.items()):
+            providers[f"{provider}/{model}"] = dict(hist.to_dict(), errors=self.errors.get((provider, model), 0))
+        tokens = defaultdict(dict)
+        for (provider, model, kind, source), n in sorted(self.tokens.items()):
+            key = kind if source == 'usage' else f"{kind}_estimated"
+            tokens[f"{provider}/{model}"][key] = n
+        for (provider, model), usd in costs.items():
+            providers.setdefault(f"{provider}/{model}", {})['cost_usd'] = round(usd, 6)
+        return {
+            'script': self.script,
+            'argv': sys.argv[1:],
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'duration_s': round(time.time() - self.started, 3),
+            'stages': {name: hist.to_dict() for name, hist in sorted(self.stages.items())},
+            'counters': dict(sorted(self.counters.items())),
+            'providers': providers,
+            'tokens': dict(tokens),
+            'estimated_cost_usd': round(sum(costs.values()), 6),
+            'unpriced_models': [f"{p}/{m}" for p, m in unpriced],
+            'memory': self.memory,
+            'profile': self.profile,
+        }
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format."""
+        script = _label(self.script)
+        lines = []
+
+        def histogram(name, help_text, items):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, hist in items:
+                cumulative = 0
+                for bound, n in zip(BUCKETS + ('+Inf',), hist.counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {hist.sum:.6f}")
+                lines.append(f"{name}_count{{{labels}}} {hist.count}")
+
+        def simple(name, kind, help_text, items):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in items:
+                lines.append(f"{name}{{{labels}}} {value}")
+
+        histogram('tag_refiner_stage_seconds', 'Time spent per stage.',
+                  [(f'script="{script}",stage="{_label(s)}"', h) for s, h in sorted(self.stages.items())])
+        histogram('tag_refiner_api_request_seconds', 'Provider request latency.',
+                  [(f'script="{script}",provider="{_label(p)}",model="{_label(m)}"', h)
+                   for (p, m), h in sorted(self.requests.items())])
+        simple('tag_refiner_api_errors_total', 'counter', 'Failed provider requests.',
+               [(f'script="{script}",provider="{_label(p)}",model="{_label(m)}"', n)
+                for (p, m), n in sorted(self.errors.items())])
+        simple('tag_refiner_tokens_total', 'counter', 'Tokens used (source="estimate" where the API reports none).',
+               [(f'script="{script}",provider="{_label(p)}",model="{_label(m)}",kind="{k}",source="{s}"', n)
+                for (p, m, k, s), n in sorted(self.tokens.items())])
+        costs, _ = self.costs()
+        simple('tag_refiner_estimated_cost_usd', 'gauge', 'Estimated API cost of the run.',
+               [(f'script="{script}",provider="{_label(p)}",model="{_label(m)}"', f"{usd:.6f}")
+                for (p, m), usd in sorted(costs.items())])
+        simple('tag_refiner_events_total', 'counter', 'Event counters (notes tagged, skipped, failed, ...).',
+               [(f'script="{script}",event="{_label(n)}"', v) for n, v in sorted(self.counters.items())])
+        simple('tag_refiner_run_duration_seconds', 'gauge', 'Wall time of the run so far.',
+               [(f'script="{script}"', f"{time.time() - self.started:.3f}")])
+        simple('tag_refiner_last_report_timestamp_seconds', 'gauge', 'When this file was written.',
+               [(f'script="{script}"', f"{time.time():.3f}")])
+        return '\n'.join(lines) + '\n'
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+METRICS = Metrics()
+
+def stage(name):
+    return METRICS.stage(name)
+
+def timed_iter(name, iterable):
+    return METRICS.timed_iter(name, iterable)
+
+def count(name, n=1):
+    METRICS.count(name, n)
+
+def set_count(name, value):
+    METRICS.set_count(name, value)
+
+def api_call(provider, model):
+    return METRICS.api_call(provider, model)
+
+def record_usage(provider, model, prompt=0, completion=0, embedding=0, estimated=False):
+    METRICS.record_usage(provider, model, prompt, completion, embedding, estimated)
+
+def record_openai_usage(provider, model, resp, embedding=False):
+    """Record the `usage` field of an OpenAI-compatible response."""
+    usage = getattr(resp, 'usage', None)
+    if usage is None:
+        return False
+    if embedding:
+        record_usage(provider, model, embedding=getattr(usage, 'prompt_tokens', 0) or 0)
+    else:
+        record_usage(provider, model, prompt=getattr(usage, 'prompt_tokens', 0) or 0,
+                     completion=getattr(usage, 'completion_tokens', 0) or 0)
+    return True
+
+def record_gemini_usage(provider, model, resp):
+    """Record the `usage_metadata` of a Gemini generate_content response."""
+    usage = getattr(resp, 'usage_metadata', None)
+    if usage is None:
+        return False
+    record_usage(provider, model, prompt=getattr(usage, 'prompt_token_count', 0) or 0,
+                 completion=getattr(usage, 'candidates_token_count', 0) or 0)
+    return True
+
+_outputs = {'report': None, 'textfile': None, 'profile': None}
+_profiler = None
+_lock = threading.Lock()
+
+def configure(script, report=None, textfile=None, profile=None, trace_memory=False):
+    """
+    Name the run and choose its outputs: a JSON report path, a Prometheus
+    textfile path, a cProfile stats path (main thread only) and whether to
+    trace memory allocations. Outputs are written by write_reports() and
+    when the process exits.
+    """
+    global _profiler
+    METRICS.script = script
+    _outputs['report'] = report
+    _outputs['textfile'] = textfile
+    _outputs['profile'] = profile
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start(25)
+    if profile:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    if report or textfile or profile or trace_memory:
+        atexit.register(finish)
+
+def _atomic_write(path, text):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def write_reports():
+    """Write the configured JSON report and Prometheus textfile (e.g. after each watch batch)."""
+    with _lock:
+        try:
+            if _outputs['report']:
+                _atomic_write(_outputs['report'], json.dumps(METRICS.report(), ensure_ascii=False, indent=2))
+            if _outputs['textfile']:
+                _atomic_write(_outputs['textfile'], METRICS.prometheus())
+        except OSError as e:
+            print(f"Warning: cannot write run report: {e}", file=sys.stderr)
+
+def finish():
+    """Stop profiling / memory tracing, record their results and write the reports."""
+    global _profiler
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_outputs['profile'])
+        METRICS.profile = _outputs['profile']
+        _profiler = None
+        print(f"Profile written to {_outputs['profile']} (python -m pstats {_outputs['profile']})")
+    import tracemalloc
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+        tracemalloc.stop()
+        METRICS.memory = {
+            'current_mb': round(current / 1e6, 2),
+            'peak_mb': round(peak / 1e6, 2),
+            'top': [{'where': str(stat.traceback), 'size_kb': round(stat.size / 1e3, 1), 'count': stat.count}
+                    for stat in top],
+        }
+    write_reports()
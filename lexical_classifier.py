@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Local lexical classifier trained on the vault's own confirmed notes
+(tags with 'tag_revision_needed: false'); no network or LLM is used.
+Notes become hashed character n-gram TF-IDF vectors (character n-grams
+need no word segmentation, so Japanese text works as is), and one logistic
+regression per tag (one-vs-rest) is trained with mini-batch SGD on the
+sparse vectors. Per-tag probability thresholds are tuned for F1 on notes
+scored before the model was trained on them: a held-out share when a model
+is first trained, and every new note on incremental updates. Notes no tag
+is confident about get no tags (and are marked for revision).
+"""
+import os
+import re
+import json
+import hashlib
+import unicodedata
+import numpy as np
+
+DEFAULT_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'lexical')
+
+_MULT = np.uint64(1000003)
+_MASK = np.uint64(0xFFFFFFFF)
+_MIX = np.uint64(0x9E3779B1)
+
+def default_model_dir(input_dir):
+    """Model directory for one vault."""
+    key = hashlib.sha1(os.path.abspath(input_dir).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(DEFAULT_MODEL_DIR, key)
+
+def normalize_text(text):
+    """NFKC, casefolded text with punctuation and formatting runs collapsed to single spaces."""
+    return re.sub(r'[\W_]+', ' ', unicodedata.normalize('NFKC', text).casefold()).strip()
+
+def ngram_buckets(norm, ngram_range, n_features):
+    """Feature buckets (with repeats) of the character n-grams of a normalized text."""
+    codes = np.frombuffer(norm.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    low, high = ngram_range
+    parts = []
+    h = codes
+    # Rolling hashes: the n-gram hashes extend the (n-1)-gram ones by one character
+    for n in range(1, high + 1):
+        if n > 1:
+            if len(h) < 2:
+                break
+            h = (h[:-1] * _MULT + codes[n - 1:]) & _MASK
+        if n >= low:
+            parts.append((h * _MIX + np.uint64(n)) & _MASK)
+    if not parts:
+        return np.zeros(0, dtype=np.int64)
+    return (np.concatenate(parts) % np.uint64(n_features)).astype(np.int64)
+
+def _f1_cut(scores, labels, positives):
+    """Score cutoff maximizing F1 when everything at or above it is accepted."""
+    order = np.argsort(-scores, kind='stable')
+    ranked = scores[order]
+    f1 = 2 * np.cumsum(labels[order]) / (np.arange(1, len(scores) + 1) + positives)
+    best = int(np.argmax(f1))
+    # The lowest accepted score is a tight bound on a small sample; leave a margin below it
+    return float((ranked[best] + ranked[best + 1]) / 2 if best + 1 < len(ranked) else ranked[best])
+
+def tune_thresholds(scores, labels, default=0.5, min_positive=3):
+    """
+    Per-tag probability threshold maximizing F1 over (scores, labels) rows,
+    placed midway to the next lower score and never below the tag's base
+    rate in `labels`, so a tag is only given to notes the model rates more
+    likely than an average note. Tags with fewer than `min_positive`
+    positives share the threshold maximizing F1 over all tags (`default`
+    when there are too few rows for that).
+    """
+    thresholds = np.full(scores.shape[1], default, dtype=np.float32)
+    if int(labels.sum()) >= min_positive:
+        thresholds[:] = _f1_cut(scores.ravel(), labels.ravel(), int(labels.sum()))
+    for t in range(scores.shape[1]):
+        positives = int(labels[:, t].sum())
+        if positives >= min_positive:
+            thresholds[t] = max(positives / len(labels), _f1_cut(scores[:, t], labels[:, t], positives))
+    return thresholds
+
+class LexicalModel:
+    """
+    Hashed character n-gram TF-IDF features and one-vs-rest logistic
+    regressions. `weights` is (n_features x tags); `df` and `n_docs` are the
+    document frequencies the IDF is computed from. `trained` maps note keys
+    to the version (e.g. stat data) of the note last trained on, so update()
+    only learns from new or changed notes: a new model trains until an
+    epoch improves its log loss by less than `tol` (at most `epochs`),
+    later updates for `update_epochs`, with a step size that decays over
+    the model's lifetime so a few new notes do not overwrite what it learned.
+    Scores of notes taken before the model trained on them (the latest
+    `max_calibration`) tune the thresholds.
+    """
+    def __init__(self, n_features=2 ** 18, ngram_range=(2, 4), max_chars=20000, epochs=50, update_epochs=1,
+                 tol=0.05, batch_size=32, learning_rate=1.0, decay=0.01, alpha=1e-5, top_k=3, max_calibration=5000, seed=0):
+        self.n_features = n_features
+        self.ngram_range = tuple(ngram_range)
+        self.max_chars = max_chars
+        self.epochs = epochs
+        self.update_epochs = update_epochs
+        self.tol = tol
+        self.batch_size = batch_size
+        self.learning_rate = learning_rate
+        self.decay = decay
+        self.alpha = alpha
+        self.top_k = top_k
+        self.max_calibration = max_calibration
+        self.seed = seed
+        self.tags = []
+        self.tag_rows = {}
+        self.weights = np.zeros((n_features, 0), dtype=np.float32)
+        self.bias = np.zeros(0, dtype=np.float32)
+        self.thresholds = np.zeros(0, dtype=np.float32)
+        self.df = np.zeros(n_features, dtype=np.int32)
+        self.n_docs = 0
+        self.steps = 0
+        self.trained = {}
+        self.calib_scores = np.zeros((0, 0), dtype=np.float32)
+        self.calib_labels = np.zeros((0, 0), dtype=bool)
+        self.dirty = False
+
+    def _add_tags(self, tags):
+        new = [t for t in dict.fromkeys(tags) if t not in self.tag_rows]
+        if not new:
+            return
+        for tag in new:
+            self.tag_rows[tag] = len(self.tags)
+            self.tags.append(tag)
+        n = len(new)
+        self.weights = np.hstack([self.weights, np.zeros((self.n_features, n), dtype=np.float32)])
+        self.bias = np.concatenate([self.bias, np.zeros(n, dtype=np.float32)])
+        self.thresholds = np.concatenate([self.thresholds, np.full(n, 0.5, dtype=np.float32)])
+        self.calib_scores = np.hstack([self.calib_scores, np.zeros((len(self.calib_scores), n), dtype=np.float32)])
+        self.calib_labels = np.hstack([self.calib_labels, np.zeros((len(self.calib_labels), n), dtype=bool)])
+
+    def term_counts(self, text):
+        """(bucket indices, counts) of a text's character n-grams."""
+        buckets = ngram_buckets(normalize_text(text[:self.max_chars]), self.ngram_range, self.n_features)
+        return np.unique(buckets, return_counts=True)
+
+    def _vectors(self, counts):
+        """L2-normalized sublinear TF-IDF (indices, values) per term-count pair."""
+        idf = np.log((1.0 + self.n_docs) / (1.0 + self.df.astype(np.float32))) + 1.0
+        vectors = []
+        for idx, tf in counts:
+            values = ((1.0 + np.log(tf)) * idf[idx]).astype(np.float32)
+            norm = float(np.sqrt(values @ values))
+            vectors.append((idx, values / norm if norm else values))
+        return vectors
+
+    def _design(self, vectors):
+        """Dense rows over the batch's distinct buckets: (buckets, X)."""
+        lengths = [len(idx) for idx, _ in vectors]
+        if not sum(lengths):
+            return np.zeros(0, dtype=np.int64), np.zeros((len(vectors), 0), dtype=np.float32)
+        cols, inverse = np.unique(np.concatenate([idx for idx, _ in vectors]), return_inverse=True)
+        X = np.zeros((len(vectors), len(cols)), dtype=np.float32)
+        X[np.repeat(np.arange(len(vectors)), lengths), inverse] = np.concatenate([v for _, v in vectors])
+        return cols, X
+
+    def _proba(self, vectors):
+        scores = np.zeros((len(vectors), len(self.tags)), dtype=np.float32)
+        for start in range(0, len(vectors), self.batch_size):
+            cols, X = self._design(vectors[start:start + self.batch_size])
+            z = X @ self.weights[cols] + self.bias
+            scores[start:start + len(X)] = 1.0 / (1.0 + np.exp(-z))
+        return scores
+
+    def _sgd(self, vectors, Y, rng):
+        """One pass over the examples in shuffled minibatches; returns their mean log loss."""
+        order = rng.permutation(len(vectors))
+        loss = 0.0
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            cols, X = self._design([vectors[i] for i in batch])
+            W = self.weights[cols]
+            p = 1.0 / (1.0 + np.exp(-(X @ W + self.bias)))
+            y = Y[batch]
+            loss -= float(np.sum(y * np.log(p + 1e-7) + (1 - y) * np.log(1 - p + 1e-7)))
+            grad = p - y
+            # The step size decays over the model's lifetime so later updates refine it
+            rate = self.learning_rate / np.sqrt(1.0 + self.decay * self.steps)
+            # Each n-gram's gradient is averaged over the notes containing it, not the whole
+            # batch, so rare n-grams learn as fast as common ones
+            present = np.maximum((X > 0).sum(axis=0), 1)[:, None]
+            # L2 decay is applied lazily to the rows this batch touches
+            W -= rate * (X.T @ grad / present + self.alpha * W)
+            self.weights[cols] = W
+            self.bias -= rate * grad.mean(axis=0)
+            self.steps += 1
+        return loss / max(1, Y.size)
+
+    def _fit(self, vectors, Y, rng, max_epochs):
+        """Train for up to `max_epochs`, stopping once an epoch improves the loss by less than `tol`."""
+        previous = np.inf
+        for _ in range(max_epochs):
+            loss = self._sgd(vectors, Y, rng)
+            if previous - loss < self.tol * previous:
+                break
+            previous = loss
+
+    def update(self, examples):
+        """
+        Learn from (key, version, text, tags) examples whose key was not yet
+        trained at this version. Returns the number of notes learned from.
+        """
+        new = [e for e in examples if e[0] not in self.trained or self.trained[e[0]] != e[1]]
+        if not new:
+            return 0
+        self._add_tags(t for _, _, _, tags in new for t in tags)
+        counts = [self.term_counts(text) for _, _, text, _ in new]
+        for idx, _ in counts:
+            self.df[idx] += 1
+        self.n_docs += len(new)
+        vectors = self._vectors(counts)
+        Y = np.zeros((len(new), len(self.tags)), dtype=np.float32)
+        for i, (_, _, _, tags) in enumerate(new):
+            Y[i, [self.tag_rows[t] for t in tags]] = 1.0
+        rng = np.random.default_rng(self.seed + len(self.trained))
+        epochs = self.update_epochs if self.trained else self.epochs
+        if self.trained:
+            # Progressive validation: every new note is scored before it is learned
+            scored = np.arange(len(new))
+        else:
+            # A new model holds out every fifth note (by key) for threshold tuning
+            holdout = [int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % 5 == 0 for key, _, _, _ in new]
+            scored = np.flatnonzero(holdout) if len(new) >= 50 else np.zeros(0, dtype=np.int64)
+            rest = np.setdiff1d(np.arange(len(new)), scored)
+            self._fit([vectors[i] for i in rest], Y[rest], rng, epochs)
+        if len(scored):
+            self.calib_scores = np.vstack([self.calib_scores, self._proba([vectors[i] for i in scored])])
+            self.calib_labels = np.vstack([self.calib_labels, Y[scored] > 0])
+            self.calib_scores = self.calib_scores[-self.max_calibration:]
+            self.calib_labels = self.calib_labels[-self.max_calibration:]
+            self.thresholds = tune_thresholds(self.calib_scores, self.calib_labels)
+            self._fit([vectors[i] for i in scored], Y[scored], rng, epochs)
+        for key, version, _, _ in new:
+            self.trained[key] = version
+        self.dirty = True
+        return len(new)
+
+    def predict(self, texts, tags_list=None):
+        """
+        Tags per text whose probability reaches the tag's threshold (at most
+        `top_k`, most probable first), limited to `tags_list`; None where no
+        tag qualifies.
+        """
+        if not texts:
+            return []
+        if not self.tags:
+            return [None] * len(texts)
+        scores = self._proba(self._vectors([self.term_counts(t) for t in texts]))
+        allowed = np.ones(len(self.tags), dtype=bool)
+        if tags_list is not None:
+            valid = set(tags_list)
+            allowed = np.array([t in valid for t in self.tags])
+        passing = (scores >= self.thresholds) & allowed
+        results = []
+        for row, ok in zip(scores, passing):
+            hits = np.flatnonzero(ok)
+            hits = hits[np.argsort(-row[hits], kind='stable')][:self.top_k]
+            results.append([self.tags[i] for i in hits] or None)
+        return results
+
+    def save(self, directory):
+        if not self.dirty:
+            return
+        os.makedirs(directory, exist_ok=True)
+        arrays = {'weights': self.weights, 'bias': self.bias, 'thresholds': self.thresholds, 'df': self.df,
+                  'calib_scores': self.calib_scores, 'calib_labels': self.calib_labels}
+        tmp = os.path.join(directory, 'model.tmp.npz')
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, os.path.join(directory, 'model.npz'))
+        meta = {
+            'n_features': self.n_features, 'ngram_range': list(self.ngram_range), 'max_chars': self.max_chars,
+            'n_docs': self.n_docs, 'steps': self.steps, 'tags': self.tags, 'trained': self.trained,
+        }
+        tmp = os.path.join(directory, 'model.json.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(directory, 'model.json'))
+        self.dirty = False
+
+    @classmethod
+    def load(cls, directory, **kwargs):
+        """Saved model in `directory`, or a new untrained one if there is none."""
+        meta_path = os.path.join(directory, 'model.json')
+        arrays_path = os.path.join(directory, 'model.npz')
+        if not (os.path.exists(meta_path) and os.path.exists(arrays_path)):
+            return cls(**kwargs)
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        kwargs.update(n_features=meta['n_features'], ngram_range=meta['ngram_range'], max_chars=meta['max_chars'])
+        model = cls(**kwargs)
+        with np.load(arrays_path) as arrays:
+            for name in ('weights', 'bias', 'thresholds', 'df', 'calib_scores', 'calib_labels'):
+                setattr(model, name, arrays[name])
+        model.n_docs = meta['n_docs']
+        model.steps = meta['steps']
+        model.tags = meta['tags']
+        model.tag_rows = {t: i for i, t in enumerate(model.tags)}
+        model.trained = meta['trained']
+        return model
+
+class LexicalProvider:
+    """
+    Classification provider backed by a LexicalModel saved in `path`.
+    Notes without a confident tag get no tags, like a failed API answer.
+    """
+    name = 'lexical'
+    model = 'lexical'
+
+    def __init__(self, classifier, path=None):
+        self.classifier = classifier
+        self.path = path
+
+    def load_tags(self, tags_list):
+        """Nothing to prepare; tags outside `tags_list` are filtered per call."""
+
+    def classify(self, text, tags_list):
+        return self.classify_batch([text], tags_list)[0]
+
+    def classify_batch(self, texts, tags_list):
+        return [tags or [] for tags in self.classifier.predict(texts, tags_list)]
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Near-duplicate detection for clipped notes.
+Each tagged note is fingerprinted by its source URL (tracking parameters
+stripped), a hash of its normalized text and a MinHash signature over
+character shingles. DuplicateIndex keeps the fingerprints with the note's
+tags; MinHash signatures are bucketed by LSH bands (sorted per band and
+searched with a binary search), so a lookup only compares the few notes
+sharing a band instead of the whole vault. DuplicateFinder lets a note
+that duplicates an already-tagged one inherit its tags without a provider call.
+"""
+import os
+import re
+import json
+import hashlib
+import threading
+import unicodedata
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import numpy as np
+
+from embedding_store import content_hash
+
+DEFAULT_DUPLICATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'duplicates')
+
+# Frontmatter keys holding the clipped page's URL (Obsidian Web Clipper writes `source`)
+SOURCE_KEYS = ('source', 'url', 'source_url', 'link')
+TRACKING_PARAMS = {'fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'igshid', 'mc_cid', 'mc_eid',
+                   'ref', 'ref_src', 'ref_url', 'spm', 'si', '_ga'}
+
+SHINGLE_SIZE = 5
+# Texts with fewer shingles are only matched by URL or exact text hash
+MIN_SHINGLES = 16
+_PRIME = np.uint64((1 << 31) - 1)
+_EMPTY = np.uint32(0xFFFFFFFF)
+
+def default_duplicate_dir(input_dir):
+    """Duplicate index directory for one vault."""
+    key = hashlib.sha1(os.path.abspath(input_dir).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(DEFAULT_DUPLICATE_DIR, key)
+
+def normalize_text(text):
+    """Text reduced to its casefolded word characters (formatting and punctuation dropped)."""
+    return re.sub(r'[\W_]+', '', unicodedata.normalize('NFKC', text).casefold())
+
+def normalize_url(url):
+    """
+    Canonical form of a page URL: scheme, `www.`, fragment, trailing slash
+    and tracking parameters dropped, remaining parameters sorted.
+    Returns None for anything that is not an http(s) URL.
+    """
+    if not isinstance(url, str):
+        return None
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return None
+    if parts.scheme.lower() not in ('http', 'https') or not parts.hostname:
+        return None
+    host = parts.hostname.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if port and port not in (80, 443):
+        host = f"{host}:{port}"
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if not k.lower().startswith('utm_') and k.lower() not in TRACKING_PARAMS)
+    url = host + (parts.path.rstrip('/') or '/')
+    return f"{url}?{urlencode(query)}" if query else url
+
+def note_source(fm_dict):
+    """Normalized source URL from a note's frontmatter, or None."""
+    for key in SOURCE_KEYS:
+        value = fm_dict.get(key)
+        if isinstance(value, list):
+            value = next((v for v in value if isinstance(v, str)), None)
+        url = normalize_url(value)
+        if url:
+            return url
+    return None
+
+def shingle_hashes(norm, size=SHINGLE_SIZE):
+    """Distinct 32-bit hashes of the character `size`-grams of a normalized text."""
+    if len(norm) < size:
+        return np.zeros(0, dtype=np.uint64)
+    codes = np.frombuffer(norm.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    m = len(codes) - size + 1
+    h = np.zeros(m, dtype=np.uint64)
+    for j in range(size):
+        h = (h * np.uint64(1000003) + codes[j:j + m]) & np.uint64(0xFFFFFFFF)
+    return np.unique(h)
+
+class Fingerprint:
+    """Source URL, normalized text hash and MinHash signature (None for short texts) of a note."""
+    __slots__ = ('source', 'digest', 'signature')
+
+    def __init__(self, source, digest, signature):
+        self.source = source
+        self.digest = digest
+        self.signature = signature
+
+class DuplicateIndex:
+    """
+    Incrementally updatable near-duplicate index over note fingerprints.
+    Keys are vault-relative note paths; re-adding a key replaces its entry.
+    The per-band sorted arrays cover the rows present when they were last
+    built; rows added or changed since then are looked up in `_tail`.
+    Outdated band entries of changed rows only yield candidates that fail
+    the signature comparison.
+    """
+    def __init__(self, num_perm=128, bands=16, seed=1):
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+        self.num_perm = num_perm
+        self.bands = bands
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, int(_PRIME), size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, int(_PRIME), size=num_perm, dtype=np.uint64)
+        self.keys = []
+        self.tags = []
+        self.sources = []
+        self.digests = []
+        self.rows = {}
+        self._by_source = {}
+        self._by_digest = {}
+        self._signatures = np.zeros((0, num_perm), dtype=np.uint32)
+        self._band_keys = np.zeros((0, bands), dtype=np.uint64)
+        self._count = 0
+        self._sorted_keys = None
+        self._sorted_rows = None
+        self._tail = {}
+        self._lock = threading.RLock()
+        self.dirty = False
+
+    def __len__(self):
+        return self._count
+
+    def fingerprint(self, text, source=None):
+        norm = normalize_text(text)
+        digest = hashlib.blake2b(norm.encode('utf-8'), digest_size=8).hexdigest() if norm else None
+        shingles = shingle_hashes(norm)
+        signature = self.signature(shingles) if len(shingles) >= MIN_SHINGLES else None
+        return Fingerprint(source, digest, signature)
+
+    def signature(self, shingles):
+        """MinHash signature: the minimum of num_perm universal hashes over the shingles."""
+        x = shingles % _PRIME
+        sig = np.full(self.num_perm, _PRIME, dtype=np.uint64)
+        # Chunked so long notes do not build a huge num_perm x shingles matrix
+        for start in range(0, len(x), 4096):
+            chunk = x[start:start + 4096]
+            values = (self._a[:, None] * chunk[None, :] + self._b[:, None]) % _PRIME
+            np.minimum(sig, values.min(axis=1), out=sig)
+        return sig.astype(np.uint32)
+
+    def _bands_of(self, signature):
+        """One 64-bit key per LSH band (FNV-style fold of the band's rows)."""
+        rows = signature.reshape(self.bands, -1).astype(np.uint64)
+        keys = np.full(self.bands, 0xCBF29CE484222325, dtype=np.uint64)
+        for col in rows.T:
+            keys = (keys ^ col) * np.uint64(0x100000001B3)
+        return keys
+
+    def _grow(self, n):
+        if n <= self._signatures.shape[0]:
+            return
+        capacity = max(n, 2 * self._signatures.shape[0], 1024)
+        for name in ('_signatures', '_band_keys'):
+            old = getattr(self, name)
+            grown = np.zeros((capacity, old.shape[1]), dtype=old.dtype)
+            grown[:self._count] = old[:self._count]
+            setattr(self, name, grown)
+
+    def _unlink(self, row):
+        """Drop a row from the URL and text hash tables before it is replaced."""
+        for table, value in ((self._by_source, self.sources[row]), (self._by_digest, self.digests[row])):
+            if value is not None and table.get(value) == row:
+                del table[value]
+
+    def add(self, key, fp, tags):
+        """Add or replace the entry for a note."""
+        with self._lock:
+            row = self.rows.get(key)
+            if row is None:
+                row = self._count
+                self._grow(row + 1)
+                self.keys.append(key)
+                self.tags.append(list(tags))
+                self.sources.append(None)
+                self.digests.append(None)
+                self.rows[key] = row
+                self._count += 1
+            else:
+                self._unlink(row)
+                self.tags[row] = list(tags)
+            self.sources[row] = fp.source
+            self.digests[row] = fp.digest
+            if fp.source:
+                self._by_source[fp.source] = row
+            if fp.digest:
+                self._by_digest[fp.digest] = row
+            if fp.signature is None:
+                self._signatures[row] = _EMPTY
+            else:
+                self._signatures[row] = fp.signature
+                self._band_keys[row] = self._bands_of(fp.signature)
+                for band, band_key in enumerate(self._band_keys[row].tolist()):
+                    self._tail.setdefault((band, band_key), []).append(row)
+            self.dirty = True
+            if len(self._tail) > max(4096, self._count // 4 * self.bands):
+                self.build()
+
+    def build(self):
+        """Sort the band keys of all signed rows so lookups are binary searches."""
+        with self._lock:
+            signed = np.flatnonzero(self._signatures[:self._count, 0] != _EMPTY)
+            keys = self._band_keys[signed].T
+            order = np.argsort(keys, axis=1, kind='stable')
+            self._sorted_keys = np.take_along_axis(keys, order, axis=1)
+            self._sorted_rows = signed[order]
+            self._tail = {}
+
+    def candidates(self, signature):
+        """Rows sharing at least one LSH band with the signature."""
+        found = []
+        for band, band_key in enumerate(self._bands_of(signature).tolist()):
+            if self._sorted_keys is not None:
+                keys = self._sorted_keys[band]
+                lo = np.searchsorted(keys, np.uint64(band_key), side='left')
+                hi = np.searchsorted(keys, np.uint64(band_key), side='right')
+                found.extend(self._sorted_rows[band, lo:hi].tolist())
+            found.extend(self._tail.get((band, band_key), ()))
+        return set(found)
+
+    def find(self, fp, threshold=0.8, exclude=None):
+        """
+        Best already-indexed duplicate of a fingerprint as (key, tags, how, similarity),
+        `how` being 'source', 'exact' or 'minhash'; None when nothing is close enough.
+        The entry stored under `exclude` (the note itself) is ignored.
+        """
+        with self._lock:
+            skip = self.rows.get(exclude)
+            for how, table, value in (('source', self._by_source, fp.source),
+                                      ('exact', self._by_digest, fp.digest)):
+                row = table.get(value) if value else None
+                if row is not None and row != skip:
+                    return self.keys[row], self.tags[row], how, 1.0
+            if fp.signature is None:
+                return None
+            rows = self.candidates(fp.signature)
+            rows.discard(skip)
+            if not rows:
+                return None
+            rows = np.fromiter(rows, dtype=np.intp, count=len(rows))
+            similarity = (self._signatures[rows] == fp.signature).mean(axis=1)
+            best = int(np.argmax(similarity))
+            if similarity[best] < threshold:
+                return None
+            row = int(rows[best])
+            return self.keys[row], self.tags[row], 'minhash', float(similarity[best])
+
+    def save(self, directory):
+        with self._lock:
+            if not self.dirty:
+                return
+            os.makedirs(directory, exist_ok=True)
+            tmp = os.path.join(directory, 'signatures.tmp.npy')
+            np.save(tmp, self._signatures[:self._count])
+            os.replace(tmp, os.path.join(directory, 'signatures.npy'))
+            meta = {'num_perm': self.num_perm, 'bands': self.bands, 'keys': self.keys,
+                    'tags': self.tags, 'sources': self.sources, 'digests': self.digests}
+            tmp = os.path.join(directory, 'notes.json.tmp')
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(tmp, os.path.join(directory, 'notes.json'))
+            self.dirty = False
+
+    @classmethod
+    def load(cls, directory, **kwargs):
+        notes_path = os.path.join(directory, 'notes.json')
+        signatures_path = os.path.join(directory, 'signatures.npy')
+        if not (os.path.exists(notes_path) and os.path.exists(signatures_path)):
+            return cls(**kwargs)
+        with open(notes_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        kwargs.update(num_perm=meta['num_perm'], bands=meta['bands'])
+        index = cls(**kwargs)
+        signatures = np.load(signatures_path)
+        n = min(len(meta['keys']), len(signatures))
+        index._grow(n)
+        index._signatures[:n] = signatures[:n]
+        index._count = n
+        index.keys = meta['keys'][:n]
+        index.tags = meta['tags'][:n]
+        index.sources = meta['sources'][:n]
+        index.digests = meta['digests'][:n]
+        index.rows = {k: i for i, k in enumerate(index.keys)}
+        for row in range(n):
+            if index.sources[row]:
+                index._by_source[index.sources[row]] = row
+            if index.digests[row]:
+                index._by_digest[index.digests[row]] = row
+            if index._signatures[row, 0] != _EMPTY:
+                index._band_keys[row] = index._bands_of(index._signatures[row])
+        index.build()
+        return index
+
+class DuplicateFinder:
+    """
+    First pipeline stage: a note whose fingerprint matches an already-tagged
+    note inherits that note's tags (those still in the taxonomy). `stats`
+    counts notes resolved here and notes passed on to classification.
+    """
+    stage = 'duplicate'
+
+    def __init__(self, index, root, threshold=0.8):
+        self.index = index
+        self.root = root
+        self.threshold = threshold
+        self.stats = {self.stage: 0, 'escalated': 0}
+        self._recent = {}
+        self._lock = threading.Lock()
+
+    def key(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def lookup(self, path, text, fm_dict, tags_list):
+        """Tags inherited from a duplicate of the note, or None."""
+        fp = self.index.fingerprint(text, note_source(fm_dict))
+        with self._lock:
+            # Kept until the note is written (see note_tagged)
+            self._recent[content_hash(text)] = fp
+            if len(self._recent) > 4096:
+                del self._recent[next(iter(self._recent))]
+        match = self.index.find(fp, self.threshold, exclude=self.key(path))
+        tags = [t for t in match[1] if t in tags_list] if match else None
+        with self._lock:
+            self.stats[self.stage if tags else 'escalated'] += 1
+        if tags:
+            key, _, how, similarity = match
+            print(f"Duplicate of {key} ({how}, {similarity:.2f}): reusing tags for {path}")
+        return tags or None
+
+    def note_tagged(self, path, text, tags, fm_dict=None):
+        """Add a freshly written note to the index."""
+        with self._lock:
+            fp = self._recent.pop(content_hash(text), None)
+        if fp is None:
+            fp = self.index.fingerprint(text, note_source(fm_dict or {}))
+        self.index.add(self.key(path), fp, tags)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Nearest-neighbour label propagation from already-tagged notes.
+NeighborIndex stores one normalized embedding per classified note together
+with its tags. Small vaults are searched exactly; once the index grows past
+`ivf_threshold` notes an IVF (inverted file) index of spherical k-means
+lists is trained and only the `nprobe` closest lists are scanned.
+KNNProvider tags a new note by a similarity-weighted vote of its nearest
+labelled neighbours and escalates to a real provider when the vote is
+not confident.
+"""
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+from similarity import normalize_rows, top_k_indices
+from embedding_store import content_hash
+from cascade import GatedProvider
+
+DEFAULT_INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'neighbors')
+
+def default_index_dir(input_dir, provider, model):
+    """Index directory for one vault and embedding model."""
+    key = f"{os.path.abspath(input_dir)}\n{provider}\n{model}"
+    return os.path.join(DEFAULT_INDEX_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest()[:12])
+
+class NeighborIndex:
+    """
+    Incrementally updatable kNN index over note embeddings.
+    Keys are vault-relative note paths; re-adding a key replaces its entry.
+    """
+    def __init__(self, dim=None, ivf_threshold=20000, nprobe=8):
+        self.dim = dim
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        self.keys = []
+        self.tags = []
+        self.rows = {}
+        self._vectors = np.zeros((0, dim or 0), dtype=np.float32)
+        self._count = 0
+        self.centroids = None
+        self._trained_at = 0
+        # IVF layout: vectors copied contiguously per list at training time;
+        # rows added or changed since then are scanned exactly from `_tail`,
+        # and the outdated list copies of changed rows are skipped (`_stale`)
+        self._list_vectors = None
+        self._list_rows = None
+        self._offsets = None
+        self._tail = {}
+        self._stale = set()
+        self._lock = threading.RLock()
+        self.dirty = False
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def vectors(self):
+        return self._vectors[:self._count]
+
+    def _grow(self, n):
+        if n <= self._vectors.shape[0]:
+            return
+        capacity = max(n, 2 * self._vectors.shape[0], 1024)
+        grown = np.zeros((capacity, self.dim), dtype=np.float32)
+        grown[:self._count] = self._vectors[:self._count]
+        self._vectors = grown
+
+    def add(self, key, vector, tags):
+        """Add or replace the entry for a note."""
+        vec = np.asarray(vector, dtype=np.float32)
+        if not vec.size or not vec.any():
+            return
+        with self._lock:
+            if self.dim is None:
+                self.dim = vec.shape[0]
+                self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+            if vec.shape[0] != self.dim:
+                return
+            vec = normalize_rows(vec)[0]
+            row = self.rows.get(key)
+            if row is None:
+                row = self._count
+                self._grow(row + 1)
+                self.keys.append(key)
+                self.tags.append(list(tags))
+                self.rows[key] = row
+                self._count += 1
+            else:
+                self.tags[row] = list(tags)
+            self._vectors[row] = vec
+            if self.centroids is not None:
+                if row < self._trained_at:
+                    self._stale.add(row)
+                self._tail[row] = None
+            self.dirty = True
+            # (Re)train the IVF lists once the index has grown or changed enough
+            if self._count >= self.ivf_threshold and (self._count >= 2 * self._trained_at
+                                                     or len(self._tail) > self._trained_at // 4):
+                self.train()
+
+    def train(self, iterations=10, seed=0):
+        """Train IVF centroids with spherical k-means on a sample of the vectors."""
+        with self._lock:
+            n = self._count
+            nlist = max(1, int(np.sqrt(n)))
+            rng = np.random.default_rng(seed)
+            vectors = self.vectors
+            sample = vectors[rng.choice(n, size=min(n, 64 * nlist), replace=False)]
+            centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+            for _ in range(iterations):
+                labels = np.argmax(sample @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, labels, sample)
+                filled = np.bincount(labels, minlength=nlist) > 0
+                centroids[filled] = normalize_rows(sums[filled])
+            assign = np.empty(n, dtype=np.int32)
+            for start in range(0, n, 65536):
+                block = vectors[start:start + 65536]
+                assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+            order = np.argsort(assign, kind='stable')
+            self.centroids = centroids
+            self._list_rows = order
+            self._list_vectors = vectors[order]
+            self._offsets = np.searchsorted(assign[order], np.arange(nlist + 1))
+            self._tail = {}
+            self._stale = set()
+            self._trained_at = n
+
+    def search(self, vector, k=10):
+        """Return [(key, tags, similarity), ...] for the k nearest notes."""
+        with self._lock:
+            if not self._count:
+                return []
+            q = normalize_rows(np.asarray(vector, dtype=np.float32))[0]
+            if q.shape[0] != self.dim:
+                return []
+            if self.centroids is None:
+                rows = None
+                scores = self.vectors @ q
+            else:
+                probe = top_k_indices(self.centroids @ q, self.nprobe)
+                spans = [(self._offsets[c], self._offsets[c + 1]) for c in probe]
+                rows = [self._list_rows[a:b] for a, b in spans]
+                scores = [self._list_vectors[a:b] @ q for a, b in spans]
+                if self._tail:
+                    tail = np.fromiter(self._tail, dtype=np.intp, count=len(self._tail))
+                    rows.append(tail)
+                    scores.append(self.vectors[tail] @ q)
+                rows = np.concatenate(rows)
+                scores = np.concatenate(scores)
+                if self._stale:
+                    stale = np.fromiter(self._stale, dtype=np.intp, count=len(self._stale))
+                    keep = ~np.isin(rows[:len(rows) - len(self._tail)], stale)
+                    keep = np.concatenate([keep, np.ones(len(self._tail), dtype=bool)])
+                    rows = rows[keep]
+                    scores = scores[keep]
+            idx = top_k_indices(scores, k)
+            hits = idx if rows is None else rows[idx]
+            return [(self.keys[r], self.tags[r], float(scores[i])) for r, i in zip(hits, idx)]
+
+    def save(self, directory):
+        with self._lock:
+            if not self.dirty:
+                return
+            os.makedirs(directory, exist_ok=True)
+            tmp = os.path.join(directory, 'vectors.tmp.npy')
+            np.save(tmp, self.vectors)
+            os.replace(tmp, os.path.join(directory, 'vectors.npy'))
+            meta = {'dim': self.dim, 'keys': self.keys, 'tags': self.tags}
+            tmp = os.path.join(directory, 'labels.json.tmp')
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(tmp, os.path.join(directory, 'labels.json'))
+            self.dirty = False
+
+    @classmethod
+    def load(cls, directory, **kwargs):
+        index = cls(**kwargs)
+        labels_path = os.path.join(directory, 'labels.json')
+        vectors_path = os.path.join(directory, 'vectors.npy')
+        if not (os.path.exists(labels_path) and os.path.exists(vectors_path)):
+            return index
+        with open(labels_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        vectors = np.load(vectors_path)
+        n = min(len(meta['keys']), len(vectors))
+        index.dim = meta['dim']
+        index._vectors = np.array(vectors[:n], dtype=np.float32).reshape(n, index.dim)
+        index._count = n
+        index.keys = meta['keys'][:n]
+        index.tags = meta['tags'][:n]
+        index.rows = {k: i for i, k in enumerate(index.keys)}
+        if n >= index.ivf_threshold:
+            index.train()
+        return index
+
+def vote(neighbors, min_similarity=0.85, min_share=0.4, max_tags=3):
+    """
+    Similarity-weighted tag vote over the neighbours at least `min_similarity`
+    close. Returns the winning tags (at most max_tags, each holding at least
+    `min_share` of the vote), or None when no neighbour is close enough.
+    """
+    weights = {}
+    total = 0.0
+    for _, tags, sim in neighbors:
+        if sim < min_similarity:
+            continue
+        total += sim
+        for tag in tags:
+            weights[tag] = weights.get(tag, 0.0) + sim
+    if not total:
+        return None
+    ranked = sorted(weights.items(), key=lambda x: x[1], reverse=True)
+    winners = [tag for tag, w in ranked if w / total >= min_share][:max_tags]
+    return winners or None
+
+class KNNProvider(GatedProvider):
+    """
+    Tag notes from their nearest already-tagged neighbours, escalating to
+    `fallback` when the vote is not confident. `embedder` is an embedding
+    provider (its store makes re-embedding free).
+    """
+    stage = 'knn'
+
+    def __init__(self, index, embedder, fallback, k=10, min_similarity=0.85, min_share=0.4):
+        super().__init__(fallback)
+        self.index = index
+        self.embedder = embedder
+        self.k = k
+        self.min_similarity = min_similarity
+        self.min_share = min_share
+        self._recent = {}
+        self._lock = threading.Lock()
+
+    def _remember(self, text, vec):
+        with self._lock:
+            # Kept until the note is written (see note_tagged)
+            self._recent[content_hash(text)] = vec
+            if len(self._recent) > 4096:
+                del self._recent[next(iter(self._recent))]
+
+    def predict(self, vec, tags_list):
+        """Vote over the neighbours of one vector; None when not confident."""
+        if vec is None or not len(vec):
+            return None
+        tags = vote(self.index.search(vec, self.k), self.min_similarity, self.min_share)
+        tags = [t for t in tags if t in tags_list] if tags else None
+        return tags or None
+
+    def predict_many(self, texts, tags_list):
+        results = []
+        for text, vec in zip(texts, self.embedder.embed_many(texts)):
+            self._remember(text, vec)
+            results.append(self.predict(vec, tags_list))
+        return results
+
+    def note_tagged(self, key, text, tags):
+        """Add a freshly written note to the index."""
+        with self._lock:
+            vec = self._recent.pop(content_hash(text), None)
+        if vec is None:
+            vec = self.embedder.embed_many([text])[0]
+        self.index.add(key, vec, tags)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Minimal HTTP client for the local Ollama API (/api/generate, /api/chat, /api/embed).
+Keeps a pool of keep-alive connections so concurrent workers can have
+several requests in flight without reconnecting, and passes `keep_alive`
+so the model stays resident between notes.
+"""
+import os
+import json
+import queue
+import http.client
+from urllib.parse import urlsplit
+
+from instrumentation import api_call, record_usage
+
+DEFAULT_OLLAMA_HOST = 'http://localhost:11434'
+# How long Ollama keeps the model loaded after the last request
+DEFAULT_KEEP_ALIVE = '30m'
+
+class OllamaError(Exception):
+    """Error response from the Ollama server."""
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+def _parse_host(host):
+    host = host or os.environ.get('OLLAMA_HOST') or DEFAULT_OLLAMA_HOST
+    if '://' not in host:
+        host = f"http://{host}"
+    parts = urlsplit(host)
+    hostname = parts.hostname or 'localhost'
+    # OLLAMA_HOST=0.0.0.0 is a bind address; connect locally instead
+    if hostname == '0.0.0.0':
+        hostname = '127.0.0.1'
+    return parts.scheme, hostname, parts.port or 11434
+
+class OllamaClient:
+    """
+    Thread-safe Ollama API client backed by a pool of persistent connections.
+    """
+    def __init__(self, host=None, keep_alive=DEFAULT_KEEP_ALIVE, timeout=600, pool_size=8):
+        self.scheme, self.hostname, self.port = _parse_host(host)
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    @property
+    def base_url(self):
+        return f"{self.scheme}://{self.hostname}:{self.port}"
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        return cls(self.hostname, self.port, timeout=self.timeout)
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def _release(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, path, payload):
+        """POST a JSON payload and return the decoded JSON response."""
+        body = json.dumps(payload).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        for attempt in range(2):
+            conn = self._acquire()
+            try:
+                conn.request('POST', path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # A pooled connection closed by the server: retry once on a fresh one
+                conn.close()
+                if attempt:
+                    raise
+                continue
+            except Exception:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            if resp.status != 200:
+                try:
+                    message = json.loads(data).get('error', '')
+                except ValueError:
+                    message = data.decode('utf-8', 'replace')
+                raise OllamaError(f"Ollama {path} returned {resp.status}: {message}", resp.status)
+            return json.loads(data)
+
+    def generate(self, model, prompt, system=None, options=None, format=None):
+        payload = {'model': model, 'prompt': prompt, 'stream': False, 'keep_alive': self.keep_alive}
+        if system:
+            payload['system'] = system
+        if options:
+            payload['options'] = options
+        if format:
+            payload['format'] = format
+        with api_call('ollama', model):
+            data = self.request('/api/generate', payload)
+        record_usage('ollama', model, prompt=data.get('prompt_eval_count', 0), completion=data.get('eval_count', 0))
+        return data.get('response', '')
+
+    def chat(self, model, messages, options=None, format=None):
+        payload = {'model': model, 'messages': messages, 'stream': False, 'keep_alive': self.keep_alive}
+        if options:
+            payload['options'] = options
+        if format:
+            payload['format'] = format
+        with api_call('ollama', model):
+            data = self.request('/api/chat', payload)
+        record_usage('ollama', model, prompt=data.get('prompt_eval_count', 0), completion=data.get('eval_count', 0))
+        return data.get('message', {}).get('content', '')
+
+    def embed(self, model, inputs):
+        """Embed a list of inputs in one request; returns one vector per input."""
+        payload = {'model': model, 'input': list(inputs), 'keep_alive': self.keep_alive}
+        with api_call('ollama', model):
+            data = self.request('/api/embed', payload)
+        record_usage('ollama', model, embedding=data.get('prompt_eval_count', 0))
+        return data.get('embeddings', [])
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
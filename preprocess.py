@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Token-budgeted note preprocessing before classification.
+Strips or collapses markdown that carries no topical content (data URIs,
+HTML, link targets, long code blocks and link lists), then caps the text
+to a per-provider token budget by keeping the head, the tail and an evenly
+spaced sample of paragraphs from the middle.
+Large files are read as a bounded head/tail sample instead of in full.
+"""
+import re
+import hashlib
+from collections import deque
+from urllib.parse import urlsplit
+
+from rate_limit import estimate_tokens
+
+# Default classification input budget (tokens of note text) per provider
+DEFAULT_TOKEN_BUDGETS = {
+    'openai': 6000,
+    'gemini': 8000,
+    'ollama': 3000,
+    'embedding': 8000,
+}
+# Notes larger than this are read as a head/tail sample
+LARGE_NOTE_BYTES = 1024 * 1024
+OMISSION_MARKER = '\n\n[…]\n\n'
+
+_tokenizers = {}
+
+def _tokenizer(model):
+    """tiktoken encoding for a model, or None when tiktoken is unavailable."""
+    if model in _tokenizers:
+        return _tokenizers[model]
+    enc = None
+    try:
+        import tiktoken
+        try:
+            enc = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding('o200k_base')
+        except KeyError:
+            enc = tiktoken.get_encoding('o200k_base')
+    except Exception:
+        enc = None
+    _tokenizers[model] = enc
+    return enc
+
+def count_tokens(text, model=None):
+    """
+    Token count of text. Uses tiktoken when installed; otherwise falls back
+    to a CJK-aware estimate (one token per Japanese character).
+    """
+    enc = _tokenizer(model)
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+_DATA_IMAGE_RE = re.compile(r'!\[[^\]]*\]\(\s*data:[^)]*\)')
+_DATA_URI_RE = re.compile(r'data:[\w.+/-]+;base64,[A-Za-z0-9+/=\s]{64,}')
+_HTML_COMMENT_RE = re.compile(r'<!--.*?-->', re.S)
+_HTML_TAG_RE = re.compile(r'</?[A-Za-z][^>\n]*>')
+_IMAGE_RE = re.compile(r'!\[([^\]]*)\]\([^)]*\)')
+_LINK_RE = re.compile(r'\[([^\]]+)\]\((?:[^()\s]|\([^)]*\))*(?:\s+"[^"]*")?\)')
+_URL_RE = re.compile(r'https?://[^\s<>()\]]+')
+_FENCE_RE = re.compile(r'^(```|~~~)([^\n]*)\n(.*?)^\1[ \t]*$', re.S | re.M)
+_LIST_ITEM_RE = re.compile(r'^\s*(?:[-*+]|\d+[.)])\s+')
+
+def _collapse_code(match, max_lines):
+    fence, info, code = match.groups()
+    lines = code.splitlines()
+    if len(lines) <= max_lines:
+        return match.group(0)
+    kept = '\n'.join(lines[:max_lines])
+    return f"{fence}{info}\n{kept}\n… ({len(lines) - max_lines} more lines)\n{fence}"
+
+def _collapse_lists(text, max_items):
+    out, run = [], 0
+    for line in text.split('\n'):
+        if _LIST_ITEM_RE.match(line):
+            run += 1
+            if run == max_items + 1:
+                out.append('- …')
+            if run > max_items:
+                continue
+        else:
+            run = 0
+        out.append(line)
+    return '\n'.join(out)
+
+def clean_markdown(text, max_code_lines=15, max_list_items=15):
+    """Remove markdown that carries no topical content."""
+    text = _DATA_IMAGE_RE.sub('', text)
+    text = _DATA_URI_RE.sub('[data]', text)
+    text = _HTML_COMMENT_RE.sub('', text)
+    text = _FENCE_RE.sub(lambda m: _collapse_code(m, max_code_lines), text)
+    text = _HTML_TAG_RE.sub('', text)
+    text = _IMAGE_RE.sub(r'\1', text)
+    text = _LINK_RE.sub(r'\1', text)
+    # Keep only the domain of bare URLs
+    text = _URL_RE.sub(lambda m: urlsplit(m.group(0)).netloc, text)
+    text = _collapse_lists(text, max_list_items)
+    text = re.sub(r'[ \t]+\n', '\n', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    return text.strip()
+
+def _trim(text, budget, model, from_end=False):
+    """Cut text to about `budget` tokens at a character boundary."""
+    tokens = count_tokens(text, model)
+    if tokens <= budget:
+        return text
+    chars = max(1, int(len(text) * budget / tokens))
+    return text[-chars:] if from_end else text[:chars]
+
+def fit_to_budget(text, budget, model=None, head_share=0.6, tail_share=0.2):
+    """
+    Cap text to `budget` tokens. Keeps leading paragraphs (head_share of the
+    budget), trailing paragraphs (tail_share) and fills the rest with evenly
+    spaced paragraphs from the middle, in document order.
+    """
+    if not budget or count_tokens(text, model) <= budget:
+        return text
+    paras = [p for p in re.split(r'\n\s*\n', text) if p.strip()]
+    tokens = [count_tokens(p, model) for p in paras]
+    chosen = {}
+    remaining = budget
+
+    def take(i, limit, from_end=False):
+        nonlocal remaining
+        if i in chosen or remaining <= 0 or limit <= 0:
+            return 0
+        t = min(tokens[i], limit, remaining)
+        chosen[i] = paras[i] if t == tokens[i] else _trim(paras[i], t, model, from_end)
+        remaining -= t
+        return t
+
+    head = int(budget * head_share)
+    for i in range(len(paras)):
+        if head <= 0:
+            break
+        head -= take(i, head)
+    tail = int(budget * tail_share)
+    for i in reversed(range(len(paras))):
+        if tail <= 0:
+            break
+        tail -= take(i, tail, from_end=True)
+    middle = [i for i in range(len(paras)) if i not in chosen]
+    if middle and remaining > 0:
+        avg = max(1, sum(tokens[i] for i in middle) // len(middle))
+        step = max(1, len(middle) * avg // remaining)
+        for i in middle[step // 2::step]:
+            if remaining <= 0:
+                break
+            take(i, remaining)
+    parts, last = [], None
+    for i in sorted(chosen):
+        if last is not None and i != last + 1:
+            parts.append(OMISSION_MARKER.strip())
+        parts.append(chosen[i])
+        last = i
+    return '\n\n'.join(parts)
+
+def prepare_text(text, budget=None, model=None, clean=True):
+    """Clean a note body and cap it to the token budget."""
+    if clean:
+        text = clean_markdown(text)
+    return fit_to_budget(text, budget, model)
+
+def read_head_tail(path, max_bytes=LARGE_NOTE_BYTES, chunk_size=1024 * 1024):
+    """
+    Stream a file once, returning (head, tail, digest):
+      head   - the first max_bytes bytes (the whole file if it is small)
+      tail   - the last max_bytes // 4 bytes, or None when head is complete
+      digest - SHA-256 of the full contents
+    Memory use is bounded by max_bytes regardless of the file size.
+    """
+    digest = hashlib.sha256()
+    tail_bytes = max(1, max_bytes // 4)
+    head = bytearray()
+    tail = deque()
+    tail_len = 0
+    overflow = False
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            if len(head) < max_bytes:
+                room = max_bytes - len(head)
+                head += chunk[:room]
+                chunk = chunk[room:]
+            if chunk:
+                overflow = True
+                tail.append(chunk)
+                tail_len += len(chunk)
+                while tail_len - len(tail[0]) >= tail_bytes:
+                    tail_len -= len(tail.popleft())
+    if not overflow:
+        return bytes(head), None, digest.hexdigest()
+    return bytes(head), b''.join(tail)[-tail_bytes:], digest.hexdigest()
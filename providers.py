@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Provider registry shared by tag_refiner.py, generate_taxonomy.py and
+benchmark.py. Completion and embedding backends are registered by name as
+'module:Class' strings, so a backend's module is only imported when it is
+selected, and the provider classes import their SDK (openai,
+google-generativeai) on the first request. build_completion_provider() and
+build_embedding_provider() share the construction and configuration (API
+keys from the command line or environment, Ollama connection settings,
+the embedding store) between the scripts. register_provider() adds or
+replaces backends, e.g. from a script or benchmark.
+"""
+import os
+import sys
+import importlib
+import importlib.util
+from collections import namedtuple
+
+from ollama_client import DEFAULT_KEEP_ALIVE
+from instrumentation import stage
+
+COMPLETION = 'completion'
+EMBEDDING = 'embedding'
+
+# `target` is a class or 'module:Class'; backends with an `api_key_env` are
+# constructed as cls(api_key, model, **options), others are local servers
+# constructed as cls(model, host=..., keep_alive=..., pool_size=..., **options)
+ProviderSpec = namedtuple('ProviderSpec', ['target', 'api_key_env', 'package'])
+
+REGISTRY = {
+    COMPLETION: {
+        'openai': ProviderSpec('completion_providers:OpenAIProvider', 'OPENAI_API_KEY', 'openai'),
+        'gemini': ProviderSpec('completion_providers:GeminiProvider', 'GOOGLE_API_KEY', 'google.generativeai'),
+        'ollama': ProviderSpec('completion_providers:OllamaProvider', None, None),
+    },
+    EMBEDDING: {
+        'openai': ProviderSpec('embedding_classifier:OpenAIEmbeddingProvider', 'OPENAI_API_KEY', 'openai'),
+        'gemini': ProviderSpec('embedding_classifier:GeminiEmbeddingProvider', 'GOOGLE_API_KEY', 'google.generativeai'),
+        'ollama': ProviderSpec('embedding_classifier:OllamaEmbeddingProvider', None, None),
+    },
+}
+
+# pip distribution names of SDK packages whose import name differs
+PACKAGE_NAMES = {'google.generativeai': 'google-generativeai'}
+
+def register_provider(kind, name, target, api_key_env=None, package=None):
+    """Register (or replace) a backend; `target` is a class or a lazily imported 'module:Class' string."""
+    REGISTRY[kind][name] = ProviderSpec(target, api_key_env, package)
+
+def provider_names(kind):
+    """Registered backend names, for argparse choices (imports nothing)."""
+    return list(REGISTRY[kind])
+
+def provider_spec(kind, name):
+    """Registry entry of backend `name`; exits if there is none."""
+    spec = REGISTRY[kind].get(name)
+    if spec is None:
+        print(f"Error: unsupported {kind} provider: {name}", file=sys.stderr)
+        sys.exit(1)
+    return spec
+
+def provider_class(kind, name):
+    """The provider class registered as `name`, importing its module on first use."""
+    spec = provider_spec(kind, name)
+    if not isinstance(spec.target, str):
+        return spec.target
+    module, _, attr = spec.target.partition(':')
+    with stage('import'):
+        cls = getattr(importlib.import_module(module), attr)
+    REGISTRY[kind][name] = spec._replace(target=cls)
+    return cls
+
+def _check_package(name, spec):
+    # find_spec locates the SDK without importing it, so a missing package fails before any work is done
+    try:
+        found = spec.package is None or importlib.util.find_spec(spec.package) is not None
+    except ImportError:
+        found = False
+    if not found:
+        package = PACKAGE_NAMES.get(spec.package, spec.package)
+        print(f"Error: the {package} package is required for provider={name} (pip install {package}).",
+              file=sys.stderr)
+        sys.exit(1)
+
+def api_key_for(name, spec, api_key=None):
+    """`api_key`, or the backend's API key environment variable; exits if neither is set."""
+    key = api_key or os.environ.get(spec.api_key_env)
+    if not key:
+        print(f"Error: an API key is required for provider={name} (--api-key or ${spec.api_key_env}).",
+              file=sys.stderr)
+        sys.exit(1)
+    return key
+
+def _build(kind, name, model, api_key, ollama_host, keep_alive, pool_size, options):
+    spec = provider_spec(kind, name)
+    key = api_key_for(name, spec, api_key) if spec.api_key_env else None
+    _check_package(name, spec)
+    cls = provider_class(kind, name)
+    if key is not None:
+        return cls(key, model, **options)
+    return cls(model, host=ollama_host, keep_alive=keep_alive, pool_size=pool_size, **options)
+
+def build_completion_provider(name, model=None, api_key=None, ollama_host=None,
+                              keep_alive=DEFAULT_KEEP_ALIVE, pool_size=8, **options):
+    """Construct the completion backend `name`; `options` go to the provider class."""
+    return _build(COMPLETION, name, model, api_key, ollama_host, keep_alive, pool_size, options)
+
+def build_embedding_provider(name, model=None, api_key=None, ollama_host=None,
+                             keep_alive=DEFAULT_KEEP_ALIVE, pool_size=8, cache=True, cache_dir=None,
+                             **options):
+    """
+    Construct the embedding backend `name`. Unless `cache` is False its
+    embeddings are served from the on-disk store in `cache_dir` (default:
+    .cache/embeddings next to this script).
+    """
+    provider = _build(EMBEDDING, name, model, api_key, ollama_host, keep_alive, pool_size, options)
+    if cache:
+        from embedding_store import DEFAULT_CACHE_DIR
+        provider.enable_store(cache_dir or DEFAULT_CACHE_DIR)
+    return provider
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Rate-limit-aware scheduling helpers for concurrent classification.
+A RateLimiter enforces requests/min and tokens/min budgets shared by all
+worker threads; call_with_retry retries 429s, 5xx and timeouts with
+jittered exponential backoff.
+"""
+import re
+import sys
+import time
+import random
+import socket
+import threading
+
+from instrumentation import count
+
+# Default per-minute budgets per provider (None = unlimited).
+# Override with --rpm / --tpm to match your account tier.
+DEFAULT_RATE_LIMITS = {
+    'openai': {'rpm': 500, 'tpm': 200000},
+    'gemini': {'rpm': 1000, 'tpm': 1000000},
+    'ollama': {'rpm': None, 'tpm': None},
+}
+
+_CJK_RE = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯＀-￯]')
+
+def estimate_tokens(text):
+    """
+    Cheap token estimate used for budgeting: CJK characters count as one
+    token each, everything else as ~4 characters per token.
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+class RateLimiter:
+    """
+    Token-bucket limiter over requests per minute and tokens per minute.
+    Thread-safe; `acquire` blocks until both budgets allow the request.
+    """
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm or 0)
+        self._tokens = float(tpm or 0)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._last
+        self._last = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+
+    def acquire(self, tokens=0):
+        if not self.rpm and not self.tpm:
+            return
+        # A single request larger than the whole budget waits for a full bucket
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                wait = 0.0
+                if self.rpm and self._requests < 1:
+                    wait = max(wait, (1 - self._requests) * 60.0 / self.rpm)
+                if self.tpm and self._tokens < tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60.0 / self.tpm)
+                if wait == 0.0:
+                    if self.rpm:
+                        self._requests -= 1
+                    if self.tpm:
+                        self._tokens -= tokens
+                    return
+            time.sleep(wait)
+
+def _status_code(exc):
+    code = getattr(exc, 'status_code', None) or getattr(exc, 'code', None)
+    if code is None:
+        response = getattr(exc, 'response', None)
+        code = getattr(response, 'status_code', None) or getattr(response, 'status', None)
+    try:
+        return int(code)
+    except (TypeError, ValueError):
+        return None
+
+def is_retryable(exc):
+    """True for rate-limit (429), server-side (5xx) and timeout errors."""
+    if isinstance(exc, (TimeoutError, socket.timeout, ConnectionError)):
+        return True
+    code = _status_code(exc)
+    if code is not None:
+        return code == 429 or code >= 500
+    # SDK exceptions without a status code (openai / google.api_core)
+    name = type(exc).__name__
+    return name in (
+        'RateLimitError', 'APITimeoutError', 'APIConnectionError', 'InternalServerError',
+        'ResourceExhausted', 'ServiceUnavailable', 'DeadlineExceeded', 'TimeoutExpired',
+    )
+
+def _retry_after(exc):
+    response = getattr(exc, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def call_with_retry(fn, *args, max_retries=5, base_delay=1.0, max_delay=60.0, **kwargs):
+    """
+    Call fn(*args, **kwargs), retrying retryable errors with full-jitter
+    exponential backoff (honouring a Retry-After header when present).
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+            count('api_retries')
+            print(f"Retrying after {type(e).__name__} (attempt {attempt + 1}/{max_retries}, "
+                  f"sleep {delay:.1f}s)", file=sys.stderr)
+            time.sleep(delay)
+
+class RateLimitedProvider:
+    """
+    Wrap a completion or embedding provider so every API request first
+    acquires the shared RateLimiter and is retried on transient errors.
+    Completion calls are wrapped here; embedding providers get the limiter
+    handed to their batcher. Other attributes (model, store, ...) are passed through.
+    """
+    def __init__(self, provider, limiter, max_retries=5):
+        self.provider = provider
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.is_embedding = hasattr(provider, 'load_tags')
+        if self.is_embedding:
+            # Embedding providers batch several notes per request, so they
+            # acquire the limiter themselves once per actual API request
+            provider.limiter = limiter
+            provider.max_retries = max_retries
+
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
+
+    def classify(self, text, tags_list):
+        if self.is_embedding:
+            return self.provider.classify(text, tags_list)
+        # Completion prompts carry the note and the whole taxonomy
+        tokens = estimate_tokens(text) + estimate_tokens('\n'.join(tags_list))
+        def attempt():
+            self.limiter.acquire(tokens)
+            return self.provider.classify(text, tags_list)
+        return call_with_retry(attempt, max_retries=self.max_retries)
+
+    def classify_packed(self, notes, tags_list):
+        tokens = sum(estimate_tokens(text) for _, text in notes) + estimate_tokens('\n'.join(tags_list))
+        def attempt():
+            self.limiter.acquire(tokens)
+            return self.provider.classify_packed(notes, tags_list)
+        return call_with_retry(attempt, max_retries=self.max_retries)
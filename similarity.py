@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Vectorized cosine-similarity scoring shared by the embedding providers.
+Tag embeddings are kept as one pre-normalized float32 matrix so that a note
+(or a batch of notes) is scored with a single matrix product.
+"""
+import numpy as np
+
+
+def as_matrix(vectors, dim=None):
+    """
+    Stack a sequence of embedding vectors into a float32 matrix.
+    Empty vectors (failed embeddings) become zero rows, so they score 0.0
+    against everything.
+    """
+    vectors = list(vectors)
+    if dim is None:
+        dim = max((len(v) for v in vectors), default=0)
+    matrix = np.zeros((len(vectors), dim), dtype=np.float32)
+    for i, vec in enumerate(vectors):
+        if len(vec):
+            matrix[i] = np.asarray(vec, dtype=np.float32)
+    return matrix
+
+
+def normalize_rows(matrix):
+    """Return a copy of `matrix` with every non-zero row scaled to unit length."""
+    matrix = np.array(matrix, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+def mean_embedding(vectors):
+    """Average several chunk embeddings into a single note embedding."""
+    return as_matrix(vectors).mean(axis=0)
+
+
+def top_k_indices(scores, k):
+    """
+    Indices of the k highest scores per row, best first.
+    Uses argpartition so only the k selected entries are sorted.
+    """
+    scores = np.asarray(scores)
+    squeeze = scores.ndim == 1
+    scores = np.atleast_2d(scores)
+    n = scores.shape[1]
+    k = max(0, min(k, n))
+    if k == 0:
+        idx = np.empty((scores.shape[0], 0), dtype=np.intp)
+    else:
+        if k < n:
+            part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            part = np.tile(np.arange(n), (scores.shape[0], 1))
+        order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1, kind='stable')
+        idx = np.take_along_axis(part, order, axis=1)
+    return idx[0] if squeeze else idx
+
+
+class TagSimilarityIndex:
+    """
+    Cosine-similarity index over tag embeddings.
+    Rows are L2-normalized once at construction; queries are normalized per call.
+    """
+    def __init__(self, tags_list, embeddings):
+        self.tags_list = list(tags_list)
+        self.matrix = normalize_rows(as_matrix(embeddings))
+        if self.matrix.shape[0] != len(self.tags_list):
+            raise ValueError(
+                f"Got {self.matrix.shape[0]} embeddings for {len(self.tags_list)} tags"
+            )
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    def scores(self, vectors):
+        """
+        Cosine similarity of one vector (1-D, returns shape (tags,)) or a batch
+        of vectors (2-D, returns shape (notes, tags)) against every tag.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            if vectors.shape[0] != self.dim:
+                return np.zeros(len(self.tags_list), dtype=np.float32)
+            return self.matrix @ normalize_rows(vectors)[0]
+        if vectors.shape[1] != self.dim:
+            return np.zeros((vectors.shape[0], len(self.tags_list)), dtype=np.float32)
+        return normalize_rows(vectors) @ self.matrix.T
+
+    def top_k(self, vector, k):
+        """Return [(tag, score), ...] for the k best tags of a single vector."""
+        scores = self.scores(vector)
+        return [(self.tags_list[i], float(scores[i])) for i in top_k_indices(scores, k)]
+
+    def top_k_batch(self, vectors, k):
+        """Return one [(tag, score), ...] list per row of `vectors`."""
+        scores = self.scores(vectors)
+        idx = top_k_indices(scores, k)
+        return [
+            [(self.tags_list[i], float(row[i])) for i in row_idx]
+            for row, row_idx in zip(scores, idx)
+        ]
+
+    def classify(self, vector, k):
+        return [tag for tag, _ in self.top_k(vector, k)]
+
+    def classify_batch(self, vectors, k):
+        return [[tag for tag, _ in row] for row in self.top_k_batch(vectors, k)]
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Persistent tag -> notes inverted index for static index pages.
+One pass over the vault reads the frontmatter (tags, created, description)
+of new or modified notes only; unchanged notes are recognised by their
+stat data and kept from the saved state. tag_refiner.py updates single
+entries as it tags notes, so index pages can be re-rendered without
+scanning the vault.
+"""
+import os
+import sys
+import json
+import hashlib
+import threading
+
+from frontmatter import read_header
+from vault_manifest import DEFAULT_MANIFEST_DIR
+from vault_scanner import iter_notes, prefetch
+
+TAG_INDEX_VERSION = 1
+
+def default_tag_index_path(input_dir):
+    """Tag index state file for a vault directory, stored next to this script."""
+    key = hashlib.sha1(os.path.abspath(input_dir).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(DEFAULT_MANIFEST_DIR, f"tagindex_{key}.json")
+
+def _text(value):
+    """Frontmatter scalar as display text ('' when missing)."""
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        return ', '.join(_text(v) for v in value)
+    return ' '.join(str(value).split())
+
+def note_entry(path, st=None):
+    """Index entry for a note: stat data plus the frontmatter fields shown in index tables."""
+    st = st or os.stat(path)
+    fm = read_header(path).fm_dict
+    tags = fm.get('tags') or []
+    if isinstance(tags, str):
+        tags = [tags]
+    return {
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'tags': [str(t).lstrip('#') for t in tags if t is not None],
+        'created': _text(fm.get('created')),
+        'description': _text(fm.get('description')),
+    }
+
+class TagIndex:
+    """
+    path -> {size, mtime_ns, tags, created, description}
+    Paths are stored relative to the vault root with '/' separators.
+    """
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self.entries = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == TAG_INDEX_VERSION:
+                    self.entries = data.get('entries', {})
+            except Exception as e:
+                print(f"Warning: ignoring unreadable tag index {path}: {e}", file=sys.stderr)
+
+    def key(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def refresh(self, workers=8):
+        """
+        Walk the vault once, re-reading the frontmatter of new or modified
+        notes and dropping deleted ones. Returns the number of notes read.
+        """
+        seen = set()
+        changed = []
+        for path, st in iter_notes(self.root):
+            key = self.key(path)
+            seen.add(key)
+            entry = self.entries.get(key)
+            if entry is None or entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns:
+                changed.append((path, st))
+        read = 0
+        for (path, st), entry in prefetch(changed, lambda item: note_entry(*item), workers):
+            if isinstance(entry, Exception):
+                print(f"Warning: cannot read frontmatter of {path}: {entry}", file=sys.stderr)
+                continue
+            self.entries[self.key(path)] = entry
+            read += 1
+        stale = [key for key in self.entries if key not in seen]
+        for key in stale:
+            del self.entries[key]
+        if read or stale:
+            self.dirty = True
+        return read
+
+    def update(self, paths):
+        """Re-read the given notes (e.g. just tagged ones); missing files are removed."""
+        for path in paths:
+            key = self.key(path)
+            try:
+                entry = note_entry(path)
+            except FileNotFoundError:
+                entry = None
+            except Exception as e:
+                print(f"Warning: cannot read frontmatter of {path}: {e}", file=sys.stderr)
+                continue
+            with self._lock:
+                if entry is None:
+                    self.dirty |= self.entries.pop(key, None) is not None
+                elif self.entries.get(key) != entry:
+                    self.entries[key] = entry
+                    self.dirty = True
+
+    def notes_by_tag(self):
+        """
+        tag -> [(path, entry)] sorted by `created`, newest first (notes without
+        a date last). A note is listed under each of its tags and their parent
+        tags, as the Dataview `contains(tags, ...)` query lists nested tags.
+        """
+        dated = sorted((item for item in self.entries.items() if item[1]['created']),
+                       key=lambda item: (item[1]['created'], item[0]), reverse=True)
+        undated = sorted(item for item in self.entries.items() if not item[1]['created'])
+        by_tag = {}
+        for path, entry in dated + undated:
+            prefixes = set()
+            for tag in entry['tags']:
+                parts = tag.split('/')
+                prefixes.update('/'.join(parts[:i]) for i in range(1, len(parts) + 1))
+            for prefix in prefixes:
+                by_tag.setdefault(prefix, []).append((path, entry))
+        return by_tag
+
+    def save(self):
+        """Write the index state atomically (temp file + rename)."""
+        with self._lock:
+            if not self.dirty:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'version': TAG_INDEX_VERSION, 'entries': self.entries}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self.dirty = False
@@ -5,37 +5,38 @@ and update their frontmatter with the 'tags' property via LLMs (OpenAI, Gemini,
 """
 import os
 import sys
-import json
+import signal
+import time
 import argparse
-import subprocess
+from itertools import chain, islice
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import yaml
-from embedding_classifier import OpenAIEmbeddingProvider, GeminiEmbeddingProvider, OllamaEmbeddingProvider
-
-def build_classification_prompts(text, tags_list):
-    """
-    Build system and user prompts for Obsidian note classification.
-    Returns (system_prompt, user_prompt) for LLM calls.
-    """
-    system_prompt = (
-        "You are a helpful assistant that classifies Obsidian notes into the given tags. "
-        "Only output a JSON array of valid tags."
-    )
-    tag_lines = '\n'.join(f"- {t}" for t in tags_list)
-    user_prompt = (
-        f"""以下は Obsidian ノートの本文です。
-タグ一覧:
-{tag_lines}
-
-出力は JSON 配列のみで、例: [\"dev/agents\",\"dev/tools\"]。
-ノート本文:
-{text}
-"""
-    )
-    return system_prompt, user_prompt
+# numpy-based feature modules (hierarchy, cascade, neighbor_index,
+# near_duplicates, similarity) and provider SDKs are imported when used
+import providers
+from providers import COMPLETION, EMBEDDING, provider_names, provider_class, build_completion_provider
+from completion_providers import build_classification_prompts, parse_tags_response
+from vault_manifest import VaultManifest, default_manifest_path, taxonomy_hash
+from rate_limit import DEFAULT_RATE_LIMITS, RateLimiter, RateLimitedProvider, estimate_tokens
+from taxonomy import Taxonomy, as_taxonomy, flatten_tags
+from taxonomy_diff import diff_taxonomies, default_snapshot_path, load_snapshot, save_snapshot
+from frontmatter import find_header, read_header, build_header, replace_header
+from vault_scanner import iter_notes, prefetch
+from watcher import DEFAULT_WATCH_PORT, watch
+import instrumentation
+from instrumentation import stage, count, set_count, timed_iter
+from tag_index import TagIndex, default_tag_index_path
+from generate_index import load_taxonomy, write_index
+from preprocess import (DEFAULT_TOKEN_BUDGETS, LARGE_NOTE_BYTES, OMISSION_MARKER,
+                        prepare_text, read_head_tail)
+from ollama_client import DEFAULT_KEEP_ALIVE
+from batch_jobs import (BATCH_FORMATS, BatchState, request_id, request_line, read_results,
+                        write_batch_file, submit_openai_batch, poll_openai_batch)
 
 def load_tags_file(path):
     """
-    Load tag taxonomy from a YAML file.
+    Load tag taxonomy from a YAML file as a compiled Taxonomy (a list of tags).
     Supports:
       - A top-level list of tag strings.
       - A dict with key 'tags' mapping to a list.
@@ -44,107 +45,10 @@ def load_tags_file(path):
     """
     with open(path, 'r', encoding='utf-8') as f:
         data = yaml.safe_load(f)
-    # Recursively flatten nested dict/list into hierarchical tags
-    def recurse(node, prefix=""):
-        if isinstance(node, dict):
-            for key, value in node.items():
-                new_prefix = f"{prefix}/{key}" if prefix else str(key)
-                yield from recurse(value, new_prefix)
-        elif isinstance(node, list):
-            for item in node:
-                yield from recurse(item, prefix)
-        elif isinstance(node, str):
-            tag = f"{prefix}/{node}" if prefix else node
-            yield tag
-        else:
-            return
-    tags = list(recurse(data))
+    tags = flatten_tags(data)
     if not tags:
         raise ValueError(f"Invalid tags file format: {path}")
-    return tags
-
-class BaseProvider:
-    def classify(self, text, tags_list):
-        raise NotImplementedError
-
-class OpenAIProvider(BaseProvider):
-    def __init__(self, api_key, model=None):
-        import openai
-        openai.api_key = api_key
-        self.openai = openai
-        # Use o4-mini as default model for cost-effective tagging
-        self.model = model or "o4-mini"
-
-    def classify(self, text, tags_list):
-        system_prompt, user_prompt = build_classification_prompts(text, tags_list)
-        # Use new OpenAI chat completion API
-        params = {
-            "model": self.model,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ]
-        }
-        if self.model != 'o4-mini':
-            params["temperature"] = 0
-
-        resp = self.openai.chat.completions.create(**params)
-        content = resp.choices[0].message.content.strip()
-        try:
-            tags = json.loads(content)
-            return [t for t in tags if t in tags_list]
-        except Exception:
-            print(f"Warning: failed to parse JSON response: {content}", file=sys.stderr)
-            return []
-
-class GeminiProvider(BaseProvider):
-    def __init__(self, api_key, model=None):
-        import google.generativeai as genai
-        genai.configure(api_key=api_key)
-        self.genai = genai
-        # Default to latest Gemini 2.5 Flash preview
-        self.model = model or "gemini-2.5-flash-preview-05-20"
-
-    def classify(self, text, tags_list):
-        system_prompt, user_prompt = build_classification_prompts(text, tags_list)
-        response = self.genai.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"author": "system", "content": system_prompt},
-                {"author": "user", "content": user_prompt}
-            ],
-            temperature=0
-        )
-        content = response.choices[0].message.content.strip()
-        try:
-            tags = json.loads(content)
-            return [t for t in tags if t in tags_list]
-        except Exception:
-            print(f"Warning: failed to parse JSON response: {content}", file=sys.stderr)
-            return []
-
-class OllamaProvider(BaseProvider):
-    def __init__(self, model=None):
-        # Default to latest Llama 4 model
-        self.model = model or "llama4"
-
-    def classify(self, text, tags_list):
-        system_prompt, user_prompt = build_classification_prompts(text, tags_list)
-        prompt = system_prompt + "\n" + user_prompt
-        try:
-            result = subprocess.run(
-                ["ollama", "run", self.model, "--prompt", prompt],
-                capture_output=True, check=True, text=True
-            )
-            content = result.stdout.strip()
-            tags = json.loads(content)
-            return [t for t in tags if t in tags_list]
-        except subprocess.CalledProcessError as e:
-            print(f"Error running ollama: {e}", file=sys.stderr)
-            return []
-        except Exception:
-            print(f"Warning: failed to parse JSON response: {result.stdout}", file=sys.stderr)
-            return []
+    return Taxonomy(tags)
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -152,11 +56,12 @@ def parse_args():
     )
     parser.add_argument(
         "--provider",
-        choices=["openai", "gemini", "ollama", "embedding"],
+        choices=provider_names(COMPLETION) + ["embedding", "lexical"],
         default="openai",
         help=(
             "Which provider to use: openai (completion), gemini (completion), ollama (completion), "
-            "or embedding (embedding-based classification). "
+            "embedding (embedding-based classification), "
+            "or lexical (local classifier trained on the vault's confirmed notes, no API). "
             "For embedding, use --embed-provider and --embed-model to select the embedding service and model."
         )
     )
@@ -166,7 +71,7 @@ def parse_args():
     )
     parser.add_argument(
         "--embed-provider",
-        choices=["openai", "gemini", "ollama"],
+        choices=provider_names(EMBEDDING),
         default="openai",
         help="Embedding provider to use when --provider is 'embedding' (openai, gemini, or ollama)."
     )
@@ -174,10 +79,29 @@ def parse_args():
         "--embed-model",
         help="Embedding model identifier for the chosen embedding provider. Overrides --model when embedding."
     )
+    parser.add_argument(
+        "--embedding-cache",
+        help="Directory of the on-disk embedding store used by the embedding provider "
+             "(default: .cache/embeddings next to this script)."
+    )
+    parser.add_argument(
+        "--no-embedding-cache",
+        action="store_true",
+        help="Always call the embedding API instead of reading cached tag/note embeddings."
+    )
     parser.add_argument(
         "--api-key",
         help="API key for OpenAI or Google (Gemini)."
     )
+    parser.add_argument(
+        "--ollama-host",
+        help="Ollama server URL (default: $OLLAMA_HOST or http://localhost:11434)."
+    )
+    parser.add_argument(
+        "--ollama-keep-alive",
+        default=DEFAULT_KEEP_ALIVE,
+        help=f"How long Ollama keeps the model loaded between requests (default: {DEFAULT_KEEP_ALIVE})."
+    )
     parser.add_argument(
         "--input-dir",
         required=True,
@@ -198,98 +122,979 @@ def parse_args():
         default=10,
         help="Number of files to process in dry-run mode (default: 10)."
     )
+    parser.add_argument(
+        "--manifest",
+        help="Vault state manifest used to skip unchanged notes "
+             "(default: .cache/manifest_<hash of input dir>.json next to this script)."
+    )
+    parser.add_argument(
+        "--full-scan",
+        action="store_true",
+        help="Ignore the manifest and re-read every note (the manifest is rebuilt)."
+    )
+    parser.add_argument(
+        "--manifest-save-every",
+        type=int,
+        default=50,
+        help="Save the manifest after this many processed notes so interrupted runs resume (default: 50)."
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="After the initial run keep running: tag new or modified notes in debounced micro-batches "
+             "and accept triggers on a local HTTP port."
+    )
+    parser.add_argument(
+        "--watch-mode",
+        choices=["auto", "events", "poll"],
+        default="auto",
+        help="How --watch detects changes: filesystem events (needs the watchdog package), polling, "
+             "or auto (polling for WSL/network mounts such as /mnt/c, events otherwise)."
+    )
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=5.0,
+        help="Seconds between vault polls in --watch poll mode (default: 5)."
+    )
+    parser.add_argument(
+        "--watch-debounce",
+        type=float,
+        default=2.0,
+        help="Seconds without further changes before a micro-batch is processed (default: 2)."
+    )
+    parser.add_argument(
+        "--watch-port",
+        type=int,
+        default=DEFAULT_WATCH_PORT,
+        help=f"Localhost port of the --watch trigger server (/scan, /tag?path=..., /status); "
+             f"0 disables it (default: {DEFAULT_WATCH_PORT})."
+    )
+    parser.add_argument(
+        "--update-index",
+        action="store_true",
+        help="Keep static index pages (generate_index.py --static) up to date with the notes "
+             "tagged in this run; only pages whose content changed are rewritten."
+    )
+    parser.add_argument(
+        "--index-dir",
+        help="Directory of the index pages for --update-index (default: <input-dir>/00_index)."
+    )
+    parser.add_argument(
+        "--report",
+        help="Write a JSON run report (stage timings, provider latency, tokens, estimated cost) to this file."
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        help="Write run metrics in Prometheus text format to this file "
+             "(e.g. for the node_exporter textfile collector)."
+    )
+    parser.add_argument(
+        "--profile",
+        help="Profile the main thread with cProfile and write the stats to this file."
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Trace memory allocations (tracemalloc) and add peak usage and top allocation sites to the report."
+    )
+    parser.add_argument(
+        "--scan-workers",
+        type=int,
+        default=8,
+        help="Threads reading note headers ahead of classification (default: 8)."
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of notes classified in parallel (default: 1 = sequential)."
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        help="Requests-per-minute budget shared by all workers (default depends on provider; 0 = unlimited)."
+    )
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        help="Tokens-per-minute budget shared by all workers (default depends on provider; 0 = unlimited)."
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=5,
+        help="Retries with jittered exponential backoff on 429s, 5xx and timeouts (default: 5)."
+    )
+    parser.add_argument(
+        "--embed-batch-size",
+        type=int,
+        default=64,
+        help="Notes classified per batched embedding call when --provider is 'embedding' (default: 64)."
+    )
+    parser.add_argument(
+        "--batch-mode",
+        choices=["write", "submit", "poll", "ingest"],
+        help=(
+            "Bulk batch-job mode for openai/gemini completion: "
+            "write = write classification requests for pending notes to --batch-file; "
+            "submit = write them and upload every request not yet submitted as an OpenAI batch job; "
+            "poll = check the submitted jobs and ingest the results of those that are done; "
+            "ingest = apply tags from a local results file (--batch-results)."
+        )
+    )
+    parser.add_argument(
+        "--batch-file",
+        default="tag_refiner_batch.jsonl",
+        help="Batch request JSONL file; its state is kept in <file>.state.json (default: tag_refiner_batch.jsonl)."
+    )
+    parser.add_argument(
+        "--batch-results",
+        help="Batch results JSONL file to ingest (default: <batch-file>.results.jsonl)."
+    )
+    parser.add_argument(
+        "--max-note-tokens",
+        type=int,
+        help="Token budget for a note's text sent to the provider; longer notes keep head, tail "
+             "and sampled middle paragraphs (default depends on provider; 0 = no cap)."
+    )
+    parser.add_argument(
+        "--raw-notes",
+        action="store_true",
+        help="Send note bodies as-is instead of stripping data URIs, HTML, link targets, long code blocks and link lists."
+    )
+    parser.add_argument(
+        "--no-structured-output",
+        action="store_true",
+        help="Do not request JSON-schema constrained answers (for models or Ollama servers without "
+             "structured output); answers are then parsed leniently and end at the closing bracket."
+    )
+    parser.add_argument(
+        "--pack-size",
+        type=int,
+        default=1,
+        help="Maximum number of notes classified per completion request (default: 1 = one note per call)."
+    )
+    parser.add_argument(
+        "--pack-token-budget",
+        type=int,
+        default=12000,
+        help="Maximum tokens of note text packed into one completion request (default: 12000)."
+    )
+    parser.add_argument(
+        "--hierarchical",
+        action="store_true",
+        help="Walk the tag tree level by level: pick top-level categories first, then only "
+             "prompt/score the children of the chosen branches."
+    )
+    parser.add_argument(
+        "--beam-width",
+        type=int,
+        default=2,
+        help="Branches kept per level in --hierarchical mode (default: 2)."
+    )
+    parser.add_argument(
+        "--cascade",
+        action="store_true",
+        help="Classify by embedding similarity first (--embed-provider/--embed-model) and only call "
+             "the completion provider when the best tag does not lead the runner-up by --cascade-margin."
+    )
+    parser.add_argument(
+        "--cascade-margin",
+        type=float,
+        default=0.02,
+        help="Cosine-similarity lead of the best tag over the runner-up needed to skip the "
+             "completion call in --cascade mode (default: 0.02)."
+    )
+    parser.add_argument(
+        "--knn",
+        action="store_true",
+        help="Tag notes by a vote of their nearest already-tagged notes and only call the provider "
+             "when the vote is not confident. Notes are embedded with --embed-provider/--embed-model."
+    )
+    parser.add_argument(
+        "--knn-index",
+        help="Directory of the kNN note index (default: .cache/neighbors/<hash of vault and embedding model>)."
+    )
+    parser.add_argument(
+        "--knn-k",
+        type=int,
+        default=10,
+        help="Number of neighbours consulted per note in --knn mode (default: 10)."
+    )
+    parser.add_argument(
+        "--knn-min-similarity",
+        type=float,
+        default=0.85,
+        help="Cosine similarity a neighbour needs to take part in the vote (default: 0.85)."
+    )
+    parser.add_argument(
+        "--knn-seed",
+        action="store_true",
+        help="Before classifying, add every note that already has tags and "
+             "'tag_revision_needed: false' to the kNN index."
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="Carry tagged notes over to an edited tags file: rewrite renamed/moved tags in place and "
+             "only classify notes that lost a removed tag or may belong to an added tag."
+    )
+    parser.add_argument(
+        "--migrate-from",
+        help="Previous tags file to diff against in --migrate mode (default: the taxonomy snapshot "
+             "saved when the vault was last tagged or migrated)."
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Give notes that duplicate an already-tagged note (same source URL, same text or "
+             "near-identical MinHash signature) that note's tags without calling the provider."
+    )
+    parser.add_argument(
+        "--dedup-index",
+        help="Directory of the duplicate index (default: .cache/duplicates/<hash of vault>)."
+    )
+    parser.add_argument(
+        "--dedup-threshold",
+        type=float,
+        default=0.8,
+        help="Estimated Jaccard similarity of character shingles above which two notes count as "
+             "near-duplicates (default: 0.8)."
+    )
+    parser.add_argument(
+        "--dedup-seed",
+        action="store_true",
+        help="Before classifying, add every note that already has tags and "
+             "'tag_revision_needed: false' to the duplicate index."
+    )
+    parser.add_argument(
+        "--lexical-model",
+        help="Directory of the lexical classifier model for --provider lexical "
+             "(default: .cache/lexical/<vault hash> next to this script)."
+    )
+    parser.add_argument(
+        "--lexical-train",
+        action="store_true",
+        help="Before classifying, train the lexical classifier on notes with 'tag_revision_needed: false' "
+             "that are new or changed since it last trained (a new model always trains)."
+    )
+    parser.add_argument(
+        "--lexical-rebuild",
+        action="store_true",
+        help="Discard the saved lexical classifier and train a new one on all confirmed notes."
+    )
     return parser.parse_args()
 
-def process_file(path, provider, tags_list, dry_run=False):
-    with open(path, 'r', encoding='utf-8') as f:
-        text = f.read()
-    if text.startswith('---'):
-        parts = text.split('---', 2)
-        fm_text = parts[1]
-        body = parts[2]
-    else:
-        fm_text = ''
-        body = text
-    
-    # parse existing frontmatter
-    if fm_text:
+def run_notes(paths, handle, concurrency=1, on_done=None):
+    """
+    Run handle(path) for every path (or group of paths), sequentially or on a thread pool.
+    `paths` may be a lazy iterable: at most 2 * concurrency items are taken
+    ahead of the workers, so processing starts while discovery continues.
+    A failing note is reported and skipped; on_done(count) is called from the
+    calling thread after each finished note. Each path is handled by exactly
+    one worker, so frontmatter writes never race.
+    """
+    def safe_handle(path):
         try:
-            fm_dict = yaml.safe_load(fm_text) or {}
+            handle(path)
         except Exception as e:
-            print(f"Warning: failed to parse YAML in {path}: {e}", file=sys.stderr)
-            fm_dict = {}
-    else:
-        fm_dict = {}
-    
-    # check if tag revision checkbox exists - if so, skip tagging
-    if 'tag_revision_needed' in fm_dict:
-        print(f"Skipping {path}: tag revision checkbox found")
+            count('notes_failed')
+            print(f"Error processing {path}: {e}", file=sys.stderr)
+
+    if concurrency <= 1:
+        for i, path in enumerate(paths, 1):
+            safe_handle(path)
+            if on_done:
+                on_done(i)
+        return
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    finished_count = 0
+
+    def finished(futures):
+        nonlocal finished_count
+        for _ in futures:
+            finished_count += 1
+            if on_done:
+                on_done(finished_count)
+
+    try:
+        running = set()
+        for path in paths:
+            running.add(executor.submit(safe_handle, path))
+            if len(running) >= 2 * concurrency:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                finished(done)
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            finished(done)
+    finally:
+        # On interruption let in-flight writes finish but drop queued notes
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def batched(items, size):
+    """Group an iterable into lists of at most `size` items."""
+    items = iter(items)
+    while True:
+        group = list(islice(items, size))
+        if not group:
+            return
+        yield group
+
+class Note:
+    """
+    A note read for classification. `body` is the text to classify; `data`
+    holds the raw file contents, except for notes larger than the read limit,
+    whose body is only a head/tail sample and is streamed through on rewrite.
+    """
+    def __init__(self, path, header, body, digest, data=None):
+        self.path = path
+        self.header = header
+        self.fm_dict = header.fm_dict
+        self.body = body
+        self.digest = digest
+        self.data = data
+
+    @property
+    def complete(self):
+        return self.data is not None
+
+def skip_note(path, header, manifest=None, tax_hash=None):
+    """
+    True (and the skip recorded) if the note's header has the tag revision
+    checkbox, i.e. it was tagged before or is left to the user.
+    """
+    if 'tag_revision_needed' not in header.fm_dict:
         return False
-    
-    # classify based on body
-    content_for_classify = body.strip()
-    tags = provider.classify(content_for_classify, tags_list)
+    print(f"Skipping {path}: tag revision checkbox found")
+    count('notes_skipped')
+    if manifest is not None:
+        # Not hashed: the stat data is enough to skip it next time
+        manifest.record(path, None, 'skipped', header.fm_dict.get('tags'), tax_hash)
+    return True
+
+class ScannedNote(namedtuple('ScannedNote', ['path', 'header'])):
+    """A note path with the header read during the scan (None if it could not be read); prints as its path."""
+    __slots__ = ()
+
+    def __str__(self):
+        return self.path
+
+    def __repr__(self):
+        return repr(self.path)
+
+class VaultScan:
+    """
+    Lazily yields the notes of a run that need classification as
+    ScannedNotes. Notes whose stat data matches the manifest are skipped
+    without being opened; the headers of the rest are read ahead on
+    `workers` threads, notes with a tag revision checkbox are skipped there
+    and the others keep their header for load_note(). `seen` lists every note found,
+    and `complete` is set once the whole vault was scanned. `notes` replaces
+    the vault walk with given (path, stat_result) pairs.
+    """
+    def __init__(self, root, manifest, tax_hash=None, record_manifest=None, workers=8, limit=None,
+                 notes=None):
+        self.root = root
+        self.notes = notes
+        self.manifest = manifest
+        self.tax_hash = tax_hash
+        self.record_manifest = record_manifest
+        self.workers = workers
+        self.limit = limit
+        self.seen = []
+        self.unchanged = 0
+        self.skipped = 0
+        self.complete = False
+
+    def candidates(self):
+        notes = timed_iter('discovery', iter_notes(self.root)) if self.notes is None else self.notes
+        for path, st in notes:
+            self.seen.append(path)
+            if self.manifest.is_unchanged(path, st):
+                self.unchanged += 1
+                continue
+            yield path
+        self.complete = self.notes is None
+
+    def __iter__(self):
+        candidates = self.candidates()
+        if self.limit is not None:
+            candidates = islice(candidates, self.limit)
+        for path, header in prefetch(candidates, read_note_header, self.workers):
+            # Unreadable headers are read again and reported by the worker that loads the note
+            if isinstance(header, Exception):
+                header = None
+            elif skip_note(path, header, self.record_manifest, self.tax_hash):
+                self.skipped += 1
+                continue
+            yield ScannedNote(path, header)
+
+def read_note_header(path):
+    with stage('frontmatter'):
+        return read_header(path)
+
+def load_note(path, manifest=None, tax_hash=None, max_bytes=LARGE_NOTE_BYTES, header=None):
+    """
+    Read a note and decide whether it needs tagging. `header` is the
+    note's header if the scan already read it (it is not read again).
+    Returns a Note, or None when the note is skipped.
+    """
+    # The skip decision needs only the header bytes
+    if header is None:
+        header = read_note_header(path)
+    if skip_note(path, header, manifest, tax_hash):
+        return None
+    with stage('read'):
+        head, tail, digest = read_head_tail(path, max_bytes)
+    # Touched but unchanged notes only need their stat data refreshed
+    if manifest is not None and manifest.same_content(path, digest):
+        manifest.touch(path, os.stat(path))
+        return None
+    return parse_note(path, head, tail, digest, header)
+
+def read_note(path, max_bytes=LARGE_NOTE_BYTES):
+    """Read a note regardless of its tag revision checkbox (e.g. to migrate its tags)."""
+    with stage('read'):
+        return parse_note(path, *read_head_tail(path, max_bytes))
+
+def parse_note(path, head, tail, digest, header=None):
+    """Note from the bytes returned by read_head_tail; `header` is reused if the file did not change."""
+    # Locate the header in the same bytes as the body in case the file changed
+    # since `header` was read; only a changed header is parsed again
+    found = find_header(head)
+    if header is None or found != (header.text, header.body_offset, header.newline):
+        header = read_header(path, head)
+    body = head[header.body_offset:]
+    if tail is None:
+        return Note(path, header, body.decode('utf-8').replace('\r\n', '\n'), digest, head)
+    # Large note: classify a head/tail sample, copy the real body on rewrite
+    # (decoding drops a multi-byte character cut at the sample boundary)
+    sample = body.decode('utf-8', errors='ignore').lstrip() + OMISSION_MARKER + tail.decode('utf-8', errors='ignore')
+    return Note(path, header, sample, digest)
+
+def apply_tags(path, note, tags, dry_run=False, manifest=None, tax_hash=None, fallback=None):
+    """
+    Write classified tags into the note's frontmatter, patching only the
+    tags and tag_revision_needed keys. A note left without tags gets the
+    taxonomy's `fallback` tag (if any) and its revision checkbox ticked.
+    Returns True if it changed.
+    """
+    revision_needed = not tags
     if not tags:
-        tags = ['misc/uncategorized']
-    
+        tags = [fallback] if fallback else []
+
     # add tag revision checkbox to frontmatter
-    fm_dict['tags'] = tags
-    fm_dict['tag_revision_needed'] = False
-    
-    new_fm = yaml.safe_dump(fm_dict, allow_unicode=True, sort_keys=False).strip()
-    new_text = f"---\n{new_fm}\n---\n{body.lstrip()}"
-    if text != new_text:
-        print(f"Updating {path}: {tags}")
+    header = build_header(note.header, {'tags': tags, 'tag_revision_needed': revision_needed})
+    if note.complete and note.data[:note.header.body_offset] == header:
+        return False
+    print(f"Updating {path}: {tags}")
+    count('notes_tagged')
+    if not dry_run:
+        with stage('write'):
+            digest = replace_header(path, header, note.header.body_offset, note.data)
+        if manifest is not None:
+            manifest.record(path, digest, 'tagged', tags, tax_hash)
+    return True
+
+def classification_input(note, prepare=None):
+    """Text sent to the provider for a note (cleaned and token-capped by `prepare`)."""
+    body = note.body.strip()
+    return prepare(body) if prepare else body
+
+def reuse_duplicates(notes, texts, tags_list, dedup=None):
+    """Tags inherited from already-tagged duplicates, per (path, note); None where there is none."""
+    if dedup is None:
+        return [None] * len(notes)
+    with stage('dedup'):
+        return [dedup.lookup(path, text, note.fm_dict, tags_list) for (path, note), text in zip(notes, texts)]
+
+def process_file(path, provider, tags_list, dry_run=False, manifest=None, tax_hash=None, prepare=None,
+                 on_tagged=None, dedup=None, header=None):
+    note = load_note(path, manifest, tax_hash, header=header)
+    if note is None:
+        return False
+    # classify based on body
+    content_for_classify = classification_input(note, prepare)
+    tags = reuse_duplicates([(path, note)], [content_for_classify], tags_list, dedup)[0]
+    if tags is None:
+        with stage('classify'):
+            tags = provider.classify(content_for_classify, tags_list)
+    changed = apply_tags(path, note, tags, dry_run, manifest, tax_hash, as_taxonomy(tags_list).fallback)
+    if on_tagged and tags:
+        on_tagged(path, content_for_classify, tags)
+    return changed
+
+def _load_batch(scanned, manifest, tax_hash, prepare, tags_list, dedup):
+    """
+    Load a batch of ScannedNotes for classification. Returns (notes, texts,
+    results, fallback): the (path, note) pairs that need tags, their
+    classification inputs, tags reused from duplicates (None where the
+    provider must decide) and the taxonomy's fallback tag.
+    """
+    notes = []
+    for path, header in scanned:
+        try:
+            note = load_note(path, manifest, tax_hash, header=header)
+        except Exception as e:
+            print(f"Error processing {path}: {e}", file=sys.stderr)
+            continue
+        if note is not None:
+            notes.append((path, note))
+    texts = [classification_input(note, prepare) for _, note in notes]
+    results = reuse_duplicates(notes, texts, tags_list, dedup)
+    return notes, texts, results, as_taxonomy(tags_list).fallback
+
+def _apply_batch(notes, texts, results, fallback, dry_run, manifest, tax_hash, on_tagged):
+    """Write each note's tags, skipping notes left unclassified (None); returns how many changed."""
+    changed = 0
+    for (path, note), text, tags in zip(notes, texts, results):
+        if tags is None:
+            continue
+        changed += apply_tags(path, note, tags, dry_run, manifest, tax_hash, fallback)
+        if on_tagged and tags:
+            on_tagged(path, text, tags)
+    return changed
+
+def process_batch(scanned, provider, tags_list, dry_run=False, manifest=None, tax_hash=None, prepare=None,
+                  on_tagged=None, dedup=None):
+    """
+    Classify several notes (ScannedNotes) with one batched embedding call
+    (provider.classify_batch) and write each note's tags.
+    on_tagged(path, text, tags) is called for every tagged note.
+    """
+    notes, texts, results, fallback = _load_batch(scanned, manifest, tax_hash, prepare, tags_list, dedup)
+    todo = [i for i, tags in enumerate(results) if tags is None]
+    if todo:
+        with stage('classify_batch'):
+            for i, tags in zip(todo, provider.classify_batch([texts[i] for i in todo], tags_list)):
+                results[i] = tags
+    return _apply_batch(notes, texts, results, fallback, dry_run, manifest, tax_hash, on_tagged)
+
+def process_packed(scanned, provider, tags_list, dry_run=False, manifest=None, tax_hash=None,
+                   prepare=None, pack_tokens=None, on_tagged=None, dedup=None):
+    """
+    Classify several short notes (ScannedNotes) per completion request
+    (provider.classify_packed), packing notes into requests of at most
+    pack_tokens tokens of note text. Notes whose packed answer does not
+    validate fall back to single-note calls.
+    """
+    notes, texts, results, fallback = _load_batch(scanned, manifest, tax_hash, prepare, tags_list, dedup)
+    todo = [i for i, tags in enumerate(results) if tags is None]
+    from embedding_batcher import pack_batches
+    for pack in pack_batches([estimate_tokens(texts[i]) for i in todo], len(todo), pack_tokens):
+        if len(pack) < 2:
+            continue
+        pack = [todo[j] for j in pack]
+        ids = [f"n{j + 1}" for j in range(len(pack))]
+        try:
+            with stage('classify_packed'):
+                packed = provider.classify_packed([(nid, texts[i]) for nid, i in zip(ids, pack)], tags_list)
+        except Exception as e:
+            print(f"Warning: packed request failed, falling back to single notes: {e}", file=sys.stderr)
+            packed = {}
+        for nid, i in zip(ids, pack):
+            results[i] = packed.get(nid)
+        missing = sum(1 for nid in ids if nid not in packed)
+        if missing:
+            print(f"Packed request resolved {len(pack) - missing}/{len(pack)} notes; "
+                  f"classifying {missing} individually")
+    for i, tags in enumerate(results):
+        if tags is None:
+            try:
+                with stage('classify'):
+                    results[i] = provider.classify(texts[i], tags_list)
+            except Exception as e:
+                print(f"Error processing {notes[i][0]}: {e}", file=sys.stderr)
+    return _apply_batch(notes, texts, results, fallback, dry_run, manifest, tax_hash, on_tagged)
+
+def iter_tagged_notes(paths, tags_list, prepare=None, known=None):
+    """
+    Yield (path, fm_dict, text, tags) for notes that already carry tags and
+    'tag_revision_needed: false'; `text` is prepared like a classification
+    input and `tags` keeps only tags of the taxonomy. Paths for which
+    known(path) is true are skipped without being read.
+    """
+    valid = set(tags_list)
+    for path in paths:
+        if known is not None and known(path):
+            continue
+        try:
+            fm_dict = read_header(path).fm_dict
+            tags = fm_dict.get('tags')
+            if fm_dict.get('tag_revision_needed') is not False or not isinstance(tags, list):
+                continue
+            tags = [t for t in tags if t in valid]
+            if not tags:
+                continue
+            head, tail, _ = read_head_tail(path)
+            body = head[read_header(path, head).body_offset:]
+        except (OSError, ValueError) as e:
+            print(f"Warning: cannot read {path}: {e}", file=sys.stderr)
+            continue
+        body = body.decode('utf-8', errors='ignore').replace('\r\n', '\n').strip()
+        if tail is not None:
+            body += OMISSION_MARKER + tail.decode('utf-8', errors='ignore')
+        yield path, fm_dict, prepare(body) if prepare else body, tags
+
+def seed_neighbor_index(paths, knn, tags_list, key, prepare=None, batch_size=64):
+    """
+    Add notes that already carry tags and 'tag_revision_needed: false' to the
+    kNN index. Notes already in the index are skipped. Returns the number added.
+    """
+    added = 0
+    for batch in batched(iter_tagged_notes(paths, tags_list, prepare, lambda path: key(path) in knn.index.rows),
+                         batch_size):
+        vectors = knn.embedder.embed_many([text for _, _, text, _ in batch])
+        for (path, _, _, tags), vec in zip(batch, vectors):
+            knn.index.add(key(path), vec, tags)
+        added += len(batch)
+    return added
+
+def seed_duplicate_index(paths, dedup, tags_list, prepare=None):
+    """
+    Fingerprint notes that already carry tags and 'tag_revision_needed: false'
+    into the duplicate index. Notes already indexed are skipped. Returns the number added.
+    """
+    added = 0
+    for path, fm_dict, text, tags in iter_tagged_notes(paths, tags_list, prepare,
+                                                       lambda path: dedup.key(path) in dedup.index.rows):
+        dedup.note_tagged(path, text, tags, fm_dict)
+        added += 1
+    return added
+
+def note_version(path):
+    """Stat data identifying the current version of a note file."""
+    st = os.stat(path)
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+def train_lexical(provider, paths, tags_list, key, prepare=None):
+    """
+    Train the lexical classifier on notes that carry tags and
+    'tag_revision_needed: false' and that it has not learned at their
+    current version. Returns the number of notes learned from.
+    """
+    classifier = provider.classifier
+
+    def known(path):
+        return classifier.trained.get(key(path)) == note_version(path)
+
+    examples = [(key(path), note_version(path), text, tags)
+                for path, _, text, tags in iter_tagged_notes(paths, tags_list, prepare, known)]
+    return classifier.update(examples)
+
+def ingest_batch_results(results_path, state, tags_list, root, dry_run=False, manifest=None, tax_hash=None,
+                         batch_id=None):
+    """
+    Apply tags from a batch results file to every note still pending in
+    `state` (only those of job `batch_id` if given). Notes edited since
+    their request was written are marked 'changed' so the next write
+    queues them again.
+    """
+    applied = failed = 0
+    for custom_id, content, error in read_results(results_path, state.data['format']):
+        req = state.requests.get(custom_id)
+        if req is None or req['status'] != 'pending' or (batch_id is not None and req['batch'] != batch_id):
+            continue
+        path = os.path.join(root, req['path'])
+        tags = None if content is None else parse_tags_response(content.strip(), tags_list)
+        if tags is None:
+            print(f"Warning: batch request failed for {path}: {error or content}", file=sys.stderr)
+            if not dry_run:
+                req['status'] = 'failed'
+            failed += 1
+            continue
+        try:
+            note = load_note(path, manifest, tax_hash)
+        except (OSError, ValueError) as e:
+            print(f"Warning: cannot read {path}: {e}", file=sys.stderr)
+            continue
+        if note is not None and note.digest != req['hash']:
+            print(f"Warning: {path} changed after its batch request was written; queued again", file=sys.stderr)
+            if not dry_run:
+                req['status'] = 'changed'
+            failed += 1
+            continue
+        # Notes tagged by other means since the batch was written count as applied
+        if note is not None:
+            apply_tags(path, note, tags, dry_run, manifest, tax_hash, as_taxonomy(tags_list).fallback)
         if not dry_run:
-            with open(path, 'w', encoding='utf-8') as f:
-                f.write(new_text)
-        return True
-    return False
+            req['status'] = 'applied'
+        applied += 1
+    return applied, failed
+
+def retag_note(path, note, tags, dry_run=False, manifest=None, tax_hash=None):
+    """Rewrite only the tags of a note, keeping its tag revision checkbox. Returns True if it changed."""
+    header = build_header(note.header, {'tags': tags})
+    if note.complete and note.data[:note.header.body_offset] == header:
+        return False
+    print(f"Migrating {path}: {tags}")
+    count('notes_migrated')
+    if not dry_run:
+        with stage('write'):
+            digest = replace_header(path, header, note.header.body_offset, note.data)
+        if manifest is not None:
+            manifest.record(path, digest, 'tagged', tags, tax_hash)
+    return True
+
+def notes_near_added(added, tags_by_note, root, tags_list, embedder=None, prepare=None):
+    """
+    Vault-relative paths of tagged notes that may belong to a newly added tag.
+    A note whose embedding is in the embedder's store qualifies when an added
+    tag is at least as similar to it as its least similar current tag; notes
+    without a stored embedding qualify when they carry a sibling of an added tag.
+    """
+    if not added:
+        return []
+    from similarity import as_matrix, normalize_rows
+    parents = {tag.rpartition('/')[0] for tag in added}
+    store = getattr(embedder, 'store', None)
+    if store is not None:
+        used = sorted({t for tags in tags_by_note.values() for t in tags if t in tags_list} | set(added))
+        # Only the added tags are usually missing from the store
+        tag_matrix = normalize_rows(as_matrix(embedder.embed_many(used)))
+        tag_rows = {tag: i for i, tag in enumerate(used)}
+        added_rows = [tag_rows[t] for t in added]
+    near = []
+    for key, tags in tags_by_note.items():
+        vec = None
+        if store is not None:
+            try:
+                note = read_note(os.path.join(root, key))
+                vec = store.get_many([classification_input(note, prepare)])[0]
+            except (OSError, ValueError) as e:
+                print(f"Warning: cannot read {key}: {e}", file=sys.stderr)
+        if vec is not None and len(vec) == tag_matrix.shape[1]:
+            scores = tag_matrix @ normalize_rows(vec)[0]
+            current = [scores[tag_rows[t]] for t in tags if t in tag_rows]
+            if current and scores[added_rows].max() >= min(current):
+                near.append(key)
+        elif any(t.rpartition('/')[0] in parents for t in tags):
+            near.append(key)
+    return near
+
+def run_migration(args, provider, tags_list, manifest, tax_hash, prepare=None, embedder=None):
+    """
+    Carry tagged notes over to an edited taxonomy. Renamed and moved tags are
+    rewritten in the frontmatter without a model call; only notes that lost a
+    removed tag, or that may belong to an added tag, are classified again.
+    """
+    snapshot_path = default_snapshot_path(args.input_dir)
+    try:
+        old = load_tags_file(args.migrate_from) if args.migrate_from else load_snapshot(snapshot_path)
+    except Exception as e:
+        print(f"Error loading tags file {args.migrate_from}: {e}", file=sys.stderr)
+        sys.exit(1)
+    if old is None:
+        print('Error: no taxonomy snapshot for this vault yet; pass the previous tags file with --migrate-from.',
+              file=sys.stderr)
+        sys.exit(1)
+    diff = diff_taxonomies(old, tags_list)
+    for line in diff.describe():
+        print(line)
+    # The tag index tells which notes carry which tags without reading every note
+    tag_index = TagIndex(default_tag_index_path(args.input_dir), args.input_dir)
+    tag_index.refresh(workers=args.scan_workers)
+    migrated, lost = {}, set()
+    for key, entry in tag_index.entries.items():
+        tags, removed = diff.migrate(entry['tags'])
+        migrated[key] = tags
+        if removed:
+            lost.add(key)
+    changed = sorted(key for key, tags in migrated.items() if tags != tag_index.entries[key]['tags'])
+    tagged = {key: tags for key, tags in migrated.items()
+              if key not in lost and any(t in tags_list for t in tags)}
+    near = notes_near_added(diff.added, tagged, args.input_dir, tags_list, embedder, prepare)
+    print(f"Notes with renamed or removed tags: {len(changed)}; to classify again: "
+          f"{len(lost)} that lost a tag, {len(near)} near an added tag")
+    if args.dry_run:
+        for key in sorted(lost) + near:
+            print(f"Would classify {key}")
+        return
+    touched = []
+    for key in changed:
+        path = os.path.join(args.input_dir, key)
+        try:
+            retag_note(path, read_note(path), migrated[key], manifest=manifest, tax_hash=tax_hash)
+            touched.append(path)
+        except (OSError, ValueError) as e:
+            print(f"Error migrating {path}: {e}", file=sys.stderr)
+    added = set(diff.added)
+    fallback = as_taxonomy(tags_list).fallback
+
+    def handle(path):
+        key = manifest.key(path)
+        note = read_note(path)
+        with stage('classify'):
+            result = provider.classify(classification_input(note, prepare), tags_list)
+        # Notes that only may fit a new tag keep their tags and gain at most new ones
+        kept = migrated[key]
+        extra = result if key in lost else [t for t in result if t in added]
+        apply_tags(path, note, kept + [t for t in extra if t not in kept], manifest=manifest,
+                   tax_hash=tax_hash, fallback=fallback)
+        touched.append(path)
+
+    try:
+        run_notes([os.path.join(args.input_dir, key) for key in sorted(lost) + near], handle,
+                  concurrency=args.concurrency)
+    finally:
+        manifest.save()
+        tag_index.update(touched)
+        tag_index.save()
+    save_snapshot(snapshot_path, tags_list)
+    instrumentation.write_reports()
+
+def run_batch_mode(args, provider, pending, tags_list, manifest, tax_hash, prepare=None):
+    """Write, submit, poll or ingest asynchronous classification batch jobs."""
+    state = BatchState(args.batch_file)
+    if state.data['format'] and state.data['format'] != args.provider:
+        print(f"Error: {args.batch_file} was written for {state.data['format']}", file=sys.stderr)
+        sys.exit(1)
+    run_manifest = None if args.dry_run else manifest
+    if args.batch_mode in ('write', 'submit'):
+        model = args.model or provider_class(COMPLETION, args.provider).default_model
+        submitted = {r['path'] for r in state.pending().values() if r['batch'] is not None}
+        unsubmitted = state.in_batch(None)
+        structured = args.provider == 'openai' and not args.no_structured_output
+        schema = as_taxonomy(tags_list).schema() if structured else None
+        # The batch file is rebuilt from every request not yet submitted, so requests
+        # written earlier are kept and carry their note's current content
+        todo = {r['path']: ScannedNote(os.path.join(args.input_dir, r['path']), None) for r in unsubmitted.values()}
+        for note in pending:
+            todo.setdefault(manifest.key(note.path), note)
+        lines = []
+        new = 0
+        for rel, (path, header) in todo.items():
+            if rel in submitted:
+                continue
+            custom_id = request_id(rel)
+            try:
+                note = load_note(path, run_manifest, tax_hash, header=header)
+            except (OSError, ValueError) as e:
+                print(f"Warning: cannot read {path}: {e}", file=sys.stderr)
+                note = None
+            if note is None:
+                # Tagged or removed since its request was written
+                if custom_id in unsubmitted:
+                    del state.requests[custom_id]
+                continue
+            system_prompt, user_prompt = build_classification_prompts(classification_input(note, prepare), tags_list)
+            lines.append(request_line(args.provider, custom_id, model, system_prompt, user_prompt, schema))
+            new += custom_id not in unsubmitted
+            state.requests[custom_id] = {'path': rel, 'hash': note.digest, 'status': 'pending', 'batch': None}
+        print(f"Batch requests not yet submitted: {len(lines)} (new: {new}, in submitted jobs: {len(submitted)})")
+        if args.dry_run:
+            return
+        state.data['format'] = args.provider
+        state.data['model'] = model
+        write_batch_file(args.batch_file, lines)
+        print(f"Wrote {args.batch_file}")
+        if args.batch_mode == 'submit' and lines:
+            batch_id = submit_openai_batch(provider.openai, args.batch_file)
+            for req in state.in_batch(None).values():
+                req['batch'] = batch_id
+            state.data['batch_ids'].append(batch_id)
+            print(f"Submitted batch job: {batch_id}")
+        state.save()
+        return
+    if args.batch_mode == 'poll':
+        if not state.data['batch_ids']:
+            print(f"Error: no submitted batch job recorded in {state.path}", file=sys.stderr)
+            sys.exit(1)
+        for batch_id in list(state.data['batch_ids']):
+            results_path = args.batch_results or f"{args.batch_file}.{batch_id}.results.jsonl"
+            status = poll_openai_batch(provider.openai, batch_id, results_path)
+            print(f"Batch job {batch_id}: {status}")
+            if status == 'completed':
+                applied, failed = ingest_batch_results(results_path, state, tags_list, args.input_dir,
+                                                       args.dry_run, run_manifest, tax_hash, batch_id)
+                print(f"Batch results applied: {applied}, failed: {failed}")
+            elif status not in ('failed', 'expired', 'cancelled'):
+                continue
+            if args.dry_run:
+                continue
+            # Requests the finished job returned no result for are queued again by the next write
+            for req in state.in_batch(batch_id).values():
+                req['status'] = 'failed'
+            state.data['batch_ids'].remove(batch_id)
+        print(f"Batch status: {state.counts()}, outstanding jobs: {len(state.data['batch_ids'])}")
+        if not args.dry_run:
+            state.save()
+        return
+    results_path = args.batch_results or f"{args.batch_file}.results.jsonl"
+    if not os.path.exists(results_path):
+        print(f"Error: batch results file not found: {results_path}", file=sys.stderr)
+        sys.exit(1)
+    applied, failed = ingest_batch_results(results_path, state, tags_list, args.input_dir,
+                                           args.dry_run, run_manifest, tax_hash)
+    print(f"Batch results applied: {applied}, failed: {failed}, status: {state.counts()}")
+    if not args.dry_run:
+        state.save()
+
+def build_embedding_provider(args):
+    """Construct the embedding provider selected by --embed-provider / --embed-model."""
+    # --model names the completion model unless classifying by embedding
+    embed_model = args.embed_model or (args.model if args.provider == 'embedding' else None)
+    return providers.build_embedding_provider(
+        args.embed_provider, embed_model, args.api_key, ollama_host=args.ollama_host,
+        keep_alive=args.ollama_keep_alive, pool_size=max(8, args.concurrency),
+        cache=not args.no_embedding_cache, cache_dir=args.embedding_cache)
+
+def build_lexical_provider(args):
+    """Load (or start) the lexical classifier selected by --lexical-model / --lexical-rebuild."""
+    from lexical_classifier import LexicalModel, LexicalProvider, default_model_dir
+    path = args.lexical_model or default_model_dir(args.input_dir)
+    return LexicalProvider(LexicalModel() if args.lexical_rebuild else LexicalModel.load(path), path)
+
+def build_provider(args):
+    """Construct the classification provider selected on the command line."""
+    if args.provider == 'embedding':
+        return build_embedding_provider(args)
+    if args.provider == 'lexical':
+        return build_lexical_provider(args)
+    return build_completion_provider(args.provider, args.model, args.api_key, ollama_host=args.ollama_host,
+                                     keep_alive=args.ollama_keep_alive, pool_size=max(8, args.concurrency),
+                                     structured_output=not args.no_structured_output)
 
 def main():
     args = parse_args()
-    if args.provider == 'openai':
-        api_key = args.api_key or os.environ.get('OPENAI_API_KEY')
-        if not api_key:
-            print('Error: OpenAI API key is required.', file=sys.stderr)
+    instrumentation.configure('tag_refiner', report=args.report, textfile=args.metrics_textfile,
+                              profile=args.profile, trace_memory=args.trace_memory)
+    if args.watch and args.batch_mode:
+        print('Error: --watch cannot be combined with --batch-mode.', file=sys.stderr)
+        sys.exit(1)
+    if args.migrate and (args.watch or args.batch_mode):
+        print('Error: --migrate cannot be combined with --watch or --batch-mode.', file=sys.stderr)
+        sys.exit(1)
+    if args.hierarchical and args.provider == 'lexical':
+        print('Error: --hierarchical is not supported with --provider lexical.', file=sys.stderr)
+        sys.exit(1)
+    if args.batch_mode:
+        if args.provider not in BATCH_FORMATS:
+            print(f"Error: --batch-mode supports providers: {', '.join(BATCH_FORMATS)}", file=sys.stderr)
             sys.exit(1)
-        provider = OpenAIProvider(api_key, args.model)
-    elif args.provider == 'embedding':
-        embed_provider = args.embed_provider
-        embed_model = args.embed_model or args.model
-        if embed_provider == 'openai':
-            api_key = args.api_key or os.environ.get('OPENAI_API_KEY')
-            if not api_key:
-                print('Error: OpenAI API key is required for embedding provider.', file=sys.stderr)
-                sys.exit(1)
-            provider = OpenAIEmbeddingProvider(api_key, embed_model)
-        elif embed_provider == 'gemini':
-            api_key = args.api_key or os.environ.get('GOOGLE_API_KEY')
-            if not api_key:
-                print('Error: Google API key is required for Gemini embedding provider.', file=sys.stderr)
+        # Writing and ingesting batch files needs no API client
+        provider = None
+        if args.batch_mode in ('submit', 'poll'):
+            if args.provider != 'openai':
+                print('Error: --batch-mode submit/poll is only available for openai.', file=sys.stderr)
                 sys.exit(1)
-            provider = GeminiEmbeddingProvider(api_key, embed_model)
-        elif embed_provider == 'ollama':
-            provider = OllamaEmbeddingProvider(embed_model)
-        else:
-            print(f"Error: unsupported embedding provider: {embed_provider}", file=sys.stderr)
-            sys.exit(1)
-    elif args.provider == 'gemini':
-        api_key = args.api_key or os.environ.get('GOOGLE_API_KEY')
-        if not api_key:
-            print('Error: Google API key is required for Gemini.', file=sys.stderr)
-            sys.exit(1)
-        provider = GeminiProvider(api_key, args.model)
+            provider = build_provider(args)
     else:
-        provider = OllamaProvider(args.model)
+        provider = build_provider(args)
     # Load tag taxonomy from YAML
     tags_file = args.tags_file or os.path.join(os.path.dirname(__file__), 'tags.yml')
     # Print configuration details
     print("=== Tag Refiner Configuration ===")
     print(f"Provider: {args.provider}")
-    if args.provider == 'embedding':
+    if args.batch_mode:
+        print(f"Batch mode: {args.batch_mode}, batch file: {args.batch_file}")
+    elif args.provider == 'embedding':
         print(f"Embedding provider: {args.embed_provider}")
         print(f"Embedding model: {provider.model}")
+        print(f"Embedding cache: {'disabled' if provider.store is None else provider.store.path}")
+    elif args.provider == 'lexical':
+        print(f"Lexical model: {provider.path} ({len(provider.classifier.trained)} notes trained)")
     else:
         print(f"Completion model: {provider.model}")
     print(f"Tags file: {tags_file}")
@@ -300,26 +1105,271 @@ def main():
     except Exception as e:
         print(f"Error loading tags file {tags_file}: {e}", file=sys.stderr)
         sys.exit(1)
-    # Collect markdown files
-    markdown_files = []
-    for root, _, files in os.walk(args.input_dir):
-        # Skip 00_index directory
-        if '00_index' in root:
-            continue
-        for fn in files:
-            # Skip hidden files (e.g., .DS_Store) and dotfiles
-            if fn.startswith('.'):
-                continue
-            if fn.lower().endswith('.md'):
-                full = os.path.join(root, fn)
-                markdown_files.append(full)
-    # If dry-run, limit to first N files
-    if args.dry_run:
-        count = args.dry_run_limit
-        markdown_files = markdown_files[:count]
+    # Load the vault manifest; dry runs read it but never write it
+    manifest_path = args.manifest or default_manifest_path(args.input_dir)
+    manifest = VaultManifest(manifest_path, args.input_dir)
+    if args.full_scan:
+        manifest.entries = {}
+    tax_hash = taxonomy_hash(tags_list)
+    print(f"Manifest: {manifest_path} ({len(manifest.entries)} entries)")
+    snapshot_path = default_snapshot_path(args.input_dir)
+    snapshot = load_snapshot(snapshot_path)
+    if snapshot is not None and set(snapshot) != set(tags_list) and not args.migrate:
+        print("Note: the tags file changed since this vault was tagged; "
+              "run with --migrate to carry tagged notes over to it.")
+    run_manifest = None if args.dry_run else manifest
+    # Stream notes from the vault: unchanged notes are skipped by stat data,
+    # headers are prefetched in parallel. If dry-run, limit to first N files
+    scan = VaultScan(args.input_dir, manifest, tax_hash, run_manifest, workers=args.scan_workers,
+                     limit=args.dry_run_limit if args.dry_run else None)
+    # Clean and token-cap note bodies before classification
+    budget = DEFAULT_TOKEN_BUDGETS.get(args.provider) if args.max_note_tokens is None else args.max_note_tokens
+    token_model = args.model if provider is None else provider.model
+
+    def prepare(body):
+        return prepare_text(body, budget or None, token_model, clean=not args.raw_notes)
+    print(f"Note token budget: {budget or 'unlimited'}, markdown cleanup: {not args.raw_notes}")
+    if args.batch_mode:
+        try:
+            run_batch_mode(args, provider, list(scan), tags_list, manifest, tax_hash, prepare)
+            if not args.dry_run and scan.complete:
+                manifest.prune(scan.seen)
+        finally:
+            if not args.dry_run:
+                manifest.save()
+        return
+    if args.provider == 'lexical' and (args.lexical_train or not provider.classifier.trained):
+        with stage('lexical_train'):
+            learned = train_lexical(provider, (path for path, _ in iter_notes(args.input_dir)), tags_list,
+                                    manifest.key, prepare)
+        if not provider.classifier.trained:
+            print("Error: no notes with tags and 'tag_revision_needed: false' to train the lexical classifier on.",
+                  file=sys.stderr)
+            sys.exit(1)
+        print(f"Lexical classifier: learned {learned} notes "
+              f"({len(provider.classifier.trained)} trained, {len(provider.classifier.tags)} tags)")
+        if not args.dry_run:
+            provider.classifier.save(provider.path)
+    # Shared rate limiter and retry policy for all API calls
+    provider_key = args.embed_provider if args.provider == 'embedding' else args.provider
+    limits = DEFAULT_RATE_LIMITS.get(provider_key, {})
+    rpm = limits.get('rpm') if args.rpm is None else args.rpm
+    tpm = limits.get('tpm') if args.tpm is None else args.tpm
+    limiter = RateLimiter(rpm or None, tpm or None)
+    provider = RateLimitedProvider(provider, limiter, max_retries=args.max_retries)
+    if args.hierarchical:
+        from hierarchy import HierarchicalClassifier, load_tags_tree
+        try:
+            tree = load_tags_tree(tags_file)
+        except Exception as e:
+            print(f"Error loading tags file {tags_file}: {e}", file=sys.stderr)
+            sys.exit(1)
+        provider = HierarchicalClassifier(provider, tree, beam_width=args.beam_width)
+        print(f"Hierarchical mode: depth {tree.depth()}, beam width {args.beam_width}")
+    print(f"Concurrency: {args.concurrency}, rate limits: rpm={rpm or 'unlimited'}, tpm={tpm or 'unlimited'}")
+    if args.migrate:
+        embedder = None
+        if args.provider == 'embedding':
+            embedder = provider
+        elif args.knn or args.cascade:
+            embedder = build_embedding_provider(args)
+        run_migration(args, provider, tags_list, manifest, tax_hash, prepare, embedder)
+        return
+    # Peek at the first note so an idle run makes no setup API calls
+    pending = iter(scan)
+    first = next(pending, None)
+    if first is not None:
+        pending = chain([first], pending)
+    knn = on_tagged = None
+    stages = []
+    if args.cascade and args.provider == 'embedding':
+        print('Error: --cascade needs a completion provider to escalate to.', file=sys.stderr)
+        sys.exit(1)
+    if args.knn or args.cascade:
+        if args.provider == 'embedding':
+            embedder = provider
+        else:
+            embed_limits = DEFAULT_RATE_LIMITS.get(args.embed_provider, {})
+            embedder = RateLimitedProvider(build_embedding_provider(args),
+                                           RateLimiter(embed_limits.get('rpm'), embed_limits.get('tpm')),
+                                           max_retries=args.max_retries)
+    if args.cascade:
+        from cascade import CascadeProvider
+        provider = CascadeProvider(embedder, provider, margin=args.cascade_margin)
+        stages.insert(0, provider)
+        if first is not None or args.watch:
+            embedder.load_tags(tags_list)
+        print(f"Cascade: embedding ({args.embed_provider}/{embedder.model}) -> {args.provider}, "
+              f"margin={args.cascade_margin}")
+    if args.knn:
+        from neighbor_index import NeighborIndex, KNNProvider, default_index_dir
+        knn_dir = args.knn_index or default_index_dir(args.input_dir, args.embed_provider, embedder.model)
+        knn = KNNProvider(NeighborIndex.load(knn_dir), embedder, provider,
+                          k=args.knn_k, min_similarity=args.knn_min_similarity)
+        if args.knn_seed:
+            added = seed_neighbor_index((path for path, _ in iter_notes(args.input_dir)), knn, tags_list, manifest.key, prepare,
+                                        batch_size=max(1, args.embed_batch_size))
+            print(f"kNN index seeded with {added} tagged notes")
+        print(f"kNN index: {knn_dir} ({len(knn.index)} notes), k={args.knn_k}, "
+              f"min similarity={args.knn_min_similarity}")
+        provider = knn
+        stages.insert(0, knn)
+        if not args.dry_run:
+            # Newly tagged notes become neighbours for the rest of the run
+            def on_tagged(path, text, tags):
+                knn.note_tagged(manifest.key(path), text, tags)
+    dedup = None
+    if args.dedup:
+        from near_duplicates import DuplicateIndex, DuplicateFinder, default_duplicate_dir
+        dedup_dir = args.dedup_index or default_duplicate_dir(args.input_dir)
+        dedup = DuplicateFinder(DuplicateIndex.load(dedup_dir), args.input_dir, threshold=args.dedup_threshold)
+        if args.dedup_seed:
+            added = seed_duplicate_index((path for path, _ in iter_notes(args.input_dir)), dedup, tags_list, prepare)
+            print(f"Duplicate index seeded with {added} tagged notes")
+        print(f"Duplicate index: {dedup_dir} ({len(dedup.index)} notes), threshold={args.dedup_threshold}")
+        stages.insert(0, dedup)
+        if not args.dry_run:
+            neighbor_tagged = on_tagged
+
+            # Tagged notes (including inherited tags) become duplicate targets
+            def on_tagged(path, text, tags):
+                if neighbor_tagged is not None:
+                    neighbor_tagged(path, text, tags)
+                dedup.note_tagged(path, text, tags)
+    tag_index = None
+    tagged = set()
+    if args.update_index and not args.dry_run:
+        index_dir = args.index_dir or os.path.join(args.input_dir, '00_index')
+        tag_index = TagIndex(default_tag_index_path(args.input_dir), args.input_dir)
+        index_tax = load_taxonomy(tags_file)
+        print(f"Index pages: {index_dir} ({len(tag_index.entries)} notes indexed)")
+        previous_tagged = on_tagged
+
+        # Collect tagged notes so their index entries are refreshed after the run
+        def on_tagged(path, text, tags):
+            if previous_tagged is not None:
+                previous_tagged(path, text, tags)
+            tagged.add(path)
+
+        def update_index(scan):
+            # A complete scan also picks up notes edited or deleted by hand
+            if scan.complete or not tag_index.entries:
+                tag_index.refresh(workers=args.scan_workers)
+            else:
+                tag_index.update(sorted(tagged))
+            tagged.clear()
+            tag_index.save()
+            folder = os.path.basename(os.path.normpath(args.input_dir))
+            write_index(index_tax, index_dir, folder, tag_index.notes_by_tag())
+    if args.provider in ('embedding', 'lexical'):
+        # Embed the taxonomy once up front instead of inside the first workers
+        if first is not None or args.watch:
+            provider.load_tags(tags_list)
+        # Classify notes in groups so their embeddings (or lexical features) are scored together
+        size = max(1, args.embed_batch_size)
+        group = size
+
+        def handle(paths):
+            process_batch(paths, provider, tags_list, dry_run=args.dry_run,
+                          manifest=run_manifest, tax_hash=tax_hash, prepare=prepare, on_tagged=on_tagged,
+                          dedup=dedup)
+        save_every = max(1, args.manifest_save_every // size)
+    elif args.pack_size > 1 and not args.hierarchical:
+        # Send several notes per completion request, sharing the taxonomy prefix
+        size = args.pack_size
+        group = size
+
+        def handle(paths):
+            process_packed(paths, provider, tags_list, dry_run=args.dry_run, manifest=run_manifest,
+                           tax_hash=tax_hash, prepare=prepare, pack_tokens=args.pack_token_budget,
+                           on_tagged=on_tagged, dedup=dedup)
+        save_every = max(1, args.manifest_save_every // size)
+    else:
+        group = None
+
+        def handle(note):
+            process_file(note.path, provider, tags_list, dry_run=args.dry_run,
+                         manifest=run_manifest, tax_hash=tax_hash, prepare=prepare, on_tagged=on_tagged,
+                         dedup=dedup, header=note.header)
+        save_every = args.manifest_save_every
+
+    def save_state():
+        with stage('save_state'):
+            manifest.save()
+            if knn is not None:
+                knn.index.save(knn_dir)
+            if dedup is not None:
+                dedup.index.save(dedup_dir)
+
+    def on_done(count):
+        if not args.dry_run and count % save_every == 0:
+            save_state()
+
+    def process(notes, scan):
+        """Classify the notes yielded by a scan and persist progress."""
+        try:
+            run_notes(notes if group is None else batched(notes, group), handle,
+                      concurrency=args.concurrency, on_done=on_done)
+            # Forget notes deleted from the vault (only known after a full scan)
+            if not args.dry_run and scan.complete:
+                manifest.prune(scan.seen)
+        finally:
+            if not args.dry_run:
+                save_state()
+        if tag_index is not None:
+            with stage('update_index'):
+                update_index(scan)
+        count('notes_unchanged', scan.unchanged)
+        print(f"Notes found: {len(scan.seen)}, unchanged (skipped without reading): {scan.unchanged}, "
+              f"skipped by checkbox: {scan.skipped}")
+        if stages:
+            resolved = [f"{stage.stage}={stage.stats[stage.stage]}" for stage in stages]
+            resolved.append(f"{args.provider}={stages[-1].stats['escalated']}")
+            print(f"Notes resolved per stage: {', '.join(resolved)}")
+            # Stage stats are running totals across watch batches
+            for gate in stages:
+                set_count(f"resolved_{gate.stage}", gate.stats[gate.stage])
+            set_count('escalated', stages[-1].stats['escalated'])
+        instrumentation.write_reports()
+
+    # Save progress when the background run is terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
     # Process selected markdown files
-    for path in markdown_files:
-        process_file(path, provider, tags_list, dry_run=args.dry_run)
+    process(pending, scan)
+    # The first tagged taxonomy is what a later --migrate diffs against
+    if snapshot is None and not args.dry_run:
+        save_snapshot(snapshot_path, tags_list)
+    if not args.watch:
+        return
+
+    def on_batch(paths, full_scan):
+        if full_scan:
+            batch = VaultScan(args.input_dir, manifest, tax_hash, run_manifest, workers=args.scan_workers)
+        else:
+            notes = []
+            for path in paths:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                # Our own writes show up as changes too
+                if not manifest.is_unchanged(path, st):
+                    notes.append((path, st))
+            if not notes:
+                return
+            batch = VaultScan(args.input_dir, manifest, tax_hash, run_manifest,
+                              workers=args.scan_workers, notes=notes)
+        print(f"=== {time.strftime('%Y-%m-%d %H:%M:%S')}: "
+              f"{'full scan' if full_scan else f'{len(paths)} changed notes'} ===")
+        process(iter(batch), batch)
+        sys.stdout.flush()
+
+    # Keep the provider, taxonomy and tag embeddings loaded between batches
+    try:
+        watch(args.input_dir, on_batch, mode=args.watch_mode, interval=args.watch_interval,
+              debounce=args.watch_debounce, port=args.watch_port)
+    except KeyboardInterrupt:
+        print("Watch mode stopped")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
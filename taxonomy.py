@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Compiled tag taxonomy.
+Taxonomy is the flattened tag list of tags.yml (it still behaves as a list)
+compiled once for the per-note work: O(1) membership, a trie over the path
+segments, an alias table of normalized spellings and unique path suffixes,
+and JSON schemas that constrain model output to the tags. Near-miss tags
+returned by a model (other separators or width, a missing or extra path
+segment, a bare leaf name) are repaired locally instead of being dropped.
+"""
+import re
+import json
+import unicodedata
+
+from instrumentation import count
+
+# Leaf names of a catch-all tag used when a note matches nothing
+FALLBACK_NAMES = ('未分類', 'uncategorized')
+
+def flatten_tags(data):
+    """
+    Flatten parsed tags.yml data into 'parent/child' tag paths.
+    Supports a top-level list of tag strings, and dicts whose keys are
+    parent categories and whose values are (lists of) children.
+    """
+    def recurse(node, prefix=""):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                new_prefix = f"{prefix}/{key}" if prefix else str(key)
+                yield from recurse(value, new_prefix)
+        elif isinstance(node, list):
+            for item in node:
+                yield from recurse(item, prefix)
+        elif isinstance(node, str):
+            yield f"{prefix}/{node}" if prefix else node
+    return list(recurse(data))
+
+def tag_key(tag):
+    """
+    Spelling-insensitive form of a tag: NFKC, casefolded, '#' and quotes
+    stripped, '\\', '>', '::' and '|' read as '/', spaces, '_', '-' and '・' dropped.
+    """
+    key = unicodedata.normalize('NFKC', str(tag)).casefold().strip().strip('"\'`').lstrip('#')
+    key = re.sub(r'\s*(?:/|\\|>|::|\|)\s*', '/', key)
+    key = re.sub(r'[\s_\-・]+', '', key)
+    return '/'.join(part for part in key.split('/') if part)
+
+def _in_order(parts, path):
+    """True if `parts` appear in `path` (both segment lists) in the same order."""
+    it = iter(path)
+    return all(part in it for part in parts)
+
+class Taxonomy(list):
+    """
+    Read-only list of tags with compiled lookup structures:
+    `trie` maps key segments to sub-tries (a leaf stores its tag under ''),
+    `aliases` maps tag keys and unique key suffixes to their tag (None when
+    a suffix is ambiguous), and `fallback` is the catch-all tag, if any.
+    """
+    def __init__(self, tags):
+        super().__init__(dict.fromkeys(tags))
+        self._set = frozenset(self)
+        self.tag_lines = '\n'.join(f"- {t}" for t in self)
+        self.trie = {}
+        self.aliases = {}
+        self._keys = {}
+        self._leaves = {}
+        suffixes = {}
+        for tag in self:
+            parts = tag_key(tag).split('/')
+            self._keys[tag] = parts
+            self._leaves.setdefault(parts[-1], []).append(tag)
+            node = self.trie
+            for part in parts:
+                node = node.setdefault(part, {})
+            node[''] = tag
+            key = '/'.join(parts)
+            self.aliases[key] = tag if self.aliases.get(key, tag) == tag else None
+            for i in range(1, len(parts)):
+                suffix = '/'.join(parts[i:])
+                suffixes[suffix] = tag if suffixes.get(suffix, tag) == tag else None
+        # Full paths take precedence over suffixes of other tags
+        for suffix, tag in suffixes.items():
+            self.aliases.setdefault(suffix, tag)
+        self.fallback = next((t for name in FALLBACK_NAMES for t in self._leaves.get(name, ())), None)
+
+    def __contains__(self, tag):
+        return isinstance(tag, str) and tag in self._set
+
+    def _leaf_below(self, node):
+        """The only tag under a trie node, or None if there are several."""
+        found = None
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for part, child in node.items():
+                if part == '':
+                    if found is not None:
+                        return None
+                    found = child
+                else:
+                    stack.append(child)
+        return found
+
+    def resolve(self, tag):
+        """Canonical tag for a possibly misspelled one, or None if it cannot be resolved unambiguously."""
+        if tag in self:
+            return tag
+        if not isinstance(tag, str):
+            return None
+        key = tag_key(tag)
+        if not key:
+            return None
+        if key in self.aliases:
+            return self.aliases[key]
+        parts = key.split('/')
+        # Missing middle segment: the leaf name plus some of its parents
+        candidates = [t for t in self._leaves.get(parts[-1], ()) if _in_order(parts, self._keys[t])]
+        if len(candidates) == 1:
+            return candidates[0]
+        # Extra segments below a tag
+        for i in range(len(parts) - 1, 0, -1):
+            resolved = self.aliases.get('/'.join(parts[:i]))
+            if resolved is not None:
+                return resolved
+        # A category with a single tag below it
+        node = self.trie
+        for part in parts:
+            node = node.get(part)
+            if node is None:
+                return None
+        return self._leaf_below(node)
+
+    def validate(self, tags):
+        """Resolve model-returned tags to taxonomy tags, dropping unknown ones and duplicates."""
+        out = []
+        for tag in tags:
+            resolved = self.resolve(tag)
+            if resolved is None:
+                continue
+            if resolved != tag:
+                count('tags_repaired')
+            if resolved not in out:
+                out.append(resolved)
+        return out
+
+    def schema(self, ids=None, strict=True, max_enum=500, max_enum_chars=7500):
+        """
+        JSON schema of a classification answer: {"tags": [...]}, or one tag
+        array per note ID for packed requests. Tags are an enum unless the
+        taxonomy exceeds the API's enum limits. `strict` forbids extra keys
+        (required by OpenAI strict mode, rejected by Gemini).
+        """
+        items = {'type': 'string'}
+        if len(self) <= max_enum and sum(len(t) for t in self) <= max_enum_chars:
+            items['enum'] = list(self)
+        array = {'type': 'array', 'items': items}
+        properties = {'tags': array} if ids is None else {nid: array for nid in ids}
+        schema = {'type': 'object', 'properties': properties, 'required': list(properties)}
+        if strict:
+            schema['additionalProperties'] = False
+        return schema
+
+def as_taxonomy(tags):
+    """`tags` compiled into a Taxonomy unless it already is one."""
+    return tags if isinstance(tags, Taxonomy) else Taxonomy(tags)
+
+def extract_json(content):
+    """
+    First JSON array or object in a model response, skipping prose and code
+    fences. A trailing ']' is restored when generation stopped at the
+    closing bracket. Raises ValueError if there is none.
+    """
+    text = content.strip()
+    decoder = json.JSONDecoder()
+    starts = [m.start() for m in re.finditer(r'[\[{]', text)]
+    for start in starts[:16]:
+        try:
+            return decoder.raw_decode(text, start)[0]
+        except ValueError:
+            continue
+    if starts:
+        try:
+            return decoder.raw_decode(text + ']', starts[0])[0]
+        except ValueError:
+            pass
+    raise ValueError('no JSON value in response')
+
+def answer_tags(value):
+    """Tag array of a single-note answer: a bare array or {"tags": [...]}; None otherwise."""
+    if isinstance(value, dict):
+        value = value.get('tags')
+    return value if isinstance(value, list) else None
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Diff two flattened tag taxonomies for migrating tagged notes.
+Tags present in both are unchanged. Of the rest, old and new tags are
+paired as renames when they differ only in spelling, when a leaf keeps
+its name under a new parent (moved subtrees; the parent mapping learned
+from unambiguous leaves is applied to the others), or when a category
+swaps one leaf for a similarly named one. Unpaired tags are removed or added.
+A snapshot of the taxonomy each vault was last tagged with is kept so
+the next migration knows what changed.
+"""
+import os
+import sys
+import json
+import hashlib
+import difflib
+
+from taxonomy import tag_key
+from vault_manifest import DEFAULT_MANIFEST_DIR
+
+def default_snapshot_path(input_dir):
+    """Taxonomy snapshot file for a vault directory, stored next to this script."""
+    key = hashlib.sha1(os.path.abspath(input_dir).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(DEFAULT_MANIFEST_DIR, f"taxonomy_{key}.json")
+
+def load_snapshot(path):
+    """Tags of a saved taxonomy snapshot, or None if there is none."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)['tags']
+    except Exception as e:
+        print(f"Warning: ignoring unreadable taxonomy snapshot {path}: {e}", file=sys.stderr)
+        return None
+
+def save_snapshot(path, tags):
+    """Write a taxonomy snapshot atomically (temp file + rename)."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'tags': list(tags)}, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def _split(tag):
+    parent, _, leaf = tag.rpartition('/')
+    return parent, leaf
+
+class TaxonomyDiff:
+    """
+    `renamed` maps old tags to new ones; `added` and `removed` list the
+    unpaired new and old tags. Tags outside the old taxonomy are left alone.
+    """
+    def __init__(self, old, new, renamed, added, removed):
+        self.old = set(old)
+        self.new = set(new)
+        self.renamed = renamed
+        self.added = added
+        self.removed = removed
+        self._removed = set(removed)
+
+    def __bool__(self):
+        return bool(self.renamed or self.added or self.removed)
+
+    def moved_subtrees(self):
+        """{old parent: new parent} for renames that kept the leaf name."""
+        moves = {}
+        for old, new in self.renamed.items():
+            (old_parent, old_leaf), (new_parent, new_leaf) = _split(old), _split(new)
+            if old_parent != new_parent and tag_key(old_leaf) == tag_key(new_leaf):
+                moves[old_parent] = new_parent
+        return moves
+
+    def migrate(self, tags):
+        """Note tags after applying renames, and the note's tags that were removed."""
+        out, lost = [], []
+        for tag in tags:
+            if tag in self._removed:
+                lost.append(tag)
+                continue
+            tag = self.renamed.get(tag, tag)
+            if tag not in out:
+                out.append(tag)
+        return out, lost
+
+    def describe(self):
+        lines = [f"Taxonomy changes: {len(self.renamed)} renamed/moved, "
+                 f"{len(self.added)} added, {len(self.removed)} removed"]
+        moves = self.moved_subtrees()
+        lines.extend(f"  moved: {old or '/'} -> {new or '/'}" for old, new in sorted(moves.items()))
+        for old, new in self.renamed.items():
+            if _split(old)[0] not in moves or tag_key(_split(old)[1]) != tag_key(_split(new)[1]):
+                lines.append(f"  renamed: {old} -> {new}")
+        lines.extend(f"  added: {tag}" for tag in self.added)
+        lines.extend(f"  removed: {tag}" for tag in self.removed)
+        return lines
+
+def diff_taxonomies(old, new, min_ratio=0.5):
+    """Diff two tag lists; `min_ratio` is the leaf-name similarity needed to pair an in-place rename."""
+    old_set, new_set = set(old), set(new)
+    gone = [t for t in old if t not in new_set]
+    fresh = [t for t in new if t not in old_set]
+    renamed = {}
+
+    def pair(old_tag, new_tag):
+        renamed[old_tag] = new_tag
+        gone.remove(old_tag)
+        fresh.remove(new_tag)
+
+    # Spelling changes (case, width, separators)
+    by_key = {}
+    for tag in fresh:
+        by_key.setdefault(tag_key(tag), []).append(tag)
+    for tag in list(gone):
+        match = by_key.get(tag_key(tag), [])
+        if len(match) == 1 and match[0] in fresh:
+            pair(tag, match[0])
+    # Leaves that kept their name under a new parent
+    parents = {}
+
+    def by_leaf(tags):
+        groups = {}
+        for tag in tags:
+            groups.setdefault(tag_key(_split(tag)[1]), []).append(tag)
+        return groups
+
+    old_leaves, new_leaves = by_leaf(gone), by_leaf(fresh)
+    for leaf, olds in old_leaves.items():
+        news = new_leaves.get(leaf, [])
+        if len(olds) == 1 and len(news) == 1:
+            parents[_split(olds[0])[0]] = _split(news[0])[0]
+            pair(olds[0], news[0])
+    # Ambiguous leaf names follow the parent moves learned above
+    for leaf, olds in old_leaves.items():
+        for tag in [t for t in olds if t in gone]:
+            target = parents.get(_split(tag)[0])
+            match = [t for t in new_leaves.get(leaf, []) if t in fresh and _split(t)[0] == target]
+            if target is not None and len(match) == 1:
+                pair(tag, match[0])
+    # A category that swapped one leaf for a similarly named one
+    for parent in {_split(t)[0] for t in gone}:
+        olds = [t for t in gone if _split(t)[0] == parent]
+        news = [t for t in fresh if _split(t)[0] == parent]
+        if len(olds) == 1 and len(news) == 1:
+            ratio = difflib.SequenceMatcher(None, tag_key(_split(olds[0])[1]), tag_key(_split(news[0])[1])).ratio()
+            if ratio >= min_ratio:
+                pair(olds[0], news[0])
+    return TaxonomyDiff(old, new, renamed, fresh, gone)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Map-reduce helpers for taxonomy generation on vaults whose titles do not
+fit in one prompt. Titles are split into token-bounded shards, each shard
+yields a partial taxonomy, and partial taxonomies are merged structurally:
+categories whose names normalize to the same key (full/half width, case,
+spacing, trailing punctuation) are unified level by level, and the result
+is cut to the requested depth. Model output is parsed and validated here
+before it is used or written.
+
+Trees are dicts mapping a normalized key to (display name, children tree).
+"""
+import re
+import unicodedata
+import yaml
+
+_FENCE_RE = re.compile(r'^```[\w-]*[ \t]*\n(.*?)^```', re.S | re.M)
+_SPACE_RE = re.compile(r'\s+')
+
+def split_by_tokens(items, max_tokens, size):
+    """
+    Group items in order into lists whose summed size(item) stays within
+    max_tokens. An item larger than the budget gets a group of its own.
+    """
+    groups, current, used = [], [], 0
+    for item in items:
+        cost = size(item)
+        if current and used + cost > max_tokens:
+            groups.append(current)
+            current, used = [], 0
+        current.append(item)
+        used += cost
+    if current:
+        groups.append(current)
+    return groups
+
+def name_key(name):
+    """Key under which category names are considered the same."""
+    text = unicodedata.normalize('NFKC', str(name)).casefold()
+    return _SPACE_RE.sub(' ', text).strip(' ・.,、。:/_-')
+
+def _child(tree, name):
+    name = str(name).strip()
+    key = name_key(name)
+    if not key:
+        return {}
+    if key not in tree:
+        tree[key] = (name, {})
+    return tree[key][1]
+
+def to_tree(data, depth):
+    """Tree from parsed taxonomy YAML (nested mappings, lists and strings), cut to depth levels."""
+    tree = {}
+
+    def add(node, target, level):
+        if isinstance(node, dict):
+            for name, value in node.items():
+                if name is None:
+                    continue
+                child = _child(target, name)
+                if level < depth:
+                    add(value, child, level + 1)
+        elif isinstance(node, list):
+            for item in node:
+                add(item, target, level)
+        elif isinstance(node, (str, int, float)) and not isinstance(node, bool):
+            _child(target, node)
+
+    add(data, tree, 1)
+    return tree
+
+def extract_yaml(text):
+    """YAML part of a model reply (the first fenced code block, if any)."""
+    match = _FENCE_RE.search(text or '')
+    return match.group(1) if match else (text or '')
+
+def parse_taxonomy(text, depth):
+    """
+    Parse a model reply into a tree. Raises ValueError when the reply is
+    not valid YAML or contains no categories.
+    """
+    try:
+        data = yaml.safe_load(extract_yaml(text))
+    except yaml.YAMLError as e:
+        raise ValueError(f"invalid YAML: {e}") from e
+    if not isinstance(data, (dict, list)):
+        raise ValueError("taxonomy is not a YAML mapping or list")
+    tree = to_tree(data, depth)
+    if not tree:
+        raise ValueError("taxonomy has no categories")
+    return tree
+
+def _merge_into(src, dst):
+    for key, (name, children) in src.items():
+        if key not in dst:
+            dst[key] = (name, {})
+        _merge_into(children, dst[key][1])
+
+def _collapse_repeats(tree, parent_key=None):
+    """Fold children named like their parent (e.g. 開発/開発) into the parent."""
+    for key in list(tree):
+        name, children = tree[key]
+        _collapse_repeats(children, key)
+        if key == parent_key:
+            del tree[key]
+            _merge_into(children, tree)
+
+def _fold_top_level(tree):
+    """
+    Move a top-level category that also appears under exactly one other
+    top-level category (e.g. AI next to 技術/AI) into that place.
+    """
+    for key in list(tree):
+        if key not in tree:
+            continue
+        parents = [p for p, (_, children) in tree.items() if p != key and key in children]
+        if len(parents) == 1:
+            _, children = tree.pop(key)
+            _merge_into(children, tree[parents[0]][1][key][1])
+
+def _trim(tree, depth):
+    for _, children in tree.values():
+        if depth <= 1:
+            children.clear()
+        else:
+            _trim(children, depth - 1)
+
+def merge_taxonomies(trees, depth):
+    """Structural merge of several trees with duplicate categories unified."""
+    merged = {}
+    for tree in trees:
+        _merge_into(tree, merged)
+    _collapse_repeats(merged)
+    _fold_top_level(merged)
+    _trim(merged, depth)
+    return merged
+
+def to_yaml_data(tree):
+    """
+    tags.yml structure for a tree: a mapping when every category has
+    subcategories, a list of names when none has, otherwise a list mixing
+    names and single-key mappings (all read back by load_tags_file).
+    """
+    nodes = list(tree.values())
+    if all(children for _, children in nodes):
+        return {name: to_yaml_data(children) for name, children in nodes}
+    return [{name: to_yaml_data(children)} if children else name for name, children in nodes]
+
+def dump_taxonomy(tree):
+    return yaml.dump(to_yaml_data(tree), allow_unicode=True, sort_keys=False)
+
+def leaf_paths(tree, prefix=''):
+    """'parent/child' paths of all leaf categories (the tags load_tags_file would produce)."""
+    paths = []
+    for name, children in tree.values():
+        path = f"{prefix}/{name}" if prefix else name
+        paths.extend(leaf_paths(children, path) if children else [path])
+    return paths
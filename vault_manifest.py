@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Persistent vault state manifest for incremental tag_refiner runs.
+Records, per note, the stat data and content hash seen at the last run
+together with the taxonomy hash and the tags that were assigned, so that
+unchanged notes can be skipped without opening or YAML-parsing them.
+"""
+import os
+import sys
+import json
+import hashlib
+import threading
+
+MANIFEST_VERSION = 1
+DEFAULT_MANIFEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+
+# Statuses that need no further work while the note is unchanged
+DONE_STATUSES = ('tagged', 'skipped')
+
+def default_manifest_path(input_dir):
+    """Manifest file for a vault directory, stored next to this script."""
+    key = hashlib.sha1(os.path.abspath(input_dir).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(DEFAULT_MANIFEST_DIR, f"manifest_{key}.json")
+
+def taxonomy_hash(tags_list):
+    """Order-independent hash of a flattened tag taxonomy."""
+    return hashlib.sha256('\n'.join(sorted(tags_list)).encode('utf-8')).hexdigest()[:16]
+
+class VaultManifest:
+    """
+    path -> {size, mtime_ns, hash, taxonomy, tags, status}
+    Paths are stored relative to the vault root with '/' separators.
+    """
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self.entries = {}
+        self.dirty = False
+        # Workers of a concurrent run record entries from several threads
+        self._lock = threading.RLock()
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == MANIFEST_VERSION:
+                    self.entries = data.get('entries', {})
+            except Exception as e:
+                print(f"Warning: ignoring unreadable manifest {path}: {e}", file=sys.stderr)
+
+    def key(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def get(self, path):
+        return self.entries.get(self.key(path))
+
+    def is_unchanged(self, path, st):
+        """True if the note was fully handled before and its stat data still matches."""
+        entry = self.get(path)
+        return (
+            entry is not None
+            and entry.get('status') in DONE_STATUSES
+            and entry.get('size') == st.st_size
+            and entry.get('mtime_ns') == st.st_mtime_ns
+        )
+
+    def same_content(self, path, digest):
+        """True if the note was fully handled before and its SHA-256 digest still matches."""
+        entry = self.get(path)
+        return (
+            entry is not None
+            and entry.get('status') in DONE_STATUSES
+            and entry.get('hash') == digest
+        )
+
+    def touch(self, path, st):
+        """Refresh the stat data of an entry whose content did not change."""
+        with self._lock:
+            entry = self.get(path)
+            if entry is not None:
+                entry['size'] = st.st_size
+                entry['mtime_ns'] = st.st_mtime_ns
+                self.dirty = True
+
+    def record(self, path, digest, status, tags=None, taxonomy=None, st=None):
+        st = st or os.stat(path)
+        if isinstance(tags, str):
+            tags = [tags]
+        entry = {
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'hash': digest,
+            'taxonomy': taxonomy,
+            'tags': list(tags) if tags is not None else None,
+            'status': status,
+        }
+        with self._lock:
+            self.entries[self.key(path)] = entry
+            self.dirty = True
+
+    def prune(self, seen_paths):
+        """Drop entries for notes that no longer exist in the vault."""
+        seen = {self.key(p) for p in seen_paths}
+        with self._lock:
+            stale = [k for k in self.entries if k not in seen]
+            for k in stale:
+                del self.entries[k]
+            if stale:
+                self.dirty = True
+        return len(stale)
+
+    def save(self):
+        """Write the manifest atomically (temp file + rename)."""
+        with self._lock:
+            if not self.dirty:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'version': MANIFEST_VERSION, 'entries': self.entries}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self.dirty = False
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Streaming vault scanner shared by tag_refiner.py and generate_taxonomy.py.
+Walks the vault with os.scandir, pruning hidden and excluded directories
+before descending into them, and yields notes with their stat results as
+they are found. prefetch() runs per-note reads (e.g. headers) on a thread
+pool ahead of the consumer, which hides per-file latency on slow mounts
+such as a Windows vault under /mnt/c in WSL.
+"""
+import os
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Directories never descended into (index notes are generated, not clipped)
+DEFAULT_EXCLUDED_DIRS = ('00_index',)
+
+def iter_notes(root, excluded_dirs=DEFAULT_EXCLUDED_DIRS, suffix='.md'):
+    """
+    Yield (path, stat_result) for every note under root, directory by directory.
+    Hidden files and directories (dotfiles) and directories named in
+    excluded_dirs are skipped; symlinked directories are not followed.
+    """
+    excluded = set(excluded_dirs)
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            it = os.scandir(directory)
+        except OSError as e:
+            print(f"Warning: cannot scan {directory}: {e}", file=sys.stderr)
+            continue
+        subdirs = []
+        with it:
+            for entry in it:
+                name = entry.name
+                if name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if name not in excluded:
+                            subdirs.append(entry.path)
+                    elif name.lower().endswith(suffix) and entry.is_file():
+                        yield entry.path, entry.stat()
+                except OSError:
+                    continue
+        # Visit subdirectories in listing order
+        stack.extend(reversed(subdirs))
+
+def prefetch(items, load, workers=8):
+    """
+    Yield (item, load(item)) in input order while up to 2 * workers later
+    items are already being loaded on a thread pool. A load that raises
+    yields the exception object as its result.
+    """
+    def safe_load(item):
+        try:
+            return load(item)
+        except Exception as e:
+            return e
+
+    if workers <= 1:
+        for item in items:
+            yield item, safe_load(item)
+        return
+    window = deque()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for item in items:
+            window.append((item, executor.submit(safe_load, item)))
+            if len(window) >= 2 * workers:
+                item, future = window.popleft()
+                yield item, future.result()
+        while window:
+            item, future = window.popleft()
+            yield item, future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Watch mode: keep tag_refiner running and tag notes shortly after they are saved.
+Changes come from filesystem events (the optional `watchdog` package, i.e.
+inotify on Linux) or from polling the vault's stat data, which is also
+what works for Windows folders mounted into WSL. Changed notes are
+collected and handed over in debounced micro-batches. A small HTTP server
+on localhost lets other tools (e.g. the Obsidian Shell Commands plugin via
+curl) request a rescan or queue a note without starting Python.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from vault_scanner import DEFAULT_EXCLUDED_DIRS, iter_notes
+
+DEFAULT_WATCH_PORT = 18765
+# Filesystems whose changes made by another OS are not reported by inotify
+POLL_FSTYPES = ('9p', 'drvfs', 'cifs', 'smb3', 'nfs', 'nfs4', 'fuse.sshfs')
+
+class ChangeQueue:
+    """
+    Thread-safe set of changed note paths (plus a full-rescan flag), drained
+    in micro-batches once no new change arrived for `debounce` seconds.
+    """
+    def __init__(self):
+        self.paths = set()
+        self.full_scan = False
+        self.last_change = 0.0
+        self._cond = threading.Condition()
+
+    def add(self, path):
+        with self._cond:
+            self.paths.add(path)
+            self.last_change = time.monotonic()
+            self._cond.notify()
+
+    def request_scan(self):
+        with self._cond:
+            self.full_scan = True
+            self.last_change = time.monotonic()
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self.paths), self.full_scan
+
+    def next_batch(self, debounce=2.0, max_delay=30.0):
+        """
+        Block until there is work and the vault has been quiet for `debounce`
+        seconds (or `max_delay` passed since the first change), then return
+        (paths, full_scan) and reset the queue.
+        """
+        with self._cond:
+            while not self.paths and not self.full_scan:
+                self._cond.wait()
+            first = time.monotonic()
+            while True:
+                now = time.monotonic()
+                quiet = self.last_change + debounce - now
+                if quiet <= 0 or now - first >= max_delay:
+                    break
+                self._cond.wait(min(quiet, first + max_delay - now))
+            paths, full_scan = sorted(self.paths), self.full_scan
+            self.paths = set()
+            self.full_scan = False
+            return paths, full_scan
+
+def is_note_path(root, path, excluded_dirs=DEFAULT_EXCLUDED_DIRS, suffix='.md'):
+    """True for notes iter_notes() would yield (no hidden or excluded path component)."""
+    rel = os.path.relpath(path, root)
+    parts = rel.split(os.sep)
+    if rel.startswith('..') or not parts[-1].lower().endswith(suffix):
+        return False
+    return not any(p.startswith('.') or p in excluded_dirs for p in parts[:-1]) and not parts[-1].startswith('.')
+
+def needs_polling(path):
+    """True if the vault lives on a mount where inotify misses changes (e.g. /mnt/c under WSL)."""
+    try:
+        with open('/proc/mounts', 'r', encoding='utf-8') as f:
+            mounts = [line.split()[1:3] for line in f if len(line.split()) > 2]
+    except OSError:
+        return False
+    path = os.path.realpath(path)
+    best, fstype = '', ''
+    for mount_point, fs in mounts:
+        mount_point = mount_point.replace('\\040', ' ')
+        if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) > len(best):
+            best, fstype = mount_point, fs
+    return fstype in POLL_FSTYPES
+
+def poll_vault(root, changes, interval, stop):
+    """Rescan the vault's stat data every `interval` seconds and queue new or modified notes."""
+    snapshot = {path: (st.st_size, st.st_mtime_ns) for path, st in iter_notes(root)}
+    while not stop.wait(interval):
+        current = {}
+        for path, st in iter_notes(root):
+            current[path] = (st.st_size, st.st_mtime_ns)
+            if snapshot.get(path) != current[path]:
+                changes.add(path)
+        snapshot = current
+
+def start_event_observer(root, changes):
+    """
+    Queue notes reported by watchdog filesystem events.
+    Returns the running observer, or None when watchdog is not installed.
+    """
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        return None
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.is_directory or event.event_type not in ('created', 'modified', 'moved', 'closed'):
+                return
+            path = getattr(event, 'dest_path', None) or event.src_path
+            if is_note_path(root, path):
+                changes.add(path)
+
+    observer = Observer()
+    observer.schedule(Handler(), root, recursive=True)
+    observer.daemon = True
+    observer.start()
+    return observer
+
+def resolve_note_path(root, path):
+    """
+    The vault path of a note named by an absolute or vault-relative `path`,
+    or None unless it resolves (following symlinks) to a note inside `root`.
+    """
+    real_root = os.path.realpath(root)
+    real = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([real_root, real]) != real_root or not is_note_path(real_root, real):
+        return None
+    return os.path.join(root, os.path.relpath(real, real_root))
+
+def start_trigger_server(root, changes, status, port, host='127.0.0.1'):
+    """
+    Serve on host:port:
+      POST /scan              - rescan the whole vault
+      POST /tag?path=<note>   - queue one note (absolute or vault-relative path inside the vault)
+      GET  /status            - JSON with queue and run counters
+    Requests carrying an Origin header (i.e. sent by a web page) may not
+    trigger runs.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == '/status':
+                queued, full_scan = changes.pending()
+                self._reply(200, dict(status, queued=queued, scan_requested=full_scan))
+            elif url.path in ('/scan', '/tag'):
+                self._reply(405, {'error': 'use POST'})
+            else:
+                self._reply(404, {'error': 'unknown endpoint'})
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            if url.path not in ('/scan', '/tag'):
+                self._reply(404, {'error': 'unknown endpoint'})
+            elif self.headers.get('Origin'):
+                # Browsers send cross-site form posts with an Origin; curl and local tools do not
+                self._reply(403, {'error': 'cross-origin requests are not allowed'})
+            elif url.path == '/scan':
+                changes.request_scan()
+                self._reply(202, {'queued': 'scan'})
+            else:
+                paths = parse_qs(url.query).get('path', [])
+                resolved = [resolve_note_path(root, path) for path in paths]
+                if not paths or None in resolved:
+                    self._reply(400, {'error': 'path must name a note inside the vault',
+                                      'rejected': [p for p, r in zip(paths, resolved) if r is None]})
+                    return
+                for path in resolved:
+                    changes.add(path)
+                self._reply(202, {'queued': paths})
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def watch(root, on_batch, mode='auto', interval=5.0, debounce=2.0, port=DEFAULT_WATCH_PORT):
+    """
+    Run until interrupted, calling on_batch(paths, full_scan) from this thread
+    for each debounced micro-batch. mode is 'events', 'poll' or 'auto'
+    (events when watchdog is installed and the vault is on a local filesystem).
+    A batch that raises is reported (and counted in the status) and watching goes on.
+    """
+    changes = ChangeQueue()
+    status = {'batches': 0, 'notes': 0, 'last_batch': None, 'errors': 0, 'last_error': None}
+    stop = threading.Event()
+    observer = server = None
+    if mode == 'events' or (mode == 'auto' and not needs_polling(root)):
+        observer = start_event_observer(root, changes)
+        if observer is None and mode == 'events':
+            print("Warning: watchdog is not installed; falling back to polling", file=sys.stderr)
+    if observer is None:
+        threading.Thread(target=poll_vault, args=(root, changes, interval, stop), daemon=True).start()
+        print(f"Watching {root} (polling every {interval:g}s)")
+    else:
+        print(f"Watching {root} (filesystem events)")
+    if port:
+        server = start_trigger_server(root, changes, status, port)
+        print(f"Trigger server: http://127.0.0.1:{port}/scan")
+    try:
+        while True:
+            paths, full_scan = changes.next_batch(debounce)
+            try:
+                on_batch(paths, full_scan)
+            except Exception as e:
+                print(f"Error processing watch batch: {e}", file=sys.stderr)
+                status['errors'] += 1
+                status['last_error'] = f"{time.strftime('%Y-%m-%dT%H:%M:%S')}: {e}"
+            status['batches'] += 1
+            status['notes'] += len(paths)
+            status['last_batch'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    finally:
+        stop.set()
+        if observer is not None:
+            observer.stop()
+        if server is not None:
+            server.shutdown()